@@ -0,0 +1,349 @@
+'''
+无界面客户端 SDK，用于机器人、脚本和压力测试
+
+AsyncChatClient 基于 asyncio，一个事件循环可以同时驱动成千上万个连接；
+ChatClient 是同步接口，所有实例共用一个后台事件循环线程
+协议编码与服务器共用 utils 中的 Protocol / FrameBuffer / MessageBuilder
+
+    client = ChatClient('127.0.0.1', 9999)
+    client.login('user1', '123')
+    client.send_message('user2', 'hello')
+    event = client.next_event(timeout=5)
+'''
+import asyncio
+import logging
+import os
+import random
+import threading
+import zlib
+
+from utils import MessageBuilder as mb
+from utils import Compression, FrameBuffer, Protocol, negotiate_compression
+
+
+class ChatError(Exception):
+    '''
+    服务器返回失败响应，response 为完整的响应消息
+    '''
+
+    def __init__(self, response):
+        super().__init__(response.get('message'))
+        self.response = response
+
+
+class AsyncChatClient:
+    '''
+    服务器推送的消息（私聊、群聊、在线状态、群发回执、文件通知和传输结果）作为事件交给 on_event 回调，
+    未设置回调时放入 events 队列，由 next_event 取出
+    带序号的消息自动去重并按批确认
+    compression 为 True（使用所有可用算法）或算法列表时，连接后与服务器协商压缩；
+    compress_files 为 True 时同时启用文件传输压缩，上传前检测文件是否可压缩
+    ssl_context 为 utils.ResumableSSLContext 时使用 TLS，消息连接和文件连接共用同一个上下文以复用会话
+    '''
+
+    def __init__(
+        self, host, port, file_port=None, heartbeat_interval=10, request_timeout=10, on_event=None,
+        chunk_size=65536, compression=None, compress_files=False, ssl_context=None
+    ):
+        self.host = host
+        self.port = port
+        self.file_port = file_port
+        self.heartbeat_interval = heartbeat_interval
+        self.request_timeout = request_timeout
+        self.on_event = on_event
+        self.chunk_size = chunk_size
+        self.compression = Compression.available() if compression is True else compression
+        self.compress_files = compress_files
+        self.ssl_context = ssl_context
+        self.codec = None  # 协商成功后的 FrameCodec
+        self.username = None
+        self.session_token = None
+        self.reader = None
+        self.writer = None
+        self.tasks = []
+        self.pending_responses = {}  # timestamp -> Future
+        self.events = asyncio.Queue()
+        self.delivery_epoch = None
+        self.seen_messages = {}
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=self.ssl_context)
+        self.codec = None
+        if self.compression:
+            self.codec = await negotiate_compression(self.reader, self.writer, self.compression, self.compress_files)
+        self.tasks = [asyncio.ensure_future(self.__read_loop()), asyncio.ensure_future(self.__heartbeat_loop())]
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+        for future in self.pending_responses.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Connection closed'))
+        self.pending_responses.clear()
+
+    def send(self, message):
+        if self.writer is None:
+            raise ConnectionError('Not connected')
+        data = Protocol.encode(message)
+        self.writer.write(self.codec.encode(data) if self.codec is not None else data)
+
+    async def request(self, message, timeout=None):
+        '''
+        发送请求并等待对应的响应，失败的响应抛出 ChatError
+        '''
+        future = await self.__send_request(message)
+        return await self.__wait_response(message, future, timeout or self.request_timeout)
+
+    async def __send_request(self, message):
+        if self.writer is None:
+            await self.connect()
+        # 同一连接上按 timestamp 匹配响应，同一时刻构造的请求需要错开
+        while message['timestamp'] in self.pending_responses:
+            message['timestamp'] += 1e-6
+        future = asyncio.get_running_loop().create_future()
+        self.pending_responses[message['timestamp']] = future
+        self.send(message)
+        return future
+
+    async def __wait_response(self, message, future, timeout):
+        try:
+            response = await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending_responses.pop(message['timestamp'], None)
+        if not response['success']:
+            raise ChatError(response)
+        return response
+
+    async def next_event(self, timeout=None):
+        return await asyncio.wait_for(self.events.get(), timeout)
+
+    async def __read_loop(self):
+        frame_buffer = self.codec or FrameBuffer()
+        try:
+            while True:
+                data = await self.reader.read(self.chunk_size)
+                if not data:
+                    break
+                acks = {}
+                for frame in frame_buffer.feed(data):
+                    ack = self.__dispatch(Protocol.decode(frame))
+                    if ack:
+                        conversation, seq = ack
+                        acks[conversation] = max(acks.get(conversation, 0), seq)
+                if acks:  # 本次收到的消息合并为一个确认包
+                    self.send(mb.build_ack(self.delivery_epoch, acks))
+        except (OSError, ValueError) as e:
+            logging.error(f'{self.username}: connection error {e}')
+        for future in self.pending_responses.values():
+            if not future.done():
+                future.set_exception(ConnectionError('Connection closed by server'))
+        self.writer = None
+
+    def __dispatch(self, message):
+        message_type = message.get('type')
+        if message_type == 'heartbeat':
+            return
+        if message_type == 'response':
+            future = self.pending_responses.get(message.get('timestamp'))
+            if future is not None and not future.done():
+                future.set_result(message)
+            return
+        if message.get('action') is not None:  # 服务器转发的请求（文件通知）
+            message = message['request_data']
+
+        seq = message.get('seq')
+        if seq is not None:
+            if message.get('epoch') != self.delivery_epoch:  # 服务器重启后序号重新开始
+                self.delivery_epoch = message.get('epoch')
+                self.seen_messages = {}
+            conversation = message['conversation']
+            seen = self.seen_messages.setdefault(conversation, set())
+            if seq in seen:
+                return conversation, seq  # 重复投递，只确认不再上报
+            seen.add(seq)
+            if len(seen) > 2048:  # 只保留较新的序号
+                for old_seq in sorted(seen)[:1024]:
+                    seen.discard(old_seq)
+
+        if self.on_event is not None:
+            self.on_event(self, message)
+        else:
+            self.events.put_nowait(message)
+        if seq is not None:
+            return conversation, seq
+
+    async def __heartbeat_loop(self):
+        # 首次心跳随机错开，大量客户端同时启动时不会集中发送
+        await asyncio.sleep(random.uniform(0, self.heartbeat_interval))
+        while self.writer is not None:
+            if self.username is not None:
+                self.send(mb.build_heartbeat(self.username))
+            await asyncio.sleep(self.heartbeat_interval)
+
+    # region 账户
+    async def register(self, username, password):
+        return await self.request(mb.build_register_request(username, password))
+
+    async def login(self, username, password):
+        response = await self.request(mb.build_login_request(username, password))
+        self.username = username
+        self.session_token = (response.get('data') or {}).get('session_token')
+        return response
+
+    async def resume_session(self):
+        return await self.request(mb.build_resume_session_request(self.username, self.session_token))
+
+    async def logout(self):
+        response = await self.request(mb.build_logout_request(self.username))
+        self.username = None
+        self.session_token = None
+        return response
+
+    async def delete_account(self, username, password):
+        return await self.request(mb.build_delete_account_request(username, password))
+
+    # endregion
+
+    # region 消息
+    async def send_message(self, receiver, content):
+        return await self.request(mb.build_send_personal_message_request(self.username, receiver, content))
+
+    async def send_group_message(self, group, content):
+        return await self.request(mb.build_send_group_message_request(self.username, group, content))
+
+    # endregion
+
+    # region 好友和群组
+    async def get_friends(self, version=None):
+        return (await self.request(mb.build_get_friends_request(self.username, version)))['data']
+
+    async def add_friend(self, friend):
+        return await self.request(mb.build_add_friend_request(self.username, friend))
+
+    async def remove_friend(self, friend):
+        return await self.request(mb.build_remove_friend_request(self.username, friend))
+
+    async def create_group(self, group):
+        return await self.request(mb.build_create_group_request(self.username, group))
+
+    async def join_group(self, group):
+        return await self.request(mb.build_join_group_request(self.username, group))
+
+    async def leave_group(self, group):
+        return await self.request(mb.build_leave_group_request(self.username, group))
+
+    async def get_groups(self):
+        return (await self.request(mb.build_get_groups_request(self.username)))['data']
+
+    # endregion
+
+    # region 文件
+    async def send_file(self, receiver, file_path):
+        '''
+        上传文件，上传完成后返回服务器的 accepted 响应（data 中有 ticket）；
+        接收方下载完成、离线暂存或失败时收到 file_transfer_status 事件
+        协商了文件压缩且文件可压缩时以 zlib 压缩流上传
+        '''
+        compression = None
+        if self.codec is not None and self.codec.files and Compression.is_file_compressible(file_path):
+            compression = 'zlib'
+        message = mb.build_send_file_request(
+            self.username, receiver, os.path.basename(file_path), os.path.getsize(file_path),
+            compression=compression
+        )
+        response = await self.request(message)
+        compressor = zlib.compressobj(1) if compression else None
+        _, writer = await asyncio.open_connection(self.host, self.file_port, ssl=self.ssl_context)
+        try:
+            writer.write(response['data']['ticket'].encode('ascii'))
+            with open(file_path, 'rb') as fp:
+                while True:
+                    data = fp.read(self.chunk_size)
+                    if not data:
+                        break
+                    writer.write(compressor.compress(data) if compressor else data)
+                    await writer.drain()
+            if compressor:
+                writer.write(compressor.flush())
+        finally:
+            writer.close()
+        return response
+
+    async def receive_file(self, ticket, file_path, compression=None):
+        '''
+        收到 file_transfer 事件后调用，凭事件中的 ticket 从文件端口下载到 file_path，返回字节数
+        compression 为事件中的 compression 字段，'zlib' 表示下载的是压缩流
+        '''
+        decompressor = zlib.decompressobj() if compression == 'zlib' else None
+        reader, writer = await asyncio.open_connection(self.host, self.file_port, ssl=self.ssl_context)
+        writer.write(ticket.encode('ascii'))
+        size = 0
+        with open(file_path, 'wb') as fp:
+            while True:
+                data = await reader.read(self.chunk_size)
+                if not data:
+                    break
+                if decompressor:
+                    data = decompressor.decompress(data)
+                fp.write(data)
+                size += len(data)
+            if decompressor:
+                data = decompressor.flush()
+                fp.write(data)
+                size += len(data)
+        writer.close()
+        return size
+
+    # endregion
+
+
+class ChatClient:
+    '''
+    AsyncChatClient 的同步封装，方法与 AsyncChatClient 相同，阻塞到请求完成
+    '''
+    _loop = None
+    _lock = threading.Lock()
+
+    def __init__(self, host, port, file_port=None, **kwargs):
+        self.loop = ChatClient.get_loop()
+        self.client = self.__call(self.__create(host, port, file_port, kwargs))
+
+    @staticmethod
+    def get_loop():
+        with ChatClient._lock:
+            if ChatClient._loop is None:
+                ChatClient._loop = asyncio.new_event_loop()
+                threading.Thread(target=ChatClient._loop.run_forever, name='chat-sdk', daemon=True).start()
+        return ChatClient._loop
+
+    @staticmethod
+    async def __create(host, port, file_port, kwargs):
+        return AsyncChatClient(host, port, file_port, **kwargs)
+
+    def __call(self, coroutine, timeout=None):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result(timeout)
+
+    def __getattr__(self, name):
+        if name == 'client':
+            raise AttributeError(name)
+        method = getattr(self.client, name)
+        if not asyncio.iscoroutinefunction(method):
+            return method
+
+        def call(*args, **kwargs):
+            return self.__call(method(*args, **kwargs))
+
+        return call
+
+    def next_event(self, timeout=None):
+        '''
+        取出一个服务器推送的事件，超时抛出 TimeoutError
+        '''
+        try:
+            return self.__call(self.client.next_event(timeout))
+        except asyncio.TimeoutError:
+            raise TimeoutError('No event received') from None
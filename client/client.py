@@ -1,25 +1,25 @@
 import sys
-from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QLineEdit, QPushButton, QMessageBox, QVBoxLayout, QWidget, QStackedWidget, QTextEdit, QHBoxLayout, QFileDialog, QListWidget, QInputDialog
-from PyQt5.QtCore import Qt, pyqtSignal, QThread
-import socket
+from PyQt5.QtWidgets import QApplication, QMainWindow, QLabel, QLineEdit, QPushButton, QMessageBox, QVBoxLayout, QWidget, QStackedWidget, QTextEdit, QHBoxLayout, QFileDialog, QListWidget, QInputDialog, QListView, QAbstractItemView
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QAbstractListModel, QModelIndex
+import asyncio
 import json
 import os
 import threading
 import logging
-import time
-import queue
+import random
+from collections import OrderedDict
 from datetime import datetime
 import concurrent.futures
 import configparser
+import sqlite3
 
 sys.path.append(".")
 from utils import MessageBuilder as mb
-
-global_lock = threading.Lock()
-
+from utils import Compression, FrameBuffer, Protocol, ResumableSSLContext, negotiate_compression
 
 class CurrentUser:
     username = None
+    session_token = None
 
     @staticmethod
     def set_username(username):
@@ -28,79 +28,304 @@ class CurrentUser:
     @staticmethod
     def del_username():
         CurrentUser.username = None
+        CurrentUser.session_token = None
 
     @staticmethod
     def get_username():
         return CurrentUser.username
 
+    @staticmethod
+    def set_session_token(session_token):
+        CurrentUser.session_token = session_token
 
-class ChatConnection:
+    @staticmethod
+    def get_session_token():
+        return CurrentUser.session_token
+
+
+class ChatConnection(QObject):
+    '''
+    客户端网络连接
+    所有网络读写（消息收发、心跳、文件传输）都在同一个 asyncio 事件循环线程中完成，
+    界面更新通过 Qt 信号投递到 GUI 线程，客户端线程数固定为 GUI 线程 + 网络线程
+    连接断开后由守护协程按带随机抖动的指数退避重连，重连后恢复会话，成功后重发发件箱中未送达的消息
+    '''
+    outbox_actions = ('send_personal_message', 'send_group_messager')
+    session_errors = ('Not logged in', 'Session does not belong to this user')
+    message_signal = pyqtSignal(str, str)  # (显示内容, 会话名)，群聊的会话名为 Conversation.group_key(群名)
+    presence_signal = pyqtSignal(dict)  # 好友在线状态变化
+    file_signal = pyqtSignal(str, str, str)  # (文件名, 发送者, 下载凭证)，收到文件传输通知
+    session_expired_signal = pyqtSignal(str)  # 重连后恢复会话失败，需要重新登录
 
     def __init__(self, host, port, heartbeat_interval=10, timeout=30):
+        super().__init__()
         self.host = host
         self.port = port
-        self.server_socket = None
         self.heartbeat_interval = heartbeat_interval
         self.timeout = timeout
-        self.lock = threading.Lock()
-        self.response_cache = None
         self.parent = None
+        self.reader = None
+        self.writer = None
+        self.codec = None  # 协商成功后的 FrameCodec
+        self.tasks = []
+        self.supervisor = None
+        self.connected = threading.Event()
+        config = Config()
+        self.reconnect_base_delay = config.reconnect_base_delay
+        self.reconnect_max_delay = config.reconnect_max_delay
+        # 发件箱: 已发送但服务器尚未响应的聊天消息，timestamp -> message，重连后按原顺序重发
+        self.outbox = OrderedDict()
+        self.outbox_limit = config.outbox_limit
+        # 等待响应的请求: timestamp -> Future，只保留最近的请求，避免无人读取的响应堆积
+        self.pending_responses = OrderedDict()
+        self.pending_limit = 256
+        self.lock = threading.Lock()
 
         self.friend_status_cache = None
-        self.stop_flag = False
+        # 已显示消息的序号，用于丢弃服务器重复投递的消息
+        self.delivery_epoch = None
+        self.seen_messages = {}
+
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, name='network', daemon=True).start()
 
     def start_connect(self):
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.connect((self.host, self.port))
-        listen_thread = threading.Thread(target=self.handle_server)
-        listen_thread.start()
-        threading.Thread(target=self.send_heartbeat).start()
+        '''
+        启动连接守护协程，并等待第一次连接建立
+        '''
+        if self.supervisor is None or self.supervisor.done():
+            self.connected.clear()
+            self.supervisor = asyncio.run_coroutine_threadsafe(self.__supervise(), self.loop)
+        if not self.connected.wait(self.timeout):
+            raise ConnectionError("Failed to connect to server")
+
+    async def __supervise(self):
+        attempt = 0
+        try:
+            while True:
+                try:
+                    await self.__connect()
+                except OSError as e:
+                    logging.warning(f"Failed to connect to server: {e}")
+                    self.__close()
+                except Exception:  # 例如压缩协商收到无效的回复
+                    logging.exception("Failed to connect to server")
+                    self.__close()
+                else:
+                    connected_at = self.loop.time()
+                    self.connected.set()
+                    try:
+                        await self.__read_loop()
+                    except Exception:
+                        # 任何异常都不能结束守护协程，否则客户端不再重连
+                        logging.exception("Unexpected error in connection")
+                    self.connected.clear()
+                    self.__close()
+                    if self.loop.time() - connected_at > self.heartbeat_interval:
+                        attempt = 0  # 连接保持了一段时间才重置退避，避免连上即断时频繁重连
+                # 完全随机抖动，服务器重启时所有客户端的重连时间被打散
+                delay = random.uniform(0, min(self.reconnect_max_delay, self.reconnect_base_delay * 2**attempt))
+                attempt += 1
+                logging.info(f"Reconnecting in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        finally:
+            self.connected.clear()
+            self.__close()
+
+    async def __connect(self):
+        config = Config()
+        self.reader, self.writer = await asyncio.open_connection(self.host, self.port, ssl=config.ssl_context)
+        self.codec = None
+        if config.compression_algorithms:
+            self.codec = await negotiate_compression(
+                self.reader, self.writer, config.compression_algorithms, min_size=config.compression_min_size,
+                level=config.compression_level
+            )
+        self.tasks = [asyncio.ensure_future(self.__heartbeat_loop())]
+        # 重连后使用会话令牌恢复登录状态，无需再次发送密码；响应由读取循环取回，因此在单独的任务中等待
+        username = CurrentUser.get_username()
+        session_token = CurrentUser.get_session_token()
+        if username is not None and session_token is not None:
+            self.tasks.append(asyncio.ensure_future(self.__resume_session(username, session_token)))
+
+    async def __resume_session(self, username, session_token):
+        '''
+        会话恢复成功后才重发发件箱；令牌失效（服务器更换了密钥、账户已删除）时保留发件箱，通知界面重新登录
+        '''
+        config = Config()
+        while True:
+            request = mb.build_resume_session_request(username, session_token)
+            future = concurrent.futures.Future()
+            with self.lock:
+                self.pending_responses[request['timestamp']] = future
+            self.__write(request)
+            try:
+                response = await asyncio.wait_for(asyncio.wrap_future(future), config.socket_timeout)
+            except asyncio.TimeoutError:
+                logging.warning("Resume session timed out, reconnecting")
+                if self.writer is not None:
+                    self.writer.close()
+                return
+            finally:
+                with self.lock:
+                    self.pending_responses.pop(request['timestamp'], None)
+            if response['success']:
+                self.__replay_outbox()
+                return
+            data = response.get('data')
+            if not isinstance(data, dict) or data.get('retry_after') is None:
+                break
+            await asyncio.sleep(data['retry_after'])  # 被限流或服务器过载，稍后重试
+        logging.warning(f"Failed to resume session: {response['message']}")
+        self.session_expired_signal.emit(response['message'])
+
+    def replay_outbox(self):
+        '''
+        重新登录成功后调用，可在任意线程调用
+        '''
+        self.loop.call_soon_threadsafe(self.__replay_outbox)
+
+    def __replay_outbox(self):
+        '''
+        按原顺序重发发件箱，服务器按 message_id 去重，重发已经送达的消息不会重复显示
+        会话失效后换了账户登录时，上一个账户的消息直接丢弃
+        '''
+        username = CurrentUser.get_username()
+        with self.lock:
+            for timestamp, message in list(self.outbox.items()):
+                if message['request_data'].get('sender') != username:
+                    del self.outbox[timestamp]
+            messages = list(self.outbox.values())
+        if messages:
+            logging.info(f"Replaying {len(messages)} messages from outbox")
+        for message in messages:
+            self.__write(message)
 
     def disconnect(self):
+        '''
+        主动断开（退出登录），停止重连并清空发件箱
+        '''
+        if self.supervisor is not None:
+            self.supervisor.cancel()
+            self.supervisor = None
         with self.lock:
-            if self.server_socket:
-                self.server_socket.close()
-                self.server_socket = None
+            self.outbox.clear()
 
-    def handle_server(self):
-        last_heartbeat_time = datetime.now()
-        self.server_socket.settimeout(15)
+    def __close(self):
+        writer, self.reader, self.writer = self.writer, None, None
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        if writer is not None:
+            writer.close()
+
+    async def __read_loop(self):
         config = Config()
-        default_chunk_size = config.default_chunk_size
+        frame_buffer = self.codec or FrameBuffer()
         while True:
             try:
-                if self.server_socket is None:
-                    logging.warning("Server socket not connected")
-                    break
-                json_data = self.server_socket.recv(10 * default_chunk_size).decode('utf-8')
-                message_json_list = json_data.split('!@#')
-                for message_json in message_json_list[:-1]:  #忽略最后的空包
+                data = await asyncio.wait_for(self.reader.read(10 * config.default_chunk_size), 15)
+            except asyncio.TimeoutError:
+                logging.info("Server timeout")
+                break
+            except (OSError, AttributeError) as e:
+                logging.error(f"Connection lost: {e}")
+                break
+            if not data:
+                logging.warning("Server closed the connection")
+                break
+            try:
+                frames = frame_buffer.feed(data)
+            except ValueError as e:  # 帧过大、帧损坏或压缩数据无效，之后的数据无法再解析，重新连接
+                logging.error(f"Invalid data from server: {e}")
+                break
+            acks = {}
+            for message_json in frames:
+                try:
+                    message_json = message_json.decode('utf-8')
                     logging.info(f"Received message: {message_json}")
-                    message = json.loads(message_json)
-                    last_heartbeat_time = datetime.now()
-                    message_type = message.get('type')
-                    if message_type == 'heartbeat':
-                        logging.debug("Received heartbeat from server")
-                    elif message_type == 'response':
-                        self.response_cache = message  # FIXME
-                    else:
-                        self.handle_message(message)
-            except socket.timeout:
-                logging.debug("Socket timeout")
-                if (datetime.now() - last_heartbeat_time).total_seconds() > self.timeout:
-                    logging.info("Server timeout")
-                self.disconnect()
-            except json.JSONDecodeError:
-                logging.error("Error decoding JSON message")
-            except KeyError as e:
-                logging.error(f"Missing key in message: {e}")
-            except Exception as e:
-                logging.error(str(e))
+                    ack = self.__dispatch(json.loads(message_json))
+                except json.JSONDecodeError:
+                    logging.error("Error decoding JSON message")
+                    continue
+                except KeyError as e:
+                    logging.error(f"Missing key in message: {e}")
+                    continue
+                if ack:
+                    conversation, seq = ack
+                    acks[conversation] = max(acks.get(conversation, 0), seq)
+            if acks:  # 本次收到的消息合并为一个确认包
+                self.__write(mb.build_ack(self.delivery_epoch, acks))
+
+    def __dispatch(self, message):
+        message_type = message.get('type')
+        if message_type == 'heartbeat':
+            logging.debug("Received heartbeat from server")
+        elif message_type == 'response':
+            response_data = message.get('data')
+            if isinstance(response_data, dict) and response_data.get('session_token'):
+                CurrentUser.set_session_token(response_data['session_token'])
+            timestamp = message.get('timestamp')
+            with self.lock:
+                request = self.outbox.get(timestamp)
+                future = self.pending_responses.get(timestamp)
+            if request is not None:
+                self.__settle(timestamp, request, message)
+            if future is not None and not future.done():
+                future.set_result(message)
+        else:
+            return self.handle_message(message)
 
-    def handle_message(self, message):  # TODO 收到消息后在此进行处理
+    def __settle(self, timestamp, request, response):
+        '''
+        处理发件箱中消息的响应：成功（包括服务器去重后的重复消息）才移出发件箱；
+        限流或过载时保留，retry_after 秒后重发；会话失效时保留，恢复会话或重新登录后重发；
+        其他失败（对方不存在等）移出发件箱并在对应会话中提示
+        '''
+        if response.get('success'):
+            with self.lock:
+                self.outbox.pop(timestamp, None)
+            return
+        data = response.get('data')
+        if isinstance(data, dict) and data.get('retry_after') is not None:
+            self.loop.call_later(data['retry_after'], self.__retry, timestamp)
+            return
+        if response.get('message') in self.session_errors:
+            return
+        with self.lock:
+            self.outbox.pop(timestamp, None)
+        request_data = request['request_data']
+        if 'group' in request_data:
+            target = Conversation.group_key(request_data['group'])
+        else:
+            target = request_data['receiver']
+        self.message_signal.emit(f"Failed to send message: {response.get('message')}", target)
+
+    def __retry(self, timestamp):
+        with self.lock:
+            message = self.outbox.get(timestamp)
+        if message is not None:  # 断线时不发送，重连后随发件箱一起重发
+            self.__write(message)
+
+    def handle_message(self, message):
+        '''
+        处理服务器推送的消息，需要确认的消息返回 (conversation, seq)
+        在网络线程中调用，界面更新只能通过信号完成
+        '''
         if message.get('action') is not None:  # 对数据进行拆包
             message = message['request_data']
 
+        seq = message.get('seq')
+        if seq is not None:
+            if message.get('epoch') != self.delivery_epoch:  # 服务器重启后序号重新开始
+                self.delivery_epoch = message.get('epoch')
+                self.seen_messages = {}
+            conversation = message['conversation']
+            seen = self.seen_messages.setdefault(conversation, set())
+            if seq in seen:
+                return conversation, seq  # 重复投递，只确认不再显示
+
+        displayed = False
         if message['type'] == 'personal_message':
             sender = message['sender']
             content = message['content']
@@ -108,54 +333,158 @@ class ChatConnection:
             timestamp_datetime = datetime.fromtimestamp(timestamp)
             formatted_timestamp = timestamp_datetime.strftime("%m-%d %H:%M")
             string = f"[{formatted_timestamp}]{sender}->You:\n{content}"
-            self.parent.chat_page.display_message(string, sender)
+            self.message_signal.emit(string, sender)
+            displayed = True
 
-        if message.get('type') == 'file_transfer':  # TODO 处理文件传输头
-            self.parent.chat_page.receive_file(message.get('file_name'), message.get('sender'))
-            pass
+        if message['type'] == 'group_message':
+            timestamp_datetime = datetime.fromtimestamp(message['timestamp'])
+            formatted_timestamp = timestamp_datetime.strftime("%m-%d %H:%M")
+            string = f"[{formatted_timestamp}]{message['sender']}@{message['group']}:\n{message['content']}"
+            self.message_signal.emit(string, Conversation.group_key(message['group']))
+            displayed = True
+
+        if message['type'] == 'presence':  # 服务器推送的好友在线状态变化
+            self.presence_signal.emit(message['changes'])
+
+        if message.get('type') == 'file_transfer':
+            self.file_signal.emit(message.get('file_name'), message.get('sender'), message.get('ticket'))
+
+        if message.get('type') == 'file_transfer_status':  # 自己发送的文件的传输结果
+            file_name = message['file_name']
+            receiver = message['receiver']
+            if message['status'] == 'delivered':
+                self.message_signal.emit(f"File {file_name} received by {receiver}.", receiver)
+            elif message['status'] == 'queued':
+                self.message_signal.emit(f"{receiver} is offline, {file_name} will be sent later.", receiver)
+            else:
+                self.message_signal.emit(f"Failed to send file {file_name}.", receiver)
+
+        if seq is not None and displayed:
+            seen.add(seq)
+            if len(seen) > 2048:  # 只保留较新的序号
+                for old_seq in sorted(seen)[:1024]:
+                    seen.discard(old_seq)
+            return conversation, seq
 
     def send_message(self, message):
-        if not self.server_socket:
-            self.start_connect()
-        with self.lock:
+        '''
+        可在任意线程调用；请求消息会登记等待响应，由 get_response 取回
+        聊天消息先放入发件箱，断线期间发送的消息在重连后自动补发
+        '''
+        if self.supervisor is None:
             try:
-                if not self.server_socket:
-                    logging.error("Server socket not connected")
-                    return
-                message_json = json.dumps(message)
-                logging.info(f"Sending message: {message_json}")
-                message_json = message_json + '!@#'
-                self.server_socket.send(message_json.encode('utf-8'))
-                # message_bytes = pickle.dumps(message)
-                # self.server_socket.send(len(message_bytes).to_bytes(4, byteorder='big'))
-                # self.server_socket.send(message_bytes)
-            except Exception as e:
+                self.start_connect()
+            except ConnectionError as e:
                 logging.error(str(e))
+        if message.get('type') == 'request':
+            with self.lock:
+                self.pending_responses[message['timestamp']] = concurrent.futures.Future()
+                if len(self.pending_responses) > self.pending_limit:
+                    self.pending_responses.popitem(last=False)
+                if message.get('action') in self.outbox_actions:
+                    self.outbox[message['timestamp']] = message
+                    if len(self.outbox) > self.outbox_limit:
+                        self.outbox.popitem(last=False)
+                        logging.warning("Outbox is full, dropped the oldest message")
+        self.loop.call_soon_threadsafe(self.__write, message)
+
+    def __write(self, message):
+        if self.writer is None:
+            logging.warning("Server not connected, message not sent")
+            return
+        data = Protocol.encode(message)
+        logging.info(f"Sending message: {data}")
+        self.writer.write(self.codec.encode(data) if self.codec is not None else data)
 
-    def send_heartbeat(self):
-        while self.server_socket is not None:
-            try:
-                if self.server_socket is None: break
-                username = CurrentUser.get_username()
-                if username is not None:
-                    message = mb.build_heartbeat(username)
-                    self.send_message(message)
-            except Exception as e:
-                logging.error(f"Error sending heartbeat:{str(e)}")
-            time.sleep(self.heartbeat_interval)
-
-    def get_response(self, request_timestamp, timelimit=5):  # FIXME
-        start_time = time.time()
+    async def __heartbeat_loop(self):
         while True:
-            time.sleep(0.2)
-            if self.response_cache is None: continue
-            if self.response_cache['timestamp'] == request_timestamp: return self.response_cache
-            if (time.time() - start_time > timelimit): break
-        return False
+            username = CurrentUser.get_username()
+            if username is not None:
+                self.__write(mb.build_heartbeat(username))
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def get_response(self, request_timestamp, timelimit=5):
+        with self.lock:
+            future = self.pending_responses.get(request_timestamp)
+        if future is None:
+            return False
+        try:
+            return future.result(timelimit)
+        except concurrent.futures.TimeoutError:
+            return False
+        finally:
+            with self.lock:
+                self.pending_responses.pop(request_timestamp, None)
+
+    # region 文件传输
+    def send_file(self, file_path, message, target):
+        self.send_message(message)
+        with self.lock:
+            response = self.pending_responses.get(message['timestamp'])
+        asyncio.run_coroutine_threadsafe(self.__send_file(file_path, target, message['timestamp'], response), self.loop)
+
+    def receive_file(self, file_path, target, ticket):
+        asyncio.run_coroutine_threadsafe(self.__receive_file(file_path, target, ticket), self.loop)
+
+    async def __send_file(self, file_path, target, request_timestamp, response):
+        '''
+        服务器立即返回上传凭证，连接文件端口后先发送凭证再上传，接收结果由 file_transfer_status 推送
+        '''
+        config = Config()
+        file_name = os.path.basename(file_path)
+        try:
+            response = await asyncio.wait_for(asyncio.wrap_future(response), config.socket_timeout)
+        except asyncio.TimeoutError:
+            response = None
+        finally:
+            with self.lock:
+                self.pending_responses.pop(request_timestamp, None)
+        if not response or not response['success']:
+            self.message_signal.emit(f"Failed to send file {file_name}.", target)
+            return
+        try:
+            _, writer = await asyncio.open_connection(config.host, config.file_transfer_port, ssl=config.ssl_context)
+            writer.write(response['data']['ticket'].encode('ascii'))
+            with open(file_path, 'rb') as fp:
+                while True:
+                    data = fp.read(config.default_chunk_size)
+                    if not data:
+                        break
+                    writer.write(data)
+                    await writer.drain()  # 让出事件循环，传输期间照常收发消息
+            writer.close()
+        except OSError as e:
+            logging.error(f"Error sending file {file_name}: {e}")
+            self.message_signal.emit(f"Failed to send file {file_name}.", target)
+            return
+        self.message_signal.emit(f"File {file_name} uploaded.", target)
+
+    async def __receive_file(self, file_path, target, ticket):
+        config = Config()
+        file_name = os.path.basename(file_path)
+        try:
+            reader, writer = await asyncio.open_connection(
+                config.host, config.file_transfer_port, ssl=config.ssl_context
+            )
+            writer.write(ticket.encode('ascii'))
+            with open(file_path, 'wb') as fp:
+                while True:
+                    data = await reader.read(config.default_chunk_size)
+                    if not data:
+                        break
+                    fp.write(data)
+            writer.close()
+        except OSError as e:
+            logging.error(f"Error receiving file {file_name}: {e}")
+            self.message_signal.emit(f"Failed to receive file {file_name}.", target)
+            return
+        self.message_signal.emit(f"File {file_name} received successfully.", target)
+
+    # endregion
 
 
 class ChatClient(QMainWindow):
-    response_signal = pyqtSignal(dict)  # MARK 未使用该信号量
+    response_signal = pyqtSignal(dict)
 
     def __init__(self, host, port):
         super().__init__()
@@ -227,9 +556,7 @@ class ChatClient(QMainWindow):
         return response['success']
 
     def get_response(self, request_timestamp):
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(self.connection.get_response, request_timestamp)
-            return future.result()
+        return self.connection.get_response(request_timestamp)
 
 
 class MainPage(QWidget):
@@ -331,7 +658,9 @@ class LoginPage(QWidget):
         response = self.parent.get_response(timestamp)
         if self.parent.show_response(response):
             CurrentUser.set_username(username)
+            self.parent.connection.replay_outbox()  # 会话失效期间未送达的消息
             self.parent.show_chat_page()
+            self.parent.chat_page.refresh_friend_list()
 
 
 class DeletePage(QWidget):
@@ -379,10 +708,167 @@ class DeletePage(QWidget):
                 self.parent.show_main_page()
 
 
-class FileTransferThread(QThread):
-    finished = pyqtSignal()
+class MessageStore:
+    '''
+    本地消息记录（client/history.db），会话在内存中只保留最近的消息，更早的消息按页从这里读取
+    只在 GUI 线程中使用
+    '''
+
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        # 每条消息一次 commit，WAL 下不需要每次都刷盘
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('PRAGMA synchronous=NORMAL')
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS messages ('
+            'id INTEGER PRIMARY KEY AUTOINCREMENT, owner TEXT NOT NULL, conversation TEXT NOT NULL, content TEXT NOT NULL)'
+        )
+        self.conn.execute('CREATE INDEX IF NOT EXISTS messages_conversation ON messages (owner, conversation, id)')
+        self.conn.commit()
 
-    pass
+    def append(self, owner, conversation, content):
+        '''
+        返回消息的 id
+        '''
+        cursor = self.conn.execute(
+            'INSERT INTO messages (owner, conversation, content) VALUES (?, ?, ?)', (owner, conversation, content)
+        )
+        self.conn.commit()
+        return cursor.lastrowid
+
+    def page(self, owner, conversation, before_id, limit):
+        '''
+        返回 id 小于 before_id（为 None 时不限）的最近 limit 条消息 [(id, content)]，按时间顺序
+        '''
+        if before_id is None:
+            before_id = sys.maxsize
+        rows = self.conn.execute(
+            'SELECT id, content FROM messages WHERE owner = ? AND conversation = ? AND id < ? ORDER BY id DESC LIMIT ?',
+            (owner, conversation, before_id, limit)
+        ).fetchall()
+        rows.reverse()
+        return rows
+
+    def close(self):
+        self.conn.close()
+
+
+class Conversation:
+    '''
+    会话状态（消息记录、在线状态、未发送的草稿），不依赖任何界面组件
+    设置了 store 时消息同时写入本地记录，内存中只保留最近 max_history 条，更早的消息用 load_older 读回
+    kind 为 friend（私聊）或 group（群聊）；群聊会话的 name 为 group_key(群名)，与同名的好友区分，target 为群名
+    '''
+    max_history = 200  # 每个会话在内存中保留的消息条数
+    group_prefix = 'group:'
+
+    def __init__(self, name, status='offline', store=None, owner=None, kind='friend'):
+        self.name = name
+        self.kind = kind
+        self.target = name[len(self.group_prefix):] if kind == 'group' else name  # 发送消息的对象
+        self.status = status
+        self.messages = []
+        self.ids = []  # 与 messages 对应的本地记录 id
+        self.draft = ''
+        self.store = store
+        self.owner = owner
+
+    @classmethod
+    def group_key(cls, group):
+        return cls.group_prefix + group
+
+    def append(self, message):
+        '''
+        追加一条消息，超出上限时丢弃最早的消息并返回 True
+        '''
+        self.messages.append(message)
+        self.ids.append(self.store.append(self.owner, self.name, message) if self.store else None)
+        if len(self.messages) > self.max_history:
+            del self.messages[0]
+            del self.ids[0]
+            return True
+        return False
+
+    def load_older(self, count):
+        '''
+        从本地记录读取最多 count 条更早的消息放到最前面，返回读取的条数
+        '''
+        if self.store is None:
+            return 0
+        rows = self.store.page(self.owner, self.name, self.ids[0] if self.ids else None, count)
+        self.messages[:0] = [content for _, content in rows]
+        self.ids[:0] = [message_id for message_id, _ in rows]
+        return len(rows)
+
+    def shrink(self):
+        '''
+        不再显示时丢弃滚动加载的旧消息，只保留最近 max_history 条
+        '''
+        excess = len(self.messages) - self.max_history
+        if excess > 0:
+            del self.messages[:excess]
+            del self.ids[:excess]
+
+
+class MessageListModel(QAbstractListModel):
+    '''
+    当前会话的消息列表模型
+    只向视图暴露最近的 loaded 条消息，滚动到顶部时再按页加载更早的消息，内存中的消息用完后从本地记录读取
+    '''
+    page_size = 100
+
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.conversation = None
+        self.loaded = 0
+
+    def set_conversation(self, conversation):
+        self.beginResetModel()
+        if self.conversation is not None and self.conversation is not conversation:
+            self.conversation.shrink()
+        self.conversation = conversation
+        # 内存中不足一页时（刚登录、只收到几条新消息）先从本地记录补足，否则视图没有滚动条，无法加载更早的消息
+        if len(conversation.messages) < self.page_size:
+            conversation.load_older(self.page_size - len(conversation.messages))
+        self.loaded = min(self.page_size, len(conversation.messages))
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else self.loaded
+
+    def data(self, index, role=Qt.DisplayRole):
+        if role != Qt.DisplayRole or not index.isValid():
+            return None
+        messages = self.conversation.messages
+        return messages[len(messages) - self.loaded + index.row()]
+
+    def message_appended(self, trimmed):
+        '''
+        会话追加消息后调用，trimmed 表示同时丢弃了最早的一条消息
+        '''
+        if trimmed and self.loaded == len(self.conversation.messages):
+            self.beginRemoveRows(QModelIndex(), 0, 0)
+            self.loaded -= 1
+            self.endRemoveRows()
+        self.beginInsertRows(QModelIndex(), self.loaded, self.loaded)
+        self.loaded += 1
+        self.endInsertRows()
+
+    def load_older(self):
+        '''
+        加载更早的一页消息，返回新增的行数
+        '''
+        if self.conversation is None:
+            return 0
+        count = min(self.page_size, len(self.conversation.messages) - self.loaded)
+        if count <= 0:
+            count = self.conversation.load_older(self.page_size)
+        if count <= 0:
+            return 0
+        self.beginInsertRows(QModelIndex(), 0, count - 1)
+        self.loaded += count
+        self.endInsertRows()
+        return count
 
 
 class ChatPage(QWidget):
@@ -394,129 +880,138 @@ class ChatPage(QWidget):
         self.setMinimumSize(900, 800)
 
         self.current_friend = None
-        self.chat_pages = QStackedWidget()
+        self.friend_list_version = None
+        # 会话名 -> Conversation；所有会话共用同一个消息视图和编辑框
+        self.conversations = {'None': Conversation('None')}
+        self.message_store = MessageStore(os.path.join(os.path.dirname(__file__), 'history.db'))
         self.friend_list = QListWidget()
+        self.message_model = MessageListModel(self)
+        # 网络线程收到的推送通过信号在 GUI 线程中处理
+        connection = parent.connection
+        connection.message_signal.connect(self.show_incoming_message)
+        connection.presence_signal.connect(self.update_presence)
+        connection.file_signal.connect(self.receive_file)
+        connection.session_expired_signal.connect(self.session_expired)
         self.init_UI()
 
-        # threading.Thread(target=self.__update_friend_status, daemon=True).start()
-
     def init_UI(self):
         layout = QHBoxLayout(self)
 
         V_layout = QVBoxLayout()
         update_friends_list_button = QPushButton("Update List")
-        update_friends_list_button.clicked.connect(self.__update_friend_status)
+        update_friends_list_button.clicked.connect(self.refresh_friend_list)
         update_friends_list_button.setFixedWidth(150)
         update_friends_list_button.setStyleSheet("QPushButton{text-align:left;}")
         V_layout.addWidget(update_friends_list_button)
         V_layout.addWidget(self.friend_list)
         layout.addLayout(V_layout)
-        friend_list = ['None']
-        self.friend_list.addItems(friend_list)
+        self.friend_list.addItem('None')
         self.friend_list.setFixedWidth(150)
         self.friend_list.itemClicked.connect(self.__change_selected_friend)
-        # layout.addWidget(self.friend_list)
-
-        for friend in friend_list:
-            chat = self.__chatpage_factory(friend)
-            if chat is not None:
-                self.chat_pages.addWidget(chat)
-        layout.addWidget(self.chat_pages)
-
-        self.setLayout(layout)
-        self.setWindowTitle("Chat Page")
-
-        pass
-
-    def __change_selected_friend(self, item):
-        '''
-        更改当前好友选择
-        '''
-        friend_name = item.text()
-        self.current_friend = friend_name
-        self.chat_pages.setCurrentWidget(self.chat_pages.findChild(QWidget, friend_name))
-
-    def __chatpage_factory(self, friend_name: str):
-        '''
-        根据名字生成聊天界面
-        '''
-        chat = QWidget()  # 当前好友聊天界面
-        chat.setObjectName(friend_name)
 
         min_width = 400
         min_height = 180
 
-        layout = QVBoxLayout()
+        chat_layout = QVBoxLayout()
 
         # 当前好友状态显示
-        chat.setProperty('status', 'offline')
-        status_label = QLabel(f'{friend_name}状态:' + chat.property('status'))
-        status_label.setObjectName('StatusLabel')
-        status_label.setAlignment(Qt.AlignCenter)
-        layout.addWidget(status_label)
-
-        # 聊天消息显示
-        message_displayer = QTextEdit()
-        message_displayer.setReadOnly(True)
-        message_displayer.setObjectName('MessageDisplayer')
-        message_displayer.setMinimumWidth(min_width)
-        message_displayer.setMinimumHeight(min_height)
-        layout.addWidget(message_displayer)
+        self.status_label = QLabel()
+        self.status_label.setAlignment(Qt.AlignCenter)
+        chat_layout.addWidget(self.status_label)
+
+        # 聊天消息显示，只为可见的消息创建绘制项
+        self.message_view = QListView()
+        self.message_view.setModel(self.message_model)
+        self.message_view.setWordWrap(True)
+        self.message_view.setSpacing(4)
+        self.message_view.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)
+        self.message_view.setLayoutMode(QListView.Batched)
+        self.message_view.setSelectionMode(QAbstractItemView.NoSelection)
+        self.message_view.setMinimumWidth(min_width)
+        self.message_view.setMinimumHeight(min_height)
+        self.message_view.verticalScrollBar().valueChanged.connect(self.__load_older_messages)
+        chat_layout.addWidget(self.message_view)
 
         # 发送消息编辑框
-        message_editor = QTextEdit()
-        message_editor.setObjectName('MessageEditor')
-        message_editor.setMinimumWidth(min_width)
-        message_editor.setMinimumHeight(min_height)
-        layout.addWidget(message_editor)
+        self.message_editor = QTextEdit()
+        self.message_editor.setMinimumWidth(min_width)
+        self.message_editor.setMinimumHeight(min_height)
+        chat_layout.addWidget(self.message_editor)
 
         button_layout = QHBoxLayout()
         # 发送消息按钮
         send_message_button = QPushButton("Send Message")
-        send_message_button.setObjectName('SendMessageButton')
         send_message_button.clicked.connect(self.send_message)
-        # send_message_button.setFixedSize(200, 30)
         button_layout.addWidget(send_message_button)
         # 发送文件按钮
         send_file_button = QPushButton("Send File")
-        send_file_button.setObjectName('SendFileButton')
         send_file_button.clicked.connect(self.send_file)
-        # send_file_button.setFixedSize(200, 30)
         button_layout.addWidget(send_file_button)
+        chat_layout.addLayout(button_layout)
 
-        layout.addLayout(button_layout)
-
-        del button_layout
         button_layout = QHBoxLayout()
         # 添加好友按钮
         add_friend_button = QPushButton("Add Friend")
-        add_friend_button.setObjectName('AddFriendButton')
         add_friend_button.clicked.connect(self.add_friend)
         button_layout.addWidget(add_friend_button)
         # 删除好友按钮
         delete_friend_button = QPushButton("Delete Friend")
-        delete_friend_button.setObjectName('DeleteFriendButton')
         delete_friend_button.clicked.connect(self.remove_friend)
         button_layout.addWidget(delete_friend_button)
+        chat_layout.addLayout(button_layout)
 
-        layout.addLayout(button_layout)
         # 返回主界面按钮
         back_button = QPushButton("Back")
-        back_button.setObjectName('BackButton')
         back_button.clicked.connect(self.__log_out)
-        layout.addWidget(back_button)
+        chat_layout.addWidget(back_button)
+
+        layout.addLayout(chat_layout)
 
-        chat.setLayout(layout)
+        self.setLayout(layout)
+        self.setWindowTitle("Chat Page")
+        self.__show_conversation(self.conversations['None'])
+
+    def __change_selected_friend(self, item):
+        '''
+        更改当前好友选择
+        '''
+        self.open_conversation(item.text())
 
-        return chat
+    def open_conversation(self, friend_name):
+        conversation = self.conversations.get(friend_name)
+        if conversation is None:
+            return
+        previous = self.conversations.get(self.current_friend)
+        if previous is not None:
+            previous.draft = self.message_editor.toPlainText()  # 切换会话时保留未发送的内容
+        self.current_friend = friend_name
+        self.__show_conversation(conversation)
+        self.message_editor.setPlainText(conversation.draft)
+        for item in self.friend_list.findItems(friend_name, Qt.MatchExactly):
+            self.friend_list.setCurrentItem(item)
+
+    def __show_conversation(self, conversation):
+        self.message_model.set_conversation(conversation)
+        self.status_label.setText(f'{conversation.name}状态:{conversation.status}')
+        self.message_view.scrollToBottom()
+
+    def __load_older_messages(self, value):
+        if value != self.message_view.verticalScrollBar().minimum():
+            return
+        count = self.message_model.load_older()
+        if count:  # 保持当前看到的消息位置不变
+            self.message_view.scrollTo(self.message_model.index(count), QAbstractItemView.PositionAtTop)
 
-    def __update_friend_status(self):
-        # while True:
-        update_friend_list_request = mb.build_get_friends_request(CurrentUser.get_username())
+    def refresh_friend_list(self):
+        '''
+        按版本号同步好友列表，仅在登录后和手动刷新时调用，之后的状态变化由服务器推送
+        '''
+        update_friend_list_request = mb.build_get_friends_request(
+            CurrentUser.get_username(), self.friend_list_version
+        )
         self.parent.connection.send_message(update_friend_list_request)
         response = self.parent.get_response(update_friend_list_request['timestamp'])
         if response is None or not response:
-            # continue
             return
 
         if isinstance(response, bool):
@@ -524,46 +1019,79 @@ class ChatPage(QWidget):
 
         if response['success']:
 
-            friend_list = response['data']
-            if friend_list is None:
-                # continue
+            sync_data = response['data']
+            if sync_data is None:
                 return
 
-            for index in range(self.friend_list.count()):  # 遍历好友列表，删除好友
-                item = self.friend_list.item(index)
-                username = item.text()
-
-                status = friend_list.get(username)
-                if status == None:
-                    # 好友已经被删除
-                    if username != 'None':
-                        self.handle_delete_friend(username)
-
-                else:
-                    chat = self.chat_pages.findChild(QWidget, username)
-                    chat.setProperty('status', status)
-                    status_label = chat.findChild(QLabel, 'StatusLabel')
-                    status_label.setText(f'{username}状态:{status}')
-
-            for key, value in friend_list.items():
-                if self.friend_list.findItems(key, Qt.MatchExactly):  # 好友列表存在该好友
-                    continue
+            self.friend_list_version = sync_data.get('version')
+            if 'friends' in sync_data:  # 全量同步
+                self.__apply_friend_list(sync_data['friends'])
+                return
 
-                chat = self.__chatpage_factory(key)
-                chat.setProperty('status', value)
-                label = chat.findChild(QLabel, 'StatusLabel')
-                label.setText(f'{key}状态:{value}')
+            for username in sync_data.get('removed', []):
+                if username in self.conversations:
+                    self.handle_delete_friend(username)
+            for username in sync_data.get('added', {}):
+                self.handle_add_friend(username)
+            self.update_presence(sync_data.get('added', {}))
 
-                self.friend_list.addItem(key)
-                self.chat_pages.addWidget(chat)
+            online = set(sync_data.get('online', []))
+            self.update_presence(
+                {username: username in online for username in self.__friends()}
+            )
 
-            # time.sleep(10)
+    def __apply_friend_list(self, friend_list):
+        for username in self.__friends():  # 遍历好友列表，删除好友
+            status = friend_list.get(username)
+            if status == None:
+                # 好友已经被删除
+                self.handle_delete_friend(username)
+            else:
+                self.update_presence({username: status})
+
+        for key, value in friend_list.items():
+            self.handle_add_friend(key, value)
+
+    def __friends(self):
+        return [
+            name for name, conversation in self.conversations.items()
+            if name != 'None' and conversation.kind == 'friend'
+        ]
+
+    def update_presence(self, changes):
+        for username, status in changes.items():
+            conversation = self.conversations.get(username)
+            if conversation is None or conversation.kind != 'friend':
+                continue
+            conversation.status = status
+            if username == self.current_friend:
+                self.status_label.setText(f'{username}状态:{status}')
 
     def __log_out(self):
         self.parent.connection.send_message(mb.build_logout_request(CurrentUser.get_username()))
         self.parent.connection.disconnect()
+        self.__reset()
         self.parent.show_main_page()
-        pass
+
+    def session_expired(self, reason):
+        '''
+        重连后无法恢复会话：连接和发件箱保留，重新登录后补发
+        '''
+        if CurrentUser.get_username() is None:
+            return
+        self.__reset()
+        QMessageBox.warning(self, "Session expired", f"{reason}, please log in again.")
+        self.parent.show_login_page()
+
+    def __reset(self):
+        CurrentUser.del_username()
+        self.friend_list_version = None
+        # 清除上一个账户的会话
+        self.current_friend = None
+        self.conversations = {'None': Conversation('None')}
+        self.friend_list.clear()
+        self.friend_list.addItem('None')
+        self.__show_conversation(self.conversations['None'])
 
     def add_friend(self, friend_name):
         user_name, status = QInputDialog.getText(self, "Add Friend", "Enter the username of the friend:")
@@ -575,13 +1103,11 @@ class ChatPage(QWidget):
 
         timestamp = add_friend_request['timestamp']
         response = self.parent.get_response(timestamp)  # 单向添加好友
-        if response is None or not response['success']:
+        if response is None or not response or not response['success']:
             QMessageBox.critical(self, "Error", "Failed to add friend.")
             return
 
-        chat = self.__chatpage_factory(user_name)
-        self.friend_list.addItem(user_name)
-        self.chat_pages.addWidget(chat)
+        self.handle_add_friend(user_name)
 
     def remove_friend(self, friend_name):
         user_name, status = QInputDialog.getText(self, "Delete Friend", "Enter the username of the friend:")
@@ -605,67 +1131,81 @@ class ChatPage(QWidget):
 
         self.handle_delete_friend(user_name)
 
-    def handle_add_friend(self, user_name):
-        for i in range(self.friend_list.count()):  # 遍历好友列表
-            if self.friend_list.item(i).text() == user_name:
-                return
+    def handle_add_friend(self, user_name, status='offline'):
+        if user_name in self.conversations:
+            return
 
-        chat = self.__chatpage_factory(user_name)
+        self.conversations[user_name] = Conversation(user_name, status, self.message_store, CurrentUser.get_username())
         self.friend_list.addItem(user_name)
-        self.chat_pages.addWidget(chat)
 
-    def handle_delete_friend(self, user_name):
+    def handle_add_group(self, key):
+        if key in self.conversations:
+            return
 
-        index = self.chat_pages.findChild(QWidget, user_name)
-        self.chat_pages.removeWidget(index)
-        index.deleteLater()
+        self.conversations[key] = Conversation(key, 'group', self.message_store, CurrentUser.get_username(), 'group')
+        self.friend_list.addItem(key)
 
-        index = self.friend_list.findItems(user_name, Qt.MatchExactly)
-        for item in index:
+    def handle_delete_friend(self, user_name):
+        if self.conversations.pop(user_name, None) is None:
+            return
+
+        for item in self.friend_list.findItems(user_name, Qt.MatchExactly):
             self.friend_list.takeItem(self.friend_list.row(item))
 
         if user_name == self.current_friend:
-            page = self.friend_list.findItems("None", Qt.MatchExactly)
-            self.__change_selected_friend(page[0])
+            self.current_friend = None
+            self.open_conversation('None')
 
     def send_message(self):
         if self.current_friend is None:
             QMessageBox.critical(self, "Error", "Please select a friend to send message.")
             return
 
-        editor = self.chat_pages.currentWidget().findChild(QTextEdit, 'MessageEditor')
-        displayer = self.chat_pages.currentWidget().findChild(QTextEdit, 'MessageDisplayer')
         friend_name = self.current_friend
+        conversation = self.conversations[friend_name]
 
-        message = editor.toPlainText()
+        message = self.message_editor.toPlainText()
         if message == '':
             return
 
-        if self.current_friend == 'None':
-            self.display_message(message, friend_name)
-            return
-
-        message_packet = mb.build_send_personal_message_request(
-            CurrentUser.get_username(), friend_name, message
-        )
-        self.parent.connection.send_message(message_packet)
+        if conversation.kind == 'group':
+            message_packet = mb.build_send_group_message_request(
+                CurrentUser.get_username(), conversation.target, message
+            )
+            self.parent.connection.send_message(message_packet)
+        elif friend_name != 'None':
+            message_packet = mb.build_send_personal_message_request(
+                CurrentUser.get_username(), friend_name, message
+            )
+            self.parent.connection.send_message(message_packet)
         self.display_message(message, friend_name)
 
-        editor.clear()  # 清空编辑框
-
-    def display_message(self, message, target=None):
-        chat = self.chat_pages.findChild(QWidget, target)
-        if chat is None:
-            return
-
-        displayer = chat.findChild(QTextEdit, 'MessageDisplayer')
-        displayer.append(message + '\n')
-        displayer.moveCursor(displayer.textCursor().End)
+        self.message_editor.clear()  # 清空编辑框
 
-        # self.__update_friend_status()
+    def show_incoming_message(self, message, target):
+        # 还没有会话的对象先创建会话，避免消息丢失
+        if target.startswith(Conversation.group_prefix):
+            self.handle_add_group(target)
+        elif target not in self.conversations:
+            self.handle_add_friend(target)
+        self.display_message(message, target)
 
-    def send_file(self):  # TODO 使用QThread发送、接收文件，完毕后弹窗
-        if self.current_friend is None:
+    def display_message(self, message, target=None):
+        conversation = self.conversations.get(target)
+        if conversation is None:
+            return False
+
+        trimmed = conversation.append(message)
+        if conversation is self.message_model.conversation:
+            scroll_bar = self.message_view.verticalScrollBar()
+            at_bottom = scroll_bar.value() == scroll_bar.maximum()
+            self.message_model.message_appended(trimmed)
+            if at_bottom:  # 只有停留在底部时才跟随新消息滚动
+                self.message_view.scrollToBottom()
+        return True
+
+    def send_file(self):
+        if self.current_friend is None or self.conversations[self.current_friend].kind != 'friend':
             QMessageBox.critical(self, "Error", "Please select a friend to send file.")
             return
 
@@ -679,42 +1219,16 @@ class ChatPage(QWidget):
         file_size = os.path.getsize(file_path)
 
         message = mb.build_send_file_request(sender, receiver, file_name, file_size)
-        self.parent.connection.send_message(message)
-        time.sleep(1)
-
-        self.display_message(f"Start sending file: {file_name}.", self.current_friend)
-        threading.Thread(target=self.__send_file_subthread, args=(file_path, )).start()
+        self.display_message(f"Start sending file: {file_name}.", receiver)
+        self.parent.connection.send_file(file_path, message, receiver)
 
-    def __send_file_subthread(self, file_path):
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((config.host, config.file_transfer_port))
-        with open(file_path, 'rb') as fp:
-            while True:
-                data = fp.read(config.default_chunk_size)
-                if not data:
-                    break
-                client_socket.send(data)
-        client_socket.close()
-        self.display_message(f"File {os.path.basename(file_path)} sent successfully.", self.current_friend)
-
-    def receive_file(self, file_name, sender):
-        self.__change_selected_friend(self.friend_list.findItems(sender, Qt.MatchExactly)[0])
+    def receive_file(self, file_name, sender, ticket):
+        self.handle_add_friend(sender)
+        self.open_conversation(sender)
 
         self.display_message(f"{sender} sent you a file: {file_name}.", sender)
-        threading.Thread(target=self.__recv_file_subthread, args=(file_name, sender)).start()
-
-    def __recv_file_subthread(self, file_name, sender):
-        client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        client_socket.connect((config.host, config.file_transfer_port))
-        file_path = os.path.dirname(__file__)
-        with open(file_path + '/' + file_name, 'wb') as fp:
-            while True:
-                data = client_socket.recv(config.default_chunk_size)  # MARK 是否同样需要设置较大的缓冲区
-                if not data:
-                    break
-                fp.write(data)
-        client_socket.close()
-        self.display_message(f"File {file_name} received successfully.", sender)
+        file_path = os.path.join(os.path.dirname(__file__), file_name)
+        self.parent.connection.receive_file(file_path, sender, ticket)
 
 
 class Config():
@@ -742,8 +1256,23 @@ class Config():
             self.file_transfer_port = int(self.config['Remote']['file_transfer_port'])
         self.heartbeat_timeout = int(self.config['Server']['heartbeat_timeout'])
         self.socket_timeout = int(self.config['Server']['socket_timeout'])
-        self.file_transfer_interval = float(self.config['Server']['file_transfer_interval'])
         self.default_chunk_size = int(self.config['Server']['default_chunk_size'])
+        self.reconnect_base_delay = float(self.config['Client']['reconnect_base_delay'])
+        self.reconnect_max_delay = float(self.config['Client']['reconnect_max_delay'])
+        self.outbox_limit = int(self.config['Client']['outbox_limit'])
+        # 客户端不启用文件传输压缩，只协商消息帧压缩
+        self.compression_algorithms = []
+        if self.config['Compression']['enabled'] == 'True':
+            self.compression_algorithms = [
+                algorithm for algorithm in self.config['Compression']['algorithms'].split(',')
+                if algorithm in Compression.available()
+            ]
+        self.compression_min_size = int(self.config['Compression']['min_size'])
+        self.compression_level = int(self.config['Compression']['level'])
+        # 消息连接和文件连接共用一个上下文，重连和文件传输复用 TLS 会话
+        self.ssl_context = None
+        if self.config['TLS']['enabled'] == 'True':
+            self.ssl_context = ResumableSSLContext.create(self.config['TLS']['ca_file'])
 
 
 def config_logging(level=logging.DEBUG, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'):
@@ -798,6 +1327,3 @@ if __name__ == '__main__':
     if os.environ.get('DEBUG') == 'True':
         debug_func(client)
     sys.exit(app.exec_())
-
-# TODO
-# Chat_Connection类中不使用response_cache，而是收到response时直接调用Client相关函数进行处理
@@ -0,0 +1,107 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+HELP = '''Commands:
+  profile sample <seconds> [interval]   sample all thread stacks, write collapsed stacks for flame graphs
+  profile cprofile <seconds>            cProfile request handlers across all connection threads
+  profile stop                          end the running profiling session early
+  tracemalloc snapshot [frames]         start tracemalloc, or snapshot and diff with the previous snapshot
+  tracemalloc stop
+  trace on|off [users=a,b] [actions=x,y] [rate=0.01]   change message tracing sampling
+  capture start [path]                  record anonymized inbound frames for tool/replay.py
+  capture stop
+  help'''
+
+
+class AdminServer:
+    '''
+    本机管理通道（Unix socket，仅所有者可访问）
+    每个连接发送一行命令，服务器执行后返回文本结果并关闭连接，见 tool/admin.py
+    '''
+
+    def __init__(self, path, profiler, tracer, message_server):
+        self.path = path
+        self.profiler = profiler
+        self.tracer = tracer
+        self.message_server = message_server
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)  # 上次运行遗留的 socket 文件
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.bind(self.path)
+        os.chmod(self.path, 0o600)
+        self.socket.listen(4)
+        threading.Thread(target=self.__accept_loop, name='admin', daemon=True).start()
+        logging.info(f'Admin control socket on {self.path}')
+
+    def __accept_loop(self):
+        while True:
+            connection, _ = self.socket.accept()
+            threading.Thread(target=self.__handle, args=(connection, ), daemon=True).start()
+
+    def __handle(self, connection):
+        with connection:
+            data = b''
+            while not data.endswith(b'\n'):
+                chunk = connection.recv(1024)
+                if not chunk:
+                    break
+                data += chunk
+            command = data.decode('utf-8').split()
+            logging.info(f'Admin command: {" ".join(command)}')
+            try:
+                reply = self.execute(command)
+            except (ValueError, OSError) as e:
+                reply = f'Error: {e}'
+            connection.sendall(reply.encode('utf-8') + b'\n')
+
+    def execute(self, command):
+        match command:
+            case ['profile', 'sample', seconds]:
+                return self.profiler.sample(float(seconds))
+            case ['profile', 'sample', seconds, interval]:
+                return self.profiler.sample(float(seconds), float(interval))
+            case ['profile', 'cprofile', seconds]:
+                return self.profiler.cprofile(float(seconds))
+            case ['profile', 'stop']:
+                return self.profiler.stop()
+            case ['tracemalloc', 'snapshot']:
+                return self.profiler.tracemalloc_snapshot()
+            case ['tracemalloc', 'snapshot', frames]:
+                return self.profiler.tracemalloc_snapshot(int(frames))
+            case ['tracemalloc', 'stop']:
+                return self.profiler.tracemalloc_stop()
+            case ['trace', ('on' | 'off') as state, *options]:
+                return self.configure_tracing(state == 'on', options)
+            case ['capture', 'start']:
+                return self.message_server.start_capture(f"capture-{time.strftime('%Y%m%d-%H%M%S')}.bin")
+            case ['capture', 'start', path]:
+                return self.message_server.start_capture(path)
+            case ['capture', 'stop']:
+                return self.message_server.stop_capture()
+            case _:
+                return HELP
+
+    def configure_tracing(self, enabled, options):
+        settings = {}
+        for option in options:
+            key, _, value = option.partition('=')
+            values = [item for item in value.split(',') if item]
+            match key:
+                case 'users':
+                    settings['users'] = values
+                case 'actions':
+                    settings['actions'] = values
+                case 'rate':
+                    settings['sample_rate'] = float(value)
+                case _:
+                    raise ValueError(f'Unknown option {key}')
+        self.tracer.configure(enabled, **settings)
+        return (
+            f'Tracing {"on" if enabled else "off"}: users={sorted(self.tracer.users)}, '
+            f'actions={sorted(self.tracer.actions)}, rate={self.tracer.sample_rate}'
+        )
@@ -0,0 +1,105 @@
+import base64
+import concurrent.futures
+import hashlib
+import hmac
+import logging
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.append(".")
+from utils import Utils
+
+
+class ServerBusyError(Exception):
+    pass
+
+
+class PasswordHasher:
+    '''
+    在独立的进程池中执行 bcrypt 哈希与校验，避免占满连接线程所在进程的 CPU
+    max_pending 限制同时排队的任务数，超出时直接拒绝而不是无限堆积
+    工作进程由 forkserver 创建：直接 fork 会继承服务器当时打开的连接，
+    服务器关闭这些连接后对端收不到 EOF（例如管理命令的回复一直不结束）
+    '''
+
+    def __init__(self, max_workers=2, max_pending=64, timeout=10):
+        context = None
+        if 'forkserver' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('forkserver')
+        self.executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=context)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.timeout = timeout
+
+    def _run(self, func, *args):
+        if not self.slots.acquire(blocking=False):
+            logging.warning('Password hasher queue is full')
+            raise ServerBusyError('Server is busy, please retry later')
+        try:
+            future = self.executor.submit(func, *args)
+        except Exception:
+            self.slots.release()
+            raise
+        # 任务真正结束时才释放名额，超时返回的任务仍然占用进程
+        future.add_done_callback(lambda _: self.slots.release())
+        try:
+            return future.result(timeout=self.timeout)
+        except concurrent.futures.TimeoutError:
+            raise ServerBusyError('Server is busy, please retry later')
+
+    def hash_password(self, password):
+        return self._run(Utils.hash_password, password)
+
+    def check_password(self, password, password_hash):
+        return self._run(Utils.check_password, password, password_hash)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SessionTokenManager:
+    '''
+    会话令牌: base64(username:expire:signature)
+    签名覆盖用户名、过期时间和当前密码哈希，账户删除或重建后旧令牌自动失效
+    密钥保存在 key_file 中，服务器重启后已签发的令牌依然有效
+    '''
+
+    def __init__(self, key_file='session.key', ttl=86400):
+        self.ttl = ttl
+        self.secret = self.__load_secret(key_file)
+
+    @staticmethod
+    def __load_secret(key_file):
+        if os.path.exists(key_file):
+            with open(key_file, 'rb') as f:
+                secret = f.read()
+            if secret:
+                return secret
+        secret = os.urandom(32)
+        with open(key_file, 'wb') as f:
+            f.write(secret)
+        return secret
+
+    def __sign(self, username, expire, password_hash):
+        payload = f'{username}:{expire}:{password_hash}'.encode('utf-8')
+        return hmac.new(self.secret, payload, hashlib.sha256).hexdigest()
+
+    def issue(self, username, password_hash):
+        expire = int(time.time()) + self.ttl
+        signature = self.__sign(username, expire, password_hash)
+        token = f'{username}:{expire}:{signature}'
+        return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii')
+
+    def verify(self, username, token, password_hash):
+        try:
+            token_username, expire, signature = (
+                base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8').rsplit(':', 2)
+            )
+            expire = int(expire)
+        except (ValueError, UnicodeError, AttributeError):
+            return False
+        if token_username != username or expire < time.time():
+            return False
+        return hmac.compare_digest(signature, self.__sign(username, expire, password_hash))
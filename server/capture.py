@@ -0,0 +1,126 @@
+import gzip
+import itertools
+import json
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'CHATCAP1'
+# 相对时间（微秒）、连接编号、记录类型、数据长度
+RECORD = struct.Struct('<QIBI')
+OPEN, FRAME, CLOSE = 0, 1, 2
+USER_FIELDS = ('username', 'sender', 'receiver', 'friend')
+
+
+def rename(message, user_name, group_name):
+    '''
+    返回用户名和群名经 user_name / group_name 映射后的消息副本
+    '''
+    message = dict(message)
+    if message.get('who') is not None:
+        message['who'] = user_name(message['who'])
+    request_data = message.get('request_data')
+    if isinstance(request_data, dict):
+        request_data = dict(request_data)
+        for field in USER_FIELDS:
+            if request_data.get(field) is not None:
+                request_data[field] = user_name(request_data[field])
+        if request_data.get('group') is not None:
+            request_data['group'] = group_name(request_data['group'])
+        message['request_data'] = request_data
+    return message
+
+
+def read_capture(path):
+    '''
+    依次返回 (相对秒数, 连接编号, 记录类型, 消息)，OPEN/CLOSE 记录的消息为 None
+    '''
+    with gzip.open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'{path} is not a capture file')
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            offset, connection, kind, length = RECORD.unpack(header)
+            message = json.loads(f.read(length)) if length else None
+            yield offset / 1e6, connection, kind, message
+
+
+class WireCapture:
+    '''
+    记录收到的请求帧及其相对时间，供 tool/replay.py 按原有节奏重放
+    - 文件为 gzip 压缩的二进制记录: RECORD 头 + 紧凑 JSON
+    - 用户名、群名替换为 u1、g1 等编号，消息内容替换为等长的占位字符，密码、会话令牌和文件名不保留
+    - ack 帧和压缩协商的 hello 帧不记录，重放时由客户端自行确认，并且不压缩
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self.file = gzip.open(path, 'wb', compresslevel=6)
+        self.file.write(MAGIC)
+        self.started = time.perf_counter()
+        self.lock = threading.Lock()
+        self.connection_ids = itertools.count(1)
+        self.connections = {}  # socket -> 连接编号
+        self.users = {}
+        self.groups = {}
+        self.frames = 0
+        self.closed = False
+
+    def __write(self, connection, kind, payload=b''):
+        offset = int((time.perf_counter() - self.started) * 1e6)
+        with self.lock:
+            if self.closed:
+                return
+            self.file.write(RECORD.pack(offset, connection, kind, len(payload)))
+            self.file.write(payload)
+            if kind == FRAME:
+                self.frames += 1
+
+    def __connection(self, client_socket):
+        connection = self.connections.get(client_socket)
+        if connection is None:
+            connection = self.connections[client_socket] = next(self.connection_ids)
+            self.__write(connection, OPEN)
+        return connection
+
+    def __user(self, name):
+        with self.lock:
+            return self.users.setdefault(name, f'u{len(self.users) + 1}')
+
+    def __group(self, name):
+        with self.lock:
+            return self.groups.setdefault(name, f'g{len(self.groups) + 1}')
+
+    def anonymize(self, message):
+        message = rename(message, self.__user, self.__group)
+        request_data = message.get('request_data')
+        if isinstance(request_data, dict):
+            for field in ('password', 'session_token'):
+                if field in request_data:
+                    request_data[field] = ''
+            if isinstance(request_data.get('content'), str):
+                request_data['content'] = 'x' * len(request_data['content'])
+            if request_data.get('file_name'):
+                request_data['file_name'] = 'file' + os.path.splitext(request_data['file_name'])[1]
+        return message
+
+    def record(self, client_socket, message):
+        if message.get('type') in ('ack', 'hello'):
+            return
+        connection = self.__connection(client_socket)
+        payload = json.dumps(self.anonymize(message), separators=(',', ':')).encode('utf-8')
+        self.__write(connection, FRAME, payload)
+
+    def connection_closed(self, client_socket):
+        connection = self.connections.pop(client_socket, None)
+        if connection is not None:
+            self.__write(connection, CLOSE)
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.file.close()
+        return f'{self.frames} frames from {next(self.connection_ids) - 1} connections written to {self.path}'
@@ -0,0 +1,130 @@
+import heapq
+import itertools
+import sys
+import threading
+import time
+from collections import OrderedDict
+
+
+class Envelope:
+    '''
+    一条等待确认的消息，payload 为已经编码好的帧，补发时直接发送，群消息的所有接收者共用同一份字节
+    order 为全局的接收顺序，补发时按它合并各个会话的消息
+    '''
+    __slots__ = ('seq', 'payload', 'order')
+
+    def __init__(self, seq, payload, order):
+        self.seq = seq
+        self.payload = payload
+        self.order = order
+
+
+class DeliveryTracker:
+    '''
+    消息投递确认
+    - 每个会话（私聊为双方用户名，群聊为群名）有独立递增的序号 seq
+    - 接收者未确认的消息按会话分别保存，客户端发送 ack 确认某会话中 seq 及之前的全部消息，只需移除该会话的前缀
+    - 离线接收者最多积压 max_offline 条，之后 accepts 返回 False，由调用者拒绝发送
+    - 发送者为每条消息生成 message_id，重试发送时按 message_id 去重
+    序号只保存在内存中，epoch 标识本次服务器进程，客户端在 epoch 变化时重置已读序号
+    '''
+
+    def __init__(self, max_unacked=1000, dedup_window=1024, max_offline=1000):
+        self.epoch = format(int(time.time() * 1000), 'x')
+        self.max_unacked = max_unacked
+        self.max_offline = max_offline
+        self.dedup_window = dedup_window
+        self.sequences = {}  # conversation -> 最新 seq
+        self.unacked = {}  # recipient -> {conversation: [Envelope]}，每个会话按接收顺序排列
+        self.counts = {}  # recipient -> 未确认的消息数
+        self.orders = itertools.count()
+        self.recent_ids = {}  # sender -> OrderedDict(message_id -> seq)
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def personal_conversation(user1, user2):
+        return 'p:' + '|'.join(sorted((user1, user2)))
+
+    @staticmethod
+    def group_conversation(group):
+        return 'g:' + group
+
+    def assign(self, sender, message_id, conversation):
+        '''
+        为消息分配序号，返回 (seq, is_duplicate)，重复的 message_id 返回第一次分配的序号
+        '''
+        with self.lock:
+            recent = self.recent_ids.setdefault(sender, OrderedDict())
+            if message_id is not None and message_id in recent:
+                return recent[message_id], True
+            seq = self.sequences.get(conversation, 0) + 1
+            self.sequences[conversation] = seq
+            if message_id is not None:
+                recent[message_id] = seq
+                if len(recent) > self.dedup_window:
+                    recent.popitem(last=False)
+            return seq, False
+
+    def accepts(self, recipient):
+        '''
+        离线接收者是否还能积压消息，在 assign 之前检查，拒绝的消息不占用序号和 message_id
+        '''
+        return self.counts.get(recipient, 0) < self.max_offline
+
+    def track(self, recipient, conversation, seq, payload):
+        '''
+        消息一直保留到接收者确认，不会因为积压而丢弃
+        返回 True 表示该接收者未确认的消息超过 max_unacked，由调用者断开其连接，重新登录后全部补发
+        '''
+        with self.lock:
+            conversations = self.unacked.get(recipient)
+            if conversations is None:
+                recipient = sys.intern(recipient)
+                conversations = self.unacked[recipient] = {}
+            envelopes = conversations.get(conversation)
+            if envelopes is None:
+                envelopes = conversations[sys.intern(conversation)] = []
+            envelopes.append(Envelope(seq, payload, next(self.orders)))
+            count = self.counts[recipient] = self.counts.get(recipient, 0) + 1
+            return count > self.max_unacked
+
+    def ack(self, recipient, conversation, seq):
+        '''
+        累积确认：移除 conversation 中 seq 及之前的全部消息
+        同一会话的消息可能由不同线程登记，seq 不一定严格递增，遇到更大的 seq 就停止，剩下的由之后的确认移除
+        '''
+        with self.lock:
+            conversations = self.unacked.get(recipient)
+            envelopes = conversations.get(conversation) if conversations else None
+            if not envelopes:
+                return 0
+            removed = 0
+            while removed < len(envelopes) and envelopes[removed].seq <= seq:
+                removed += 1
+            if not removed:
+                return 0
+            if removed == len(envelopes):
+                del conversations[conversation]
+            else:
+                del envelopes[:removed]
+            count = self.counts[recipient] - removed
+            if count:
+                self.counts[recipient] = count
+            else:
+                del self.counts[recipient]
+                del self.unacked[recipient]
+            return removed
+
+    def pending(self, recipient):
+        '''
+        按接收顺序返回该接收者所有未确认消息的字节串，用于重新登录后补发
+        '''
+        with self.lock:
+            conversations = self.unacked.get(recipient, {}).values()
+            return [envelope.payload for envelope in heapq.merge(*conversations, key=lambda envelope: envelope.order)]
+
+    def unacked_count(self, recipient):
+        return self.counts.get(recipient, 0)
+
+    def total_unacked(self):
+        return sum(list(self.counts.values()))
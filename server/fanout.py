@@ -0,0 +1,118 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+
+
+class FanoutJob:
+
+    def __init__(self, partitions, deliver, on_complete):
+        self.deliver = deliver
+        self.on_complete = on_complete
+        self.remaining = partitions
+        self.delivered = 0
+        self.queued = 0
+        self.failed = 0
+        self.created = time.perf_counter()
+        self.lock = threading.Lock()
+
+
+class FanoutPool:
+    '''
+    群消息后台投递
+    接收者按用户名哈希分到固定的投递线程（lane），每个 lane 顺序处理自己的队列，
+    保证同一接收者收到的消息顺序与发送顺序一致
+    deliver(recipient) 返回 'delivered'/'queued'/'failed'，全部完成后调用 on_complete(job)
+    '''
+
+    def __init__(self, workers=4, report_interval=60, slow_threshold=1.0):
+        self.lanes = [queue.Queue() for _ in range(workers)]
+        self.report_interval = report_interval
+        self.slow_threshold = slow_threshold
+        self.latencies = deque(maxlen=1024)
+        self.completed = 0
+        self.lock = threading.Lock()  # 多个 lane 线程同时完成任务，统计数据在锁内更新和读取
+        for lane in self.lanes:
+            threading.Thread(target=self.__run, args=(lane, ), daemon=True).start()
+        threading.Thread(target=self.__report, daemon=True).start()
+
+    def __report(self):
+        # 定期输出积压量和投递延迟，用于评估 fanout_workers 是否足够
+        reported = 0
+        while True:
+            time.sleep(self.report_interval)
+            if self.completed != reported or self.backlog():
+                reported = self.completed
+                logging.info(f'Fan-out stats: {self.stats()}')
+
+    def submit(self, recipients, deliver, on_complete):
+        partitions = [[] for _ in self.lanes]
+        for recipient in recipients:
+            partitions[hash(recipient) % len(self.lanes)].append(recipient)
+        partitions = [(lane, part) for lane, part in zip(self.lanes, partitions) if part]
+        job = FanoutJob(len(partitions), deliver, on_complete)
+        if not partitions:
+            self.__finish(job)
+            return job
+        for lane, part in partitions:
+            lane.put((job, part))
+        return job
+
+    def __run(self, lane):
+        while True:
+            job, recipients = lane.get()
+            delivered = queued = failed = 0
+            for recipient in recipients:
+                try:
+                    result = job.deliver(recipient)
+                except Exception as e:
+                    logging.error(f'Fan-out delivery to {recipient} failed: {e}')
+                    result = 'failed'
+                if result == 'delivered':
+                    delivered += 1
+                elif result == 'queued':
+                    queued += 1
+                else:
+                    failed += 1
+            with job.lock:
+                job.delivered += delivered
+                job.queued += queued
+                job.failed += failed
+                job.remaining -= 1
+                finished = job.remaining == 0
+            if finished:
+                self.__finish(job)
+
+    def __finish(self, job):
+        latency = time.perf_counter() - job.created
+        with self.lock:
+            self.latencies.append(latency)
+            self.completed += 1
+        if latency > self.slow_threshold:
+            logging.warning(f'Slow fan-out: {latency:.3f}s, backlog {self.backlog()}')
+        try:
+            job.on_complete(job)
+        except Exception as e:
+            logging.error(f'Fan-out completion callback failed: {e}')
+
+    def backlog(self):
+        return sum(lane.qsize() for lane in self.lanes)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            completed = self.completed
+        if latencies:
+            p50 = latencies[len(latencies) // 2]
+            p95 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))]
+        else:
+            p50 = p95 = 0.0
+        return {
+            'workers': len(self.lanes),
+            'backlog': self.backlog(),
+            'completed': completed,
+            'latency_p50': p50,
+            'latency_p95': p95,
+            'latency_max': latencies[-1] if latencies else 0.0
+        }
@@ -0,0 +1,121 @@
+import sys
+
+sys.path.append(".")
+from utils import Utils
+from metrics import TimedCursor
+
+
+class GroupManager:
+    # 单例模式
+    _instance = None
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, user_manager):
+        self.user_manager = user_manager
+        # 与 UserManager 共用同一个数据库连接和锁，两个连接同时写 users.db 会出现 database is locked
+        self.conn = user_manager.conn
+        self.lock = user_manager.db_lock
+        self.cursor = TimedCursor(self.conn.cursor(), 'groups')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS chat_groups (
+                groupname TEXT PRIMARY KEY,
+                owner TEXT NOT NULL,
+                FOREIGN KEY (owner) REFERENCES users(username)
+            )
+        ''')
+        self.cursor.execute('''
+            CREATE TABLE IF NOT EXISTS group_members (
+                groupname TEXT NOT NULL,
+                username TEXT NOT NULL,
+                PRIMARY KEY (groupname, username),
+                FOREIGN KEY (groupname) REFERENCES chat_groups(groupname),
+                FOREIGN KEY (username) REFERENCES users(username)
+            )
+        ''')
+        self.cursor.execute('CREATE INDEX IF NOT EXISTS group_members_username ON group_members (username)')
+        self.conn.commit()
+        # 群成员缓存: groupname -> frozenset，修改时整体替换，读取方无需复制
+        self.members = {}
+
+    def get_members(self, groupname):
+        '''
+        返回群成员集合，群不存在时返回 None
+        '''
+        members = self.members.get(groupname)
+        if members is not None:
+            return members
+        with self.lock:
+            self.cursor.execute('SELECT 1 FROM chat_groups WHERE groupname = ?', (groupname, ))
+            if self.cursor.fetchone() is None:
+                return None
+            self.cursor.execute('SELECT username FROM group_members WHERE groupname = ?', (groupname, ))
+            members = frozenset(row[0] for row in self.cursor.fetchall())
+            self.members[groupname] = members
+        return members
+
+    def get_groups(self, username):
+        with self.lock:
+            self.cursor.execute('SELECT groupname FROM group_members WHERE username = ?', (username, ))
+            return [row[0] for row in self.cursor.fetchall()]
+
+    def create_group(self, username, groupname):
+        success, message = Utils.is_valid_group_name(groupname)
+        if not success:
+            return success, message
+        if not self.user_manager.is_username_exist(username):
+            return False, 'User is not exist'
+        with self.lock:
+            self.cursor.execute('SELECT 1 FROM chat_groups WHERE groupname = ?', (groupname, ))
+            if self.cursor.fetchone() is not None:
+                return False, 'Group already exists'
+            self.cursor.execute('INSERT INTO chat_groups (groupname, owner) VALUES (?, ?)', (groupname, username))
+            self.cursor.execute(
+                'INSERT INTO group_members (groupname, username) VALUES (?, ?)', (groupname, username)
+            )
+            self.conn.commit()
+            self.members[groupname] = frozenset((username, ))
+        return True, 'Group created successfully'
+
+    def join_group(self, username, groupname):
+        members = self.get_members(groupname)
+        if members is None:
+            return False, 'Group is not exist'
+        if username in members:
+            return False, 'Already a member of this group'
+        if not self.user_manager.is_username_exist(username):
+            return False, 'User is not exist'
+        with self.lock:
+            self.cursor.execute(
+                'INSERT OR IGNORE INTO group_members (groupname, username) VALUES (?, ?)', (groupname, username)
+            )
+            self.conn.commit()
+            self.members[groupname] = self.members.get(groupname, frozenset()) | {username}
+        return True, 'Joined group successfully'
+
+    def leave_group(self, username, groupname):
+        members = self.get_members(groupname)
+        if members is None:
+            return False, 'Group is not exist'
+        if username not in members:
+            return False, 'Not a member of this group'
+        with self.lock:
+            self.cursor.execute(
+                'DELETE FROM group_members WHERE groupname = ? AND username = ?', (groupname, username)
+            )
+            members = self.members.get(groupname, frozenset()) - {username}
+            if members:
+                self.members[groupname] = members
+            else:
+                # 最后一个成员退出后解散该群
+                self.cursor.execute('DELETE FROM chat_groups WHERE groupname = ?', (groupname, ))
+                self.members.pop(groupname, None)
+            self.conn.commit()
+        return True, 'Left group successfully'
+
+    def close_connection(self):
+        # 数据库连接属于 UserManager，由 UserManager.close_connection 关闭
+        pass
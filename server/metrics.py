@@ -0,0 +1,276 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+# 直方图默认分桶（秒）
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Metrics:
+    '''
+    服务器运行指标，以 Prometheus 文本格式导出
+    - counter: 按线程分片，每个线程只写自己的 dict，热路径上不加锁，导出时合并各分片
+    - histogram: 观测值追加到无锁的 deque，由后台线程汇总到分桶中
+    - gauge: 导出时调用回调函数取值，回调返回数值或 {标签值元组: 数值}
+    标签值按定义时给出的标签名顺序以元组传入，例如 inc('chat_frames_received_total', ('login', ))
+    '''
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, aggregate_interval=1.0):
+        if hasattr(self, 'definitions'):
+            return
+        self.definitions = {}  # name -> (type, help, 标签名元组, 回调或分桶)
+        self.local = threading.local()
+        self.shards = []  # [(线程, 计数 dict)]
+        self.retired = {}  # 已结束线程的计数
+        self.shards_lock = threading.Lock()  # 只在线程第一次计数和合并时使用
+        self.samples = deque(maxlen=100000)  # (name, 标签值, 观测值)，汇总线程落后时丢弃最早的
+        self.histograms = {}  # (name, 标签值) -> [各分桶计数..., 总和]
+        self.histogram_lock = threading.Lock()
+        self.aggregate_interval = aggregate_interval
+        self.__define_defaults()
+        threading.Thread(target=self.__aggregate_loop, name='metrics', daemon=True).start()
+
+    def __define_defaults(self):
+        self.counter('chat_connections_accepted_total', 'Accepted message connections')
+        self.counter('chat_frames_received_total', 'Frames received, by action or type', ('action', ))
+        self.counter('chat_frames_sent_total', 'Frames sent, by action or type', ('action', ))
+        self.counter('chat_file_transfer_bytes_total', 'File transfer bytes', ('direction', ))
+        self.counter('chat_file_transfers_total', 'Finished file uploads and downloads', ('kind', 'result'))
+        self.counter(
+            'chat_compression_bytes_total', 'Frame bytes on compressed connections, before (raw) and after (wire)',
+            ('direction', 'form')
+        )
+        self.counter('chat_rejected_requests_total', 'Requests rejected by rate limits or load shedding', ('reason', 'action'))
+        self.counter('chat_deferred_requests_total', 'Requests delayed by rate limits', ('action', ))
+        self.counter(
+            'chat_unacked_overflow_total', 'Messages for receivers over max_unacked or max_offline, by receiver state', ('state', )
+        )
+        self.histogram('chat_handler_seconds', 'Request handler latency', ('action', ))
+        self.histogram('chat_sqlite_query_seconds', 'SQLite query latency', ('db', 'op'))
+        self.histogram('chat_tls_handshake_seconds', 'TLS handshake time, by port and session resumption', ('port', 'resumed'))
+
+    # region 定义
+    def counter(self, name, help, labels=()):
+        self.definitions[name] = ('counter', help, labels, None)
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.definitions[name] = ('histogram', help, labels, buckets)
+
+    def gauge(self, name, help, callback, labels=(), type='gauge'):
+        '''
+        type 为 counter 时表示回调返回的是累计值（例如缓存命中次数）
+        '''
+        self.definitions[name] = (type + ':callback', help, labels, callback)
+
+    # endregion
+
+    # region 记录
+    def inc(self, name, labels=(), amount=1):
+        counts = getattr(self.local, 'counts', None)
+        if counts is None:
+            counts = self.__register_shard()
+        key = (name, labels)
+        counts[key] = counts.get(key, 0) + amount
+
+    def observe(self, name, value, labels=()):
+        self.samples.append((name, labels, value))
+
+    def __register_shard(self):
+        counts = self.local.counts = {}
+        with self.shards_lock:
+            self.shards.append((threading.current_thread(), counts))
+        return counts
+
+    # endregion
+
+    # region 汇总
+    def __aggregate_loop(self):
+        while True:
+            time.sleep(self.aggregate_interval)
+            try:
+                self.aggregate()
+            except Exception as e:
+                logging.error(f'Metrics aggregation failed: {e}')
+
+    def aggregate(self):
+        '''
+        将观测值汇总到分桶，并合并已结束线程的计数分片
+        '''
+        with self.histogram_lock:
+            while True:
+                try:
+                    name, labels, value = self.samples.popleft()
+                except IndexError:
+                    break
+                buckets = self.definitions[name][3]
+                histogram = self.histograms.get((name, labels))
+                if histogram is None:
+                    histogram = self.histograms[name, labels] = [0] * (len(buckets) + 2)
+                histogram[bisect_left(buckets, value)] += 1
+                histogram[-1] += value
+        with self.shards_lock:
+            alive = []
+            for thread, counts in self.shards:
+                if thread.is_alive():
+                    alive.append((thread, counts))
+                else:  # 线程已结束，不会再写入
+                    for key, value in counts.items():
+                        self.retired[key] = self.retired.get(key, 0) + value
+            self.shards = alive
+
+    def counters(self):
+        with self.shards_lock:
+            totals = dict(self.retired)
+            shards = [counts for _, counts in self.shards]
+        for counts in shards:
+            # 复制后再遍历，其他线程同时写入不会影响
+            for key, value in counts.copy().items():
+                totals[key] = totals.get(key, 0) + value
+        return totals
+
+    # endregion
+
+    # region 导出
+    def render(self):
+        self.aggregate()
+        counters = self.counters()
+        with self.histogram_lock:
+            histograms = {key: list(value) for key, value in self.histograms.items()}
+        lines = []
+        for name, (type, help, label_names, extra) in self.definitions.items():
+            type, _, source = type.partition(':')
+            lines.append(f'# HELP {name} {help}')
+            lines.append(f'# TYPE {name} {type}')
+            if source == 'callback':
+                try:
+                    value = extra()
+                except Exception as e:
+                    logging.error(f'Metrics callback {name} failed: {e}')
+                    continue
+                values = value if isinstance(value, dict) else {(): value}
+                for labels, value in values.items():
+                    lines.append(f'{name}{format_labels(label_names, labels)} {value}')
+            elif type == 'counter':
+                for (counter_name, labels), value in sorted(counters.items()):
+                    if counter_name == name:
+                        lines.append(f'{name}{format_labels(label_names, labels)} {value}')
+            else:
+                for (histogram_name, labels), histogram in sorted(histograms.items()):
+                    if histogram_name == name:
+                        lines.extend(format_histogram(name, label_names, labels, extra, histogram))
+        return '\n'.join(lines) + '\n'
+
+    # endregion
+
+
+def format_labels(names, values, extra=''):
+    pairs = [f'{name}="{escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_histogram(name, label_names, labels, buckets, histogram):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(buckets, histogram):
+        cumulative += count
+        bucket_labels = format_labels(label_names, labels, f'le="{bound}"')
+        lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+    cumulative += histogram[-2]
+    bucket_labels = format_labels(label_names, labels, 'le="+Inf"')
+    lines.append(f'{name}_bucket{bucket_labels} {cumulative}')
+    lines.append(f'{name}_sum{format_labels(label_names, labels)} {histogram[-1]}')
+    lines.append(f'{name}_count{format_labels(label_names, labels)} {cumulative}')
+    return lines
+
+
+class TimedCursor:
+    '''
+    SQLite 游标包装，按数据库和语句类型（SELECT/INSERT/...）记录查询耗时，其余属性直接转发给原游标
+    '''
+
+    def __init__(self, cursor, database):
+        self.cursor = cursor
+        self.database = database
+        self.metrics = Metrics()
+
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return self.cursor.execute(sql, parameters)
+        finally:
+            self.__observe(sql, started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return self.cursor.executemany(sql, seq_of_parameters)
+        finally:
+            self.__observe(sql, started)
+
+    def __observe(self, sql, started):
+        operation = sql.split(None, 1)[0].upper() if sql.strip() else ''
+        self.metrics.observe('chat_sqlite_query_seconds', time.perf_counter() - started, (self.database, operation))
+
+    def __getattr__(self, name):
+        return getattr(self.cursor, name)
+
+
+class MetricsServer:
+    '''
+    在独立端口上提供 GET /metrics，其他只读的诊断接口通过 add_route 注册
+    '''
+
+    def __init__(self, metrics, host, port):
+        self.metrics = metrics
+        self.routes = {'/metrics': ('text/plain; version=0.0.4; charset=utf-8', lambda query: metrics.render())}
+        routes = self.routes
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(handler):
+                path, _, query = handler.path.partition('?')
+                if path not in routes:
+                    handler.send_error(404)
+                    return
+                content_type, callback = routes[path]
+                body = callback(parse_qs(query)).encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', content_type)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass  # 抓取请求不写入服务器日志
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+
+    def add_route(self, path, content_type, callback):
+        '''
+        callback(query) 返回响应文本，query 为 parse_qs 解析后的参数
+        '''
+        self.routes[path] = (content_type, callback)
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, name='metrics-http', daemon=True).start()
+        logging.info(f'Metrics endpoint on http://{self.httpd.server_address[0]}:{self.httpd.server_address[1]}/metrics')
@@ -0,0 +1,109 @@
+import socket
+import threading
+from collections import deque
+
+from metrics import Metrics
+from watchdog import Watchdog
+
+
+class OutboundQueue:
+    '''
+    每个连接的发送队列
+    任何线程都可以写入；第一个写入的线程负责把队列发送完，其余线程入队后立即返回，
+    保证同一连接上的消息不会交错，也不需要为每个连接额外开一个发送线程
+    每个在线连接都有一个队列，因此使用 __slots__，且只在有线程正在发送时才创建 deque
+    协商了压缩的连接设置 codec（utils.FrameCodec），帧在入队时（锁内，与发送顺序一致）压缩，
+    因此群消息仍然只编码一次 JSON，但每个连接各自压缩
+    积压的多个帧合并为一次写入（最多 MAX_BATCH 字节），TLS 连接上可以减少小记录和系统调用
+    写入失败（包括慢接收者导致的超时）时对端可能只收到半个帧，压缩流也已经不同步，
+    因此关闭连接，由读取线程移除会话，客户端重连后补发未确认的消息；之后的写入直接失败
+    '''
+    __slots__ = ('socket', 'peer', 'watchdog', 'pending', 'lock', 'flushing', 'codec', 'broken')
+    MAX_BATCH = 256 * 1024
+
+    def __init__(self, client_socket):
+        self.socket = client_socket
+        try:
+            self.peer = '%s:%s' % client_socket.getpeername()[:2]
+        except OSError:
+            self.peer = None
+        self.watchdog = Watchdog()
+        self.pending = None  # 其他线程正在发送时写入的 (data, on_sent)
+        self.lock = threading.Lock()
+        self.flushing = False
+        self.codec = None
+        self.broken = False
+
+    def put(self, data, on_sent=None, codec=None):
+        '''
+        on_sent 在数据写入 socket 后调用（可能在其他线程中）
+        codec 不为 None 时从下一帧开始使用该 codec 编码，用于压缩协商（协商的回复本身不压缩）
+        '''
+        raw_size = len(data)
+        with self.lock:
+            if self.broken:
+                raise BrokenPipeError(f'Connection to {self.peer} is closed after a failed write')
+            compressed = self.codec is not None
+            if compressed:
+                data = self.codec.encode(data)
+            if codec is not None:
+                self.codec = codec
+            flushing = self.flushing
+            if flushing:
+                if self.pending is None:
+                    self.pending = deque()
+                self.pending.append((data, on_sent))
+            self.flushing = True
+        if compressed:
+            metrics = Metrics()
+            metrics.inc('chat_compression_bytes_total', ('out', 'raw'), raw_size)
+            metrics.inc('chat_compression_bytes_total', ('out', 'wire'), len(data))
+        if not flushing:
+            self.__flush(data, (on_sent, ) if on_sent is not None else ())
+
+    def __flush(self, data, callbacks):
+        try:
+            while True:
+                # 接收方不读取时 sendall 会一直阻塞，由 Watchdog 报告
+                watch = self.watchdog.begin('write', 'sendall', self.peer)
+                try:
+                    self.socket.sendall(data)
+                finally:
+                    self.watchdog.end(watch)
+                for on_sent in callbacks:
+                    on_sent()
+                with self.lock:
+                    if not self.pending:
+                        self.pending = None
+                        self.flushing = False
+                        return
+                    data, callbacks = self.__take_batch()
+        except OSError:
+            with self.lock:
+                self.pending = None
+                self.flushing = False
+                self.broken = True
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            raise
+
+    def __take_batch(self):
+        '''
+        在锁内调用，取出积压的帧，返回 (合并后的数据, on_sent 列表)
+        '''
+        chunks = []
+        callbacks = []
+        size = 0
+        while self.pending and (not chunks or size + len(self.pending[0][0]) <= self.MAX_BATCH):
+            data, on_sent = self.pending.popleft()
+            chunks.append(data)
+            size += len(data)
+            if on_sent is not None:
+                callbacks.append(on_sent)
+        return (chunks[0] if len(chunks) == 1 else b''.join(chunks)), callbacks
+
+    def depth(self):
+        pending = self.pending
+        return len(pending) if pending else 0
@@ -0,0 +1,75 @@
+import logging
+import sys
+import threading
+import time
+
+sys.path.append(".")
+from utils import MessageBuilder as mb
+
+
+class PresenceNotifier:
+    '''
+    在线状态变更推送
+    状态变化先记入 pending，由后台线程每 interval 秒合并发送一次：
+    短时间内下线又上线的抖动会被抵消，每个接收者每轮只收到一个批量事件
+    '''
+
+    def __init__(self, user_manager, send_message, interval=0.5):
+        self.user_manager = user_manager
+        self.send_message = send_message
+        self.interval = interval
+        self.pending = {}  # username -> (online, watchers)
+        self.published = set()  # 最近一次推送为在线的用户
+        self.lock = threading.Lock()
+        threading.Thread(target=self.run, daemon=True).start()
+
+    def publish(self, username, online, watchers):
+        if not watchers:
+            # 没有在线好友时无需推送，但要记录状态，保证之后的抖动判断正确
+            with self.lock:
+                self.pending.pop(username, None)
+                if online:
+                    self.published.add(username)
+                else:
+                    self.published.discard(username)
+            return
+        with self.lock:
+            _, old_watchers = self.pending.get(username, (online, set()))
+            self.pending[username] = (online, old_watchers | set(watchers))
+
+    def run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except Exception as e:
+                logging.error(f'Presence flush failed: {e}')
+
+    def flush(self):
+        with self.lock:
+            if not self.pending:
+                return
+            pending, self.pending = self.pending, {}
+            batches = {}
+            for username, (online, watchers) in pending.items():
+                if online == (username in self.published):
+                    continue  # 状态与上次推送一致，属于抖动
+                if online:
+                    self.published.add(username)
+                else:
+                    self.published.discard(username)
+                for watcher in watchers:
+                    batches.setdefault(watcher, {})[username] = online
+        for watcher, changes in batches.items():
+            self.push(watcher, changes)
+
+    def push(self, watcher, changes):
+        '''
+        立即向 watcher 推送状态，用于新建好友关系等不属于状态变化的场景
+        '''
+        message = mb.build_presence(changes)
+        for client_socket in self.user_manager.get_sockets(watcher):
+            try:
+                self.send_message(client_socket, message)
+            except OSError as e:
+                logging.info(f'Failed to push presence to {watcher}: {e}')
@@ -0,0 +1,170 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+
+class Profiler:
+    '''
+    运行中的服务器按需进行性能分析，同一时间只运行一个分析会话，结果写入 output_dir
+    - sample: 定时通过 sys._current_frames 采样所有线程的调用栈，输出 collapsed stacks，
+      可直接用 flamegraph.pl 或 speedscope 生成火焰图
+    - cprofile: 分析期间处理请求的线程在 handle_message 中各自启用 cProfile（enter/exit），结束后合并；
+      Python 3.12 起 cProfile 基于 sys.monitoring，同一时间只能启用一个，多个线程各自启用会抛出 ValueError，
+      因此改为采样
+    - tracemalloc: 生成内存快照并与上一次快照对比，用于查找内存增长
+    '''
+
+    def __init__(self, output_dir='profiles'):
+        self.output_dir = output_dir
+        self.session_lock = threading.Lock()
+        self.stop_event = threading.Event()
+        self.cprofile_active = False
+        self.generation = 0
+        self.profiles = []
+        self.profiles_lock = threading.Lock()
+        self.local = threading.local()
+        self.snapshot = None
+
+    def __output_path(self, kind, suffix):
+        os.makedirs(self.output_dir, exist_ok=True)
+        return os.path.join(self.output_dir, f"{kind}-{time.strftime('%Y%m%d-%H%M%S')}.{suffix}")
+
+    def stop(self):
+        if not self.session_lock.locked():
+            return 'No profiling session is running'
+        self.stop_event.set()
+        return 'Stopping'
+
+    # region 采样
+    def sample(self, seconds, interval=0.005):
+        if not self.session_lock.acquire(blocking=False):
+            return 'A profiling session is already running'
+        try:
+            self.stop_event.clear()
+            stacks = Counter()
+            samples = 0
+            own_thread = threading.get_ident()
+            deadline = time.perf_counter() + seconds
+            while time.perf_counter() < deadline and not self.stop_event.is_set():
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id != own_thread:
+                        stacks[collapse_stack(frame)] += 1
+                samples += 1
+                self.stop_event.wait(interval)
+        finally:
+            self.session_lock.release()
+        path = self.__output_path('sample', 'folded')
+        with open(path, 'w') as f:
+            for stack, count in stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        leaves = Counter()
+        for stack, count in stacks.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        lines = [f'{samples} samples of {len(stacks)} distinct stacks written to {path}', 'Top functions (self):']
+        lines += [f'{count:>8}  {leaf}' for leaf, count in leaves.most_common(15)]
+        return '\n'.join(lines)
+
+    # endregion
+
+    # region cProfile
+    def cprofile(self, seconds, limit=30):
+        if sys.version_info >= (3, 12):
+            return 'cProfile cannot profile concurrent threads on Python 3.12+, sampling instead\n' + \
+                self.sample(seconds)
+        if not self.session_lock.acquire(blocking=False):
+            return 'A profiling session is already running'
+        try:
+            self.stop_event.clear()
+            with self.profiles_lock:
+                self.profiles = []
+            self.generation += 1
+            self.cprofile_active = True
+            self.stop_event.wait(seconds)
+            self.cprofile_active = False
+            time.sleep(0.1)  # 等待正在处理的请求结束
+            with self.profiles_lock:
+                profiles, self.profiles = self.profiles, []
+        finally:
+            self.session_lock.release()
+        if not profiles:
+            return 'No requests were handled during the session'
+        stats = pstats.Stats(profiles[0])
+        for profile in profiles[1:]:
+            stats.add(profile)
+        path = self.__output_path('cprofile', 'prof')
+        stats.dump_stats(path)
+        output = io.StringIO()
+        stats.stream = output
+        stats.sort_stats('cumulative').print_stats(limit)
+        return f'{len(profiles)} threads profiled, stats written to {path}\n{output.getvalue()}'
+
+    def enter(self):
+        '''
+        处理请求前调用，cProfile 会话进行中时为当前线程启用分析，返回值交给 exit()
+        '''
+        if not self.cprofile_active:
+            return None
+        profile = getattr(self.local, 'profile', None)
+        if profile is None or self.local.generation != self.generation:
+            profile = self.local.profile = cProfile.Profile()
+            self.local.generation = self.generation
+            with self.profiles_lock:
+                self.profiles.append(profile)
+        profile.enable()
+        return profile
+
+    def exit(self, profile):
+        if profile is not None:
+            profile.disable()
+
+    # endregion
+
+    # region tracemalloc
+    def tracemalloc_snapshot(self, frames=10, limit=20):
+        '''
+        第一次调用开始跟踪内存分配，之后每次调用生成快照，并与上一次快照按代码行对比
+        '''
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(frames)
+            self.snapshot = None
+            return f'tracemalloc started with {frames} frames, run again to take a snapshot'
+        snapshot = tracemalloc.take_snapshot().filter_traces((tracemalloc.Filter(False, tracemalloc.__file__), ))
+        path = self.__output_path('tracemalloc', 'snapshot')
+        snapshot.dump(path)
+        current, peak = tracemalloc.get_traced_memory()
+        lines = [f'Snapshot written to {path}, traced {current / 1024 / 1024:.1f} MB (peak {peak / 1024 / 1024:.1f} MB)']
+        if self.snapshot is None:
+            lines.append('Top allocations:')
+            lines += [str(stat) for stat in snapshot.statistics('lineno')[:limit]]
+        else:
+            lines.append('Growth since last snapshot:')
+            lines += [str(stat) for stat in snapshot.compare_to(self.snapshot, 'lineno')[:limit]]
+        self.snapshot = snapshot
+        return '\n'.join(lines)
+
+    def tracemalloc_stop(self):
+        if not tracemalloc.is_tracing():
+            return 'tracemalloc is not running'
+        tracemalloc.stop()
+        self.snapshot = None
+        return 'tracemalloc stopped'
+
+    # endregion
+
+
+def collapse_stack(frame):
+    '''
+    调用栈转换为 collapsed 格式: 最外层在前，以分号分隔
+    '''
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+        frame = frame.f_back
+    return ';'.join(reversed(names))
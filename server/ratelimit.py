@@ -0,0 +1,118 @@
+import math
+import threading
+import time
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self):
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    '''
+    令牌桶限流，规则为 {'<scope>.<action>': (每秒令牌数, 桶容量)}
+    scope: user（按用户）、ip（按客户端地址）、global（所有客户端合计）；action 为 * 时匹配所有请求
+    一个请求需要所有匹配的桶都有令牌才会放行，被拒绝时不消耗任何桶的令牌
+    '''
+
+    def __init__(self, rules, idle_timeout=600):
+        self.rules = {}
+        for key, (rate, burst) in rules.items():
+            scope, action = key.split('.', 1)
+            if scope not in ('user', 'ip', 'global'):
+                raise ValueError(f'Unknown rate limit scope in {key}')
+            # 每秒令牌数为 0 时永远等不到令牌；需要禁止某个请求时应在服务器中处理，而不是用限流规则
+            if rate <= 0 or burst < 1:
+                raise ValueError(f'Rate limit {key} needs a positive rate and a burst of at least 1')
+            self.rules[scope, action] = (rate, burst)
+        self.buckets = {}  # (scope, action, 用户或地址) -> TokenBucket
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.last_cleanup = time.monotonic()
+
+    def check(self, action, user, ip):
+        '''
+        返回 (建议的重试等待秒数, 超限的规则的 scope，global 规则超限时总是 global)，放行时返回 (0, None)
+        '''
+        matched = []
+        for scope, identity in (('global', ''), ('ip', ip), ('user', user)):
+            if identity is None:
+                continue
+            for rule_action in (action, '*'):
+                rule = self.rules.get((scope, rule_action))
+                if rule is not None:
+                    matched.append(((scope, rule_action, identity), rule))
+        if not matched:
+            return 0, None
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_cleanup > self.idle_timeout:
+                self.__cleanup(now)
+            buckets = []
+            wait, limited_scope = 0, None
+            for key, (rate, burst) in matched:
+                bucket = self.buckets.get(key)
+                if bucket is None:
+                    bucket = self.buckets[key] = TokenBucket(rate, burst, now)
+                bucket.refill(now)
+                buckets.append(bucket)
+                bucket_wait = bucket.wait_time()
+                if bucket_wait > wait:
+                    wait = bucket_wait
+                if bucket_wait and limited_scope != 'global':
+                    limited_scope = key[0]
+            if wait == 0:
+                for bucket in buckets:
+                    bucket.tokens -= 1
+            return wait, limited_scope
+
+    def __cleanup(self, now):
+        # 长时间未使用的桶已经回满，删除后与新建的桶相同
+        self.buckets = {
+            key: bucket for key, bucket in self.buckets.items() if now - bucket.updated < self.idle_timeout
+        }
+        self.last_cleanup = now
+
+
+class AdmissionController:
+    '''
+    过载保护：请求处理耗时的指数加权平均超过 latency_threshold 时，拒绝低优先级请求（如刷新好友列表）
+    平均值随时间衰减（时间常数 decay 秒），低优先级请求被拒绝、没有新样本时也能自动恢复
+    ignored_actions 本身耗时较长（如文件传输），不计入平均值
+    '''
+
+    def __init__(self, latency_threshold, low_priority_actions, ignored_actions=(), decay=2.0, weight=0.1):
+        self.latency_threshold = latency_threshold
+        self.low_priority_actions = frozenset(low_priority_actions)
+        self.ignored_actions = frozenset(ignored_actions)
+        self.decay = decay
+        self.weight = weight
+        self.average = 0.0
+        self.updated = time.monotonic()
+
+    def latency(self, now=None):
+        now = time.monotonic() if now is None else now
+        return self.average * math.exp(-(now - self.updated) / self.decay)
+
+    def record(self, action, seconds):
+        if action in self.ignored_actions:
+            return
+        now = time.monotonic()
+        # 多个线程同时更新时可能丢失个别样本，对估计值没有影响，不需要加锁
+        self.average = self.latency(now) * (1 - self.weight) + seconds * self.weight
+        self.updated = now
+
+    def admit(self, action):
+        return action not in self.low_priority_actions or self.latency() <= self.latency_threshold
@@ -7,11 +7,31 @@ import logging
 import sys
 import time
 import configparser
+import atexit
 import concurrent.futures
+import functools
+import signal
+import uuid
+import zlib
 
 sys.path.append(".")
 from utils import MessageBuilder as mb
+from utils import Compression, FrameBuffer, FrameCodec, Protocol
 import user_manager as usermanager
+import auth
+import presence
+import group_manager as groupmanager
+from outbound import OutboundQueue
+from fanout import FanoutPool
+from delivery import DeliveryTracker
+from metrics import Metrics, MetricsServer
+from tracing import Tracer
+from watchdog import Watchdog
+from profiler import Profiler
+from admin import AdminServer
+from capture import WireCapture
+from ratelimit import AdmissionController, RateLimiter
+import tls
 
 
 class Manager:
@@ -26,14 +46,122 @@ class Manager:
         return cls._instance
 
     def __init__(self):
-        self.file_transfer_server = FileTransferServer(self)
-        self.user_manager = usermanager.UserManager()
+        config = Config()
+        self.tracer = Tracer(
+            config.tracing_enabled == 'True', config.tracing_sample_rate, config.tracing_users,
+            config.tracing_actions, config.tracing_buffer_size
+        )
+        self.watchdog = Watchdog(
+            config.watchdog_enabled == 'True', config.watchdog_handler_budget, config.watchdog_write_budget,
+            config.watchdog_action_budgets, config.watchdog_check_interval
+        )
+        self.profiler = Profiler(config.profile_dir)
+        self.tls_context = None
+        if config.tls_enabled == 'True':
+            self.tls_context = tls.create_server_context(
+                config.tls_cert_file, config.tls_key_file, config.tls_session_tickets
+            )
+        self.file_transfer_server = FileTransferServer(self, self.tls_context)
+        self.password_hasher = auth.PasswordHasher(
+            config.password_workers, config.password_queue_limit, config.password_timeout
+        )
+        self.session_tokens = auth.SessionTokenManager(config.session_key_file, config.session_token_ttl)
+        self.user_manager = usermanager.UserManager(
+            self.password_hasher, self.session_tokens, config.friend_cache_max_entries, config.session_shards
+        )
+        self.group_manager = groupmanager.GroupManager(self.user_manager)
+        self.user_manager.presence_notifier = presence.PresenceNotifier(
+            self.user_manager, MessageServer.send_message, config.presence_coalesce_interval
+        )
         self.messagehandler = MessageHandler(manager_instance=self)
         self.message_server = MessageServer(manager_instance=self)
+        if config.metrics_enabled == 'True':
+            self.register_metrics()
+            metrics_server = MetricsServer(Metrics(), config.metrics_host, config.metrics_port)
+            metrics_server.add_route('/traces', 'application/json', self.export_traces)
+            metrics_server.start()
+        if config.admin_enabled == 'True':
+            self.start_admin(config)
+        if config.capture_enabled == 'True':
+            self.message_server.start_capture(config.capture_path)
+        self.file_transfer_server.start()
         self.message_server.start()
 
+    def start_admin(self, config):
+        '''
+        管理通道和 SIGUSR1 都只在类 Unix 系统上可用
+        '''
+        if hasattr(socket, 'AF_UNIX'):
+            AdminServer(config.admin_socket, self.profiler, self.tracer, self.message_server).start()
+        if hasattr(signal, 'SIGUSR1'):
+            # kill -USR1 <pid>: 采样 signal_profile_seconds 秒，结果写入日志
+            def on_signal(signum, frame):
+                threading.Thread(
+                    target=lambda: logging.info(self.profiler.sample(config.signal_profile_seconds)), daemon=True
+                ).start()
+
+            signal.signal(signal.SIGUSR1, on_signal)
+
+    def export_traces(self, query):
+        '''
+        GET /traces 返回 Chrome trace-event JSON，?clear=1 导出后清空缓冲区
+        '''
+        traces = json.dumps(self.tracer.export())
+        if query.get('clear') == ['1']:
+            self.tracer.clear()
+        return traces
+
+    def register_metrics(self):
+        '''
+        状态类指标在抓取时才计算
+        '''
+        metrics = Metrics()
+        online_users = self.user_manager.online_users
+        handler = self.messagehandler
+
+        def queue_depths():
+            depths = [queue.depth() for queue in list(MessageServer.outbound_queues.values())]
+            return {('total', ): sum(depths), ('max', ): max(depths, default=0)}
+
+        metrics.gauge('chat_sessions', 'Online sessions (devices)', online_users.session_count)
+        metrics.gauge('chat_online_users', 'Online users', online_users.online_count)
+        metrics.gauge('chat_connections', 'Open message connections', lambda: len(MessageServer.outbound_queues))
+        metrics.gauge('chat_outbound_queue_frames', 'Frames waiting in outbound queues', queue_depths, ('stat', ))
+        metrics.gauge('chat_unacked_messages', 'Messages waiting for ack', handler.delivery.total_unacked)
+        metrics.gauge(
+            'chat_offline_files', 'Files waiting for offline receivers',
+            lambda: sum(len(queue) for queue in list(handler.message_queues.values()))
+        )
+        metrics.gauge('chat_fanout_backlog', 'Group fan-out jobs waiting', handler.fanout_pool.backlog)
+        metrics.gauge(
+            'chat_fanout_completed_total', 'Group fan-out jobs completed', lambda: handler.fanout_pool.completed,
+            type='counter'
+        )
+        metrics.gauge(
+            'chat_file_transfers_active', 'File transfers in progress', lambda: self.file_transfer_server.active
+        )
+        metrics.gauge(
+            'chat_file_transfers_pending', 'File transfer tickets waiting for the client to connect',
+            self.file_transfer_server.pending
+        )
+        if handler.admission is not None:
+            metrics.gauge(
+                'chat_admission_latency_seconds', 'Smoothed handler latency used for load shedding',
+                handler.admission.latency
+            )
+        friend_cache = self.user_manager.friend_cache
+        metrics.gauge('chat_friend_cache_entries', 'Friend cache entries', lambda: friend_cache.entries)
+        metrics.gauge(
+            'chat_friend_cache_requests_total', 'Friend cache lookups',
+            lambda: {('hit', ): friend_cache.hits, ('miss', ): friend_cache.misses}, ('result', ), type='counter'
+        )
+
 
 class MessageServer:
+    # socket -> OutboundQueue，所有发往客户端的消息都经过对应的发送队列
+    outbound_queues = {}
+    # 正在进行的流量记录，见 capture.py
+    capture = None
 
     def __init__(self, manager_instance):
         config = Config()
@@ -41,27 +169,54 @@ class MessageServer:
         self.port = config.message_port
         self.timeout = config.heartbeat_timeout
         self.socket_timeout = config.socket_timeout
+        self.listen_backlog = config.listen_backlog
         self.manager_instace = manager_instance
         self.user_manager = manager_instance.user_manager
         self.messagehandler = manager_instance.messagehandler
+        self.tls_context = manager_instance.tls_context
+        self.compression_algorithms = []
+        if config.compression_enabled == 'True':
+            available = Compression.available()
+            self.compression_algorithms = [
+                algorithm for algorithm in config.compression_algorithms if algorithm in available
+            ]
+        self.compression_min_size = config.compression_min_size
+        self.compression_level = config.compression_level
+        self.file_compression = config.file_compression == 'True'
 
     def handle_client(self, client_socket, client_address):
         client_socket.settimeout(self.socket_timeout)
+        if self.tls_context is not None:
+            try:
+                client_socket = tls.TLSConnection(tls.handshake(self.tls_context, client_socket, 'message'))
+            except OSError as e:
+                logging.info(f"TLS handshake with {client_address} failed: {e}")
+                client_socket.close()
+                return
+        MessageServer.outbound_queues[client_socket] = OutboundQueue(client_socket)
         last_heartbeat_time = datetime.now()
         config = Config()
         is_json_format = config.is_json_format
         default_chunk_size = config.default_chunk_size
-        username = None
+        frame_buffer = FrameBuffer()
+        metrics = Metrics()
+        tracer = Tracer()
         while True:
             try:
                 if client_socket is None:
                     raise ConnectionResetError                
-                json_data = client_socket.recv(10 * default_chunk_size).decode('utf-8')
-                if not json_data:
+                data = client_socket.recv(10 * default_chunk_size)
+                received = time.perf_counter()
+                if not data:
                     raise ConnectionResetError
-                logging.debug(f"[Received data]: {json_data}")
-                message_json_list = json_data.split('!@#')
-                for message_json in message_json_list[:-1]:
+                logging.debug(f"[Received data]: {data}")
+                compressed = isinstance(frame_buffer, FrameCodec)
+                if compressed:
+                    metrics.inc('chat_compression_bytes_total', ('in', 'wire'), len(data))
+                for message_json in frame_buffer.feed(data):
+                    if compressed:
+                        metrics.inc('chat_compression_bytes_total', ('in', 'raw'), len(message_json))
+                    message_json = message_json.decode('utf-8')
                     message = json.loads(message_json)
                     formatted_json = json.dumps(message, indent=2)
                     if is_json_format == 'True':
@@ -70,85 +225,273 @@ class MessageServer:
                         logging.debug(f"[Received Message]: {message_json}")
                     last_heartbeat_time = datetime.now()
                     type = message['type']
+                    metrics.inc('chat_frames_received_total', (MessageHandler.metric_label(message.get('action') or type), ))
+                    capture = MessageServer.capture
+                    if capture is not None:
+                        capture.record(client_socket, message)
+                    trace = None
+                    if tracer.enabled:
+                        trace = tracer.start(message, received)
+                        if trace is not None:
+                            trace.stamp('dispatch')
+                        tracer.activate(trace)
                     if type == 'heartbeat':
-                        MessageServer.send_message(client_socket, mb.build_heartbeat('server'))
-                        if username is None:
-                            username = message['who']
-                            self.user_manager.set_online(username, client_socket)
-                        elif username != message['who']:
-                            self.user_manager.set_offline(username)
-                            username = message['who']
-                            self.user_manager.set_online(username, client_socket)
+                        # 心跳只刷新连接的存活时间，身份只能通过 login / resume_session 绑定，
+                        # 与连接身份不符的心跳直接丢弃
+                        owner = self.user_manager.online_users.owner(client_socket)
+                        if owner is None or message.get('who') == owner:
+                            MessageServer.send_message(client_socket, mb.build_heartbeat('server'))
+                        else:
+                            logging.warning(f"Heartbeat from {client_address} claims {message.get('who')}, owner is {owner}")
+                    elif type == 'ack':
+                        self.messagehandler.handle_ack(message, client_socket)
+                    elif type == 'hello':
+                        frame_buffer = self.negotiate(message, client_socket, frame_buffer)
                     else:
-                        self.messagehandler.handle_message(message, client_socket)
-            except json.JSONDecodeError as e:
-                logging.error(str(e))
+                        self.messagehandler.handle_message(message, client_socket, client_address[0])
+                    if trace is not None:
+                        tracer.activate(None)
+            except ValueError as e:
+                # JSON 或 UTF-8 解码失败、帧超过上限、压缩数据损坏
+                logging.error(f"Bad frame from {client_address}: {e}")
+                self.user_manager.drop_session(client_socket)
                 client_socket.close()
                 break
             except socket.timeout:
                 if (datetime.now() - last_heartbeat_time).total_seconds() > self.timeout:
                     logging.info(f"Connection with {client_address} is closed.")
-                    if username: self.user_manager.set_offline(username)
+                    self.user_manager.drop_session(client_socket)
                     client_socket.close()
             except ConnectionResetError:
                 logging.info(f"Connection with {client_address} is closed.")
-                if username: self.user_manager.set_offline(username)
+                self.user_manager.drop_session(client_socket)
                 client_socket.close()
                 break
             except socket.error:
                 logging.info(f"Connection with {client_address} is closed.")
+                self.user_manager.drop_session(client_socket)
                 client_socket.close()
                 break
             except Exception as e:
                 logging.error(str(e))
+        MessageServer.outbound_queues.pop(client_socket, None)
+        capture = MessageServer.capture
+        if capture is not None:
+            capture.connection_closed(client_socket)
+
+    def negotiate(self, message, client_socket, frame_buffer):
+        '''
+        客户端在发送其他消息之前发送 hello，服务器按自己的优先顺序选择一个双方都支持的算法并回复（不压缩），
+        之后两个方向都使用 FrameCodec；返回之后用于拆分收到的数据的对象
+        '''
+        offered = message.get('compression') or []
+        algorithm = next((algorithm for algorithm in self.compression_algorithms if algorithm in offered), None)
+        files = algorithm is not None and self.file_compression and bool(message.get('file_compression'))
+        reply = mb.build_hello(algorithm, files)
+        if algorithm is None:
+            MessageServer.send_message(client_socket, reply)
+            return frame_buffer
+        codec = FrameCodec(algorithm, self.compression_min_size, self.compression_level, files)
+        outbound_queue = MessageServer.outbound_queues[client_socket]
+        Metrics().inc('chat_frames_sent_total', ('hello', ))
+        # hello 之后的帧才压缩，即使其他线程正在向该连接发送，hello 也不会被压缩
+        outbound_queue.put(MessageServer.encode_message(reply), codec=codec)
+        logging.debug(f"Compression {algorithm} negotiated, file compression {files}")
+        return codec
+
+    @staticmethod
+    def accepts_file_compression(client_socket):
+        outbound_queue = MessageServer.outbound_queues.get(client_socket)
+        return outbound_queue is not None and outbound_queue.codec is not None and outbound_queue.codec.files
 
     @staticmethod
     def send_message(client_socket, message):
         if message is None:
             return
+        return MessageServer.send_bytes(
+            client_socket, MessageServer.encode_message(message), message.get('action') or message.get('type')
+        )
+
+    @staticmethod
+    def encode_message(message):
+        '''
+        将消息编码为带分隔符的字节串，群发时只编码一次，所有接收者共用同一份字节
+        '''
         config = Config()
         is_json_format = config.is_json_format
         message_json = json.dumps(message)
-        formatted_json = json.dumps(message, indent=2)
-        if is_json_format == 'True':
-            logging.debug(f"[Send Message]: {formatted_json}")
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            if is_json_format == 'True':
+                logging.debug(f"[Send Message]: {json.dumps(message, indent=2)}")
+            else:
+                logging.debug(f"[Send Message]: {message_json}")
+        return message_json.encode('utf-8') + Protocol.DELIMITER
+
+    @staticmethod
+    def send_bytes(client_socket, data, action='other', trace=None):
+        '''
+        trace 默认为当前线程正在处理的请求，群消息由投递线程发送，需要显式传入
+        '''
+        Metrics().inc('chat_frames_sent_total', (action, ))
+        trace = trace or Tracer().current()
+        on_sent = None
+        if trace is not None:
+            trace.stamp('enqueue', action)
+            on_sent = functools.partial(trace.stamp, 'write', action)
+        outbound_queue = MessageServer.outbound_queues.get(client_socket)
+        if outbound_queue is None:
+            client_socket.sendall(data)
+            if on_sent is not None:
+                on_sent()
         else:
-            logging.debug(f"[Send Message]: {message_json}")
-        message_json = message_json + '!@#'
-        return client_socket.send(message_json.encode('utf-8'))
+            outbound_queue.put(data, on_sent)
+        return len(data)
+
+    @staticmethod
+    def start_capture(path):
+        if MessageServer.capture is not None:
+            return f'Already capturing to {MessageServer.capture.path}'
+        MessageServer.capture = WireCapture(path)
+        atexit.register(MessageServer.stop_capture)  # 服务器退出时写完文件
+        logging.info(f'Capturing inbound frames to {path}')
+        return f'Capturing to {path}'
+
+    @staticmethod
+    def stop_capture():
+        capture, MessageServer.capture = MessageServer.capture, None
+        if capture is None:
+            return 'Not capturing'
+        result = capture.close()
+        logging.info(result)
+        return result
 
     def start(self):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # 重启时旧连接仍处于 TIME_WAIT，允许立即重新绑定端口，客户端才能重连
+        server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind((self.host, self.port))
-        server_socket.listen(5)
-        logging.info(f"Server started on {self.host}:{self.port}")
+        # 大量客户端同时连接（重连、压测）时，过小的等待队列会导致连接被丢弃或重置
+        server_socket.listen(self.listen_backlog)
+        logging.info(f"Server started on {self.host}:{self.port}{' (TLS)' if self.tls_context else ''}")
         while True:
             client_socket, client_address = server_socket.accept()
+            Metrics().inc('chat_connections_accepted_total')
             logging.info(f"Client connected from {client_address[0]}:{client_address[1]}")
             client_handler = threading.Thread(target=self.handle_client, args=(client_socket, client_address))
             client_handler.start()
 
 
 class MessageHandler:
+    # 不需要已登录会话的请求，其余请求中的 username/sender 必须是该连接的会话所属用户
+    ANONYMOUS_ACTIONS = frozenset(('login', 'resume_session', 'register', 'delete_account', 'logout'))
+    # 指标标签只使用已知的 action 和帧类型，客户端发来的其他取值都记为 other，时间序列数量有上限
+    METRIC_LABELS = frozenset((
+        'login', 'resume_session', 'logout', 'register', 'delete_account', 'send_personal_message', 'add_friend',
+        'get_friends', 'remove_friend', 'file_transfer', 'create_group', 'join_group', 'leave_group', 'get_groups',
+        'send_group_messager', 'heartbeat', 'ack', 'hello'
+    ))
 
     def __init__(self, manager_instance):
         self.manager_instance = manager_instance
         self.user_manager = self.manager_instance.user_manager
+        self.group_manager = self.manager_instance.group_manager
         self.file_transfer_server = self.manager_instance.file_transfer_server
-        self.message_queues = {}
+        self.message_queues = {}  # 离线接收者 -> [OfflineFile]
         config = Config()
-        self.file_transfer_interval = config.file_transfer_interval
+        self.fanout_pool = FanoutPool(config.fanout_workers, config.fanout_report_interval)
+        self.delivery = DeliveryTracker(config.max_unacked, config.dedup_window, config.max_offline)
+        self.watchdog = Watchdog()
+        self.profiler = self.manager_instance.profiler
+        self.rate_limiter = None
+        self.rate_limit_max_defer = config.rate_limit_max_defer
+        if config.rate_limit_enabled == 'True':
+            self.rate_limiter = RateLimiter(config.rate_limits)
+        self.admission = None
+        if config.admission_enabled == 'True':
+            self.admission = AdmissionController(
+                config.admission_latency_threshold, config.admission_low_priority_actions,
+                config.admission_ignored_actions
+            )
+
+    @classmethod
+    def metric_label(cls, action):
+        return action if action in cls.METRIC_LABELS else 'other'
+
+    def handle_message(self, message, client_socket, client_ip=None):
+        '''
+        限流和过载保护检查通过后再处理，记录处理耗时，超过预算时由 Watchdog 报告
+        '''
+        action = message.get('action') or message['type']
+        label = self.metric_label(action)
+        request_data = message.get('request_data') or {}
+        rejection = self.__check_admission(action, label, client_socket, client_ip)
+        if rejection is not None:
+            reason, retry_after = rejection
+            Metrics().inc('chat_rejected_requests_total', (reason, label))
+            response_text = 'Too many requests, please retry later' if reason == 'rate_limit' else \
+                'Server is busy, please retry later'
+            MessageServer.send_message(
+                client_socket,
+                mb.build_response(False, response_text, message.get('timestamp'), {'retry_after': retry_after})
+            )
+            return
+        started = time.perf_counter()
+        watch = self.watchdog.begin('handler', label, request_data.get('username') or request_data.get('sender'))
+        trace = Tracer().current()
+        if trace is not None:
+            trace.stamp('handler_start')
+        profile = None
+        try:
+            profile = self.profiler.enter()
+            self.__dispatch(message, client_socket)
+        finally:
+            self.profiler.exit(profile)
+            self.watchdog.end(watch)
+            if trace is not None:
+                trace.stamp('handler_end')
+            elapsed = time.perf_counter() - started
+            Metrics().observe('chat_handler_seconds', elapsed, (label, ))
+            if self.admission is not None:
+                self.admission.record(action, elapsed)
 
-    def handle_message(self, message, client_socket):
+    def __check_admission(self, action, label, client_socket, client_ip):
+        '''
+        返回 None 表示放行，否则返回 (原因, 建议的重试等待秒数)
+        user 规则只用于已登录连接的会话所属用户；登录、注册等请求中的用户名由客户端任意填写，
+        按它限流会让别人耗尽该用户的令牌，因此未登录的请求只按客户端地址和全局规则限流
+        '''
+        if self.rate_limiter is not None:
+            user = self.user_manager.online_users.owner(client_socket)
+            retry_after, scope = self.rate_limiter.check(action, user, client_ip)
+            if retry_after and retry_after <= self.rate_limit_max_defer and scope != 'global' and user is not None:
+                # 已登录连接自己的令牌短暂不足时暂停读取该连接直到有令牌，而不是拒绝：
+                # 超限的客户端被 TCP 反压减速，不再占用服务器解码和响应的开销
+                # global 规则超限时所有连接都会受影响，未登录的请求（登录、恢复会话）不应占住连接线程，都直接拒绝
+                Metrics().inc('chat_deferred_requests_total', (label, ))
+                time.sleep(retry_after)
+                retry_after, scope = self.rate_limiter.check(action, user, client_ip)
+            if retry_after:
+                return 'rate_limit', round(retry_after, 3)
+        if self.admission is not None and not self.admission.admit(action):
+            return 'overload', self.admission.decay
+        return None
+
+    def __dispatch(self, message, client_socket):
         type = message['type']
         response = None
         if type == 'request':
             action = message['action']
+            error = self.__authorize(action, message.get('request_data') or {}, client_socket)
+            if error is not None:
+                MessageServer.send_message(client_socket, mb.build_response(False, error, message.get('timestamp')))
+                return
             match action:
                 case 'login':
                     response = self.handle_login(message['request_data'], message['timestamp'], client_socket)
+                case 'resume_session':
+                    response = self.handle_resume_session(message['request_data'], message['timestamp'], client_socket)
                 case 'logout':
-                    response = self.handle_logout(message)
+                    response = self.handle_logout(message, client_socket)
                 case 'register':
                     response = self.handle_register(message['request_data'], message['timestamp'])
                 case 'delete_account':
@@ -162,46 +505,125 @@ class MessageHandler:
                 case 'remove_friend':
                     response = self.handle_remove_friend(message['request_data'], message['timestamp'])
                 case 'file_transfer':
-                    response = self.handle_file_transfer(message['request_data'], message['timestamp'])
+                    response = self.handle_file_transfer(
+                        message['request_data'], message['timestamp'], client_socket
+                    )
+                case 'create_group':
+                    response = self.handle_create_group(message['request_data'], message['timestamp'], client_socket)
+                case 'join_group':
+                    response = self.handle_join_group(message['request_data'], message['timestamp'], client_socket)
+                case 'leave_group':
+                    response = self.handle_leave_group(message['request_data'], message['timestamp'], client_socket)
+                case 'get_groups':
+                    response = self.handle_get_groups(message['request_data'], message['timestamp'], client_socket)
+                case 'send_group_messager':
+                    response = self.handle_send_group_message(
+                        message['request_data'], message['timestamp'], client_socket
+                    )
         if response:
             MessageServer.send_message(client_socket, response)
 
+    def __authorize(self, action, request_data, client_socket):
+        '''
+        返回错误信息，通过时返回 None
+        '''
+        if action in self.ANONYMOUS_ACTIONS:
+            return None
+        owner = self.user_manager.online_users.owner(client_socket)
+        if owner is None:
+            return 'Not logged in'
+        claimed = request_data.get('username') or request_data.get('sender')
+        if claimed != owner:
+            logging.warning(f'{owner} sent {action} as {claimed}')
+            return 'Session does not belong to this user'
+        return None
+
+    def redeliver(self, username, client_socket):
+        '''
+        登录后立即补发所有未确认的私聊和群聊消息，离线文件仍由 send_offline_messages 发送
+        '''
+        for payload in self.delivery.pending(username):
+            MessageServer.send_bytes(client_socket, payload, 'redelivery')
+        if self.message_queues.get(username):
+            threading.Thread(target=self.send_offline_messages, args=(username, client_socket)).start()
+
+    def disconnect_slow_receiver(self, username, client_sockets):
+        '''
+        接收者未确认的消息超过 max_unacked：消息仍然保留，断开其在线连接（接收者不读或不确认），
+        客户端重连登录后由 redeliver 全部补发；离线的接收者只计数
+        返回仍然可以投递的连接（总是为空）
+        '''
+        Metrics().inc('chat_unacked_overflow_total', ('disconnected' if client_sockets else 'offline', ))
+        for client_socket in client_sockets:
+            logging.warning(
+                f'{username} has more than {self.delivery.max_unacked} unacknowledged messages, disconnecting'
+            )
+            self.user_manager.set_offline(username, client_socket)
+            try:
+                client_socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        return []
+
     def send_offline_messages(self, username, client_socket):
         time.sleep(5)
-        if self.message_queues.get(username):
-            for message in self.message_queues.get(username):
-                type = message['type']
-                if type == 'personal_message':
-                    personal_message = message['data']
-                    MessageServer.send_message(client_socket, personal_message)
-                elif type == 'file':
-                    request_data = message['data']
-                    file_path = message['file_path']
-                    message = mb.build_send_file_request(
-                        request_data['sender'], request_data['receiver'], request_data['file_name'],
-                        request_data['file_size'], request_data['timestamp'], request_data['chunk_size']
-                    )
+        # 先整体取出再发送，发送期间新到达的离线文件进入新的列表，不会随本次 pop 丢失
+        offline_files = self.message_queues.pop(username, None)
+        if offline_files:
+            for index, offline_file in enumerate(offline_files):
+                # 下载凭证每次发送时重新生成，文件通知只能在此时编码
+                compression = None
+                if MessageServer.accepts_file_compression(client_socket) and \
+                        Compression.is_file_compressible(offline_file.file_path):
+                    compression = 'zlib'
+                download = self.file_transfer_server.open(
+                    'download', offline_file.file_path, offline_file.chunk_size, compression=compression
+                )
+                message = mb.build_send_file_request(
+                    offline_file.sender, username, offline_file.file_name, offline_file.file_size,
+                    offline_file.timestamp, offline_file.chunk_size, download.ticket, compression
+                )
+                try:
                     self.manager_instance.message_server.send_message(client_socket, message)
-                    time.sleep(0.3)
-                    self.file_transfer_server.send_file(file_path, request_data['chunk_size'])
-                time.sleep(0.3)
-            self.message_queues.pop(username)
+                except OSError:
+                    # 连接已经断开，未发送的文件放回队列，下次登录时再发送
+                    self.message_queues[username] = offline_files[index:] + self.message_queues.get(username, [])
+                    return
 
     def handle_login(self, request_data, request_timestamp, client_socket):
         username = request_data.get('username')
         password = request_data.get('password')
         success, response_text = self.user_manager.login_user(username, password)
-        if success:
-            self.user_manager.set_online(username, client_socket)
-        threading.Thread(target=self.send_offline_messages, args=(username, client_socket)).start()
-        return mb.build_response(success, response_text, request_timestamp)
+        if not success:
+            return mb.build_response(success, response_text, request_timestamp)
+        self.user_manager.set_online(username, client_socket)
+        response_data = {'session_token': self.user_manager.issue_session_token(username)}
+        # 先发送登录响应，再补发未确认的消息
+        MessageServer.send_message(
+            client_socket, mb.build_response(success, response_text, request_timestamp, response_data)
+        )
+        self.redeliver(username, client_socket)
 
-    def handle_logout(self, message):
-        request_data = message['request_data']
-        request_timestamp = message['timestamp']
+    def handle_resume_session(self, request_data, request_timestamp, client_socket):
         username = request_data.get('username')
-        if self.user_manager.is_online(username):
-            self.user_manager.set_offline(username)
+        session_token = request_data.get('session_token')
+        success, response_text = self.user_manager.resume_session(username, session_token)
+        if not success:
+            return mb.build_response(success, response_text, request_timestamp)
+        self.user_manager.set_online(username, client_socket)
+        # 续签令牌，长期在线的客户端不会因为过期而被迫重新输入密码
+        response_data = {'session_token': self.user_manager.issue_session_token(username)}
+        MessageServer.send_message(
+            client_socket, mb.build_response(success, response_text, request_timestamp, response_data)
+        )
+        self.redeliver(username, client_socket)
+
+    def handle_logout(self, message, client_socket):
+        request_timestamp = message['timestamp']
+        # 只退出当前设备，其他设备保持在线；退出的是该连接的会话，而不是请求中声明的用户
+        username = self.user_manager.online_users.owner(client_socket)
+        if username is not None:
+            self.user_manager.set_offline(username, client_socket)
         return mb.build_response(True, 'logout success', request_timestamp)
 
     def handle_register(self, request_data, request_timestamp):
@@ -217,20 +639,49 @@ class MessageHandler:
         return mb.build_response(success, response_text, request_timestamp)
 
     def handle_send_personal_message(self, request_data, request_timestamp):
+        sender = request_data.get('sender')
         receiver = request_data.get('receiver')
-        if self.user_manager.is_online(receiver):
-            receiver_client = self.user_manager.get_socket(receiver)
-            success = MessageServer.send_message(receiver_client, request_data)
-            if success: response_text = 'send success'
+        receiver_clients = self.user_manager.get_sockets(receiver)
+        if not receiver_clients and not self.user_manager.is_username_exist(receiver):
+            return mb.build_response(False, 'User is not exist', request_timestamp)
+        if not receiver_clients and not self.delivery.accepts(receiver):
+            # 离线接收者积压的消息有上限，超过后拒绝，由发送者决定是否稍后再发
+            Metrics().inc('chat_unacked_overflow_total', ('rejected', ))
+            return mb.build_response(False, 'Receiver has too many undelivered messages', request_timestamp)
+        conversation = self.delivery.personal_conversation(sender, receiver)
+        seq, duplicate = self.delivery.assign(sender, request_data.get('message_id'), conversation)
+        response_data = {'conversation': conversation, 'seq': seq}
+        if duplicate:
+            # 客户端重试的消息已经处理过，不再重复投递
+            return mb.build_response(True, 'Duplicate message ignored', request_timestamp, response_data)
+        payload = MessageServer.encode_message(
+            dict(request_data, conversation=conversation, seq=seq, epoch=self.delivery.epoch)
+        )
+        # 在接收者 ack 之前一直保留，重新登录时补发
+        if self.delivery.track(receiver, conversation, seq, payload):
+            receiver_clients = self.disconnect_slow_receiver(receiver, receiver_clients)
+        if receiver_clients:
+            # 投递到接收者的每一个在线设备
+            for receiver_client in receiver_clients:
+                try:
+                    MessageServer.send_bytes(receiver_client, payload, 'personal_message')
+                except OSError as e:
+                    logging.info(f'Failed to deliver message to {receiver}: {e}')
+            success, response_text = True, 'send success'
         else:
-            offline_message = {
-                'type': 'personal_message',
-                'data': request_data,
-                'timestamp': request_timestamp
-            }
-            self.message_queues.setdefault(receiver, []).append(offline_message)
             success, response_text = True, 'Receiver is not Online, message will be sent when receiver is online'
-        return mb.build_response(success, response_text, request_timestamp)
+        return mb.build_response(success, response_text, request_timestamp, response_data)
+
+    def handle_ack(self, message, client_socket):
+        '''
+        客户端确认收到消息，acks: {conversation: seq}，确认每个会话中 seq 及之前的全部消息
+        接收者是该连接经 login / resume_session 认证的用户，只能确认发给自己的消息
+        '''
+        recipient = self.user_manager.online_users.owner(client_socket)
+        if recipient is None or message.get('epoch') != self.delivery.epoch:
+            return
+        for conversation, seq in message.get('acks', {}).items():
+            self.delivery.ack(recipient, conversation, seq)
 
     def handle_add_friend(self, request_data, request_timestamp):
         username = request_data.get('username')
@@ -240,103 +691,434 @@ class MessageHandler:
 
     def handle_get_friends(self, request_data, request_timestamp):
         username = request_data.get('username')
+        if 'version' in request_data:
+            return self.handle_sync_friends(username, request_data['version'], request_timestamp)
         success, response_text, response_data = self.user_manager.get_friends(username)
         user_status_dict = {}
-        for user in response_data:
+        for user in response_data or []:
             status = self.user_manager.is_online(user)
             user_status_dict[user] = status
         return mb.build_response(success, response_text, request_timestamp, user_status_dict)
 
+    def handle_sync_friends(self, username, version, request_timestamp):
+        '''
+        带版本号的好友列表同步：版本未变化时只返回在线好友，
+        能够增量同步时只返回新增和删除的好友，否则返回完整列表
+        '''
+        friend_versions = self.user_manager.friend_versions
+        current_version = friend_versions.current(username)
+        success, response_text, friends = self.user_manager.get_friends(username)
+        if not success:
+            return mb.build_response(success, response_text, request_timestamp)
+        online = [friend for friend in friends if self.user_manager.is_online(friend)]
+        diff = friend_versions.diff(username, version)
+        if diff is None:
+            friend_status = {friend: self.user_manager.is_online(friend) for friend in friends}
+            response_data = mb.build_friends_sync_data(current_version, friends=friend_status)
+        else:
+            current_version, added, removed = diff
+            if not added and not removed:
+                response_text = 'Friends list not modified'
+                response_data = mb.build_friends_sync_data(current_version, online=online)
+            else:
+                added = {friend: self.user_manager.is_online(friend) for friend in added}
+                response_data = mb.build_friends_sync_data(
+                    current_version, added=added, removed=list(removed), online=online
+                )
+        return mb.build_response(success, response_text, request_timestamp, response_data)
+
     def handle_remove_friend(self, request_data, request_timestamp):
         username = request_data.get('username')
         friend = request_data.get('friend')
         success, response_text = self.user_manager.remove_friend(username, friend)
         return mb.build_response(success, response_text, request_timestamp)
 
-    def handle_file_transfer(self, request_data, request_timestamp):
+    # 群操作都以该连接的会话所属用户执行，不使用请求中的 username
+    def handle_create_group(self, request_data, request_timestamp, client_socket):
+        username = self.user_manager.online_users.owner(client_socket)
+        group = request_data.get('group')
+        success, response_text = self.group_manager.create_group(username, group)
+        return mb.build_response(success, response_text, request_timestamp)
+
+    def handle_join_group(self, request_data, request_timestamp, client_socket):
+        username = self.user_manager.online_users.owner(client_socket)
+        group = request_data.get('group')
+        success, response_text = self.group_manager.join_group(username, group)
+        return mb.build_response(success, response_text, request_timestamp)
+
+    def handle_leave_group(self, request_data, request_timestamp, client_socket):
+        username = self.user_manager.online_users.owner(client_socket)
+        group = request_data.get('group')
+        success, response_text = self.group_manager.leave_group(username, group)
+        return mb.build_response(success, response_text, request_timestamp)
+
+    def handle_get_groups(self, request_data, request_timestamp, client_socket):
+        username = self.user_manager.online_users.owner(client_socket)
+        groups = self.group_manager.get_groups(username)
+        return mb.build_response(True, 'Get groups list successfully', request_timestamp, groups)
+
+    def handle_send_group_message(self, request_data, request_timestamp, client_socket):
+        sender = request_data.get('sender')
+        group = request_data.get('group')
+        members = self.group_manager.get_members(group)
+        if members is None:
+            return mb.build_response(False, 'Group is not exist', request_timestamp)
+        if sender not in members:
+            return mb.build_response(False, 'Not a member of this group', request_timestamp)
+        conversation = self.delivery.group_conversation(group)
+        seq, duplicate = self.delivery.assign(sender, request_data.get('message_id'), conversation)
+        if duplicate:
+            return mb.build_response(
+                True, 'Duplicate message ignored', request_timestamp, {'conversation': conversation, 'seq': seq}
+            )
+        # 只编码一次，所有成员共用同一份字节，未确认消息表中保存的是同一个对象的引用
+        payload = MessageServer.encode_message(
+            dict(request_data, conversation=conversation, seq=seq, epoch=self.delivery.epoch)
+        )
+
+        trace = Tracer().current()
+
+        def deliver(member):
+            member_clients = self.user_manager.get_sockets(member)
+            if not member_clients and not self.delivery.accepts(member):
+                Metrics().inc('chat_unacked_overflow_total', ('rejected', ))
+                return 'failed'  # 离线成员积压已满，计入 group_delivery 事件的 failed
+            if self.delivery.track(member, conversation, seq, payload):
+                member_clients = self.disconnect_slow_receiver(member, member_clients)
+            if not member_clients:
+                return 'queued'
+            success = False
+            for member_client in member_clients:
+                try:
+                    MessageServer.send_bytes(member_client, payload, 'group_message', trace)
+                    success = True
+                except OSError as e:
+                    logging.info(f'Failed to deliver group message to {member}: {e}')
+            return 'delivered' if success else 'failed'
+
+        def on_complete(job):
+            event = mb.build_group_delivery_event(
+                group, request_timestamp, job.delivered, job.queued, job.failed
+            )
+            try:
+                MessageServer.send_message(client_socket, event)
+            except OSError:
+                pass
+
+        # 投递交给后台线程，发送者立即得到 accepted 响应，投递完成后再收到 group_delivery 事件
+        recipients = [member for member in members if member != sender]
+        MessageServer.send_message(client_socket, mb.build_response(
+            True, 'Group message accepted', request_timestamp,
+            {'recipients': len(recipients), 'conversation': conversation, 'seq': seq}
+        ))
+        self.fanout_pool.submit(recipients, deliver, on_complete)
+
+    def handle_file_transfer(self, request_data, request_timestamp, client_socket):
+        '''
+        立即返回上传凭证，数据收发由 FileTransferServer 的传输线程完成，
+        结果通过 file_transfer_status 事件通知发送者，传输期间该连接照常处理其他请求
+        '''
         receiver = request_data.get('receiver')
         file_name = request_data.get('file_name')
-        file_size = request_data.get('file_size')
         chunk_size = request_data.get('chunk_size')
         destination_folder = f'server_files/{receiver}'
         if not os.path.exists(destination_folder):
             os.makedirs(destination_folder)
         file_path = os.path.join(destination_folder, file_name)
-        success = self.file_transfer_server.receive_file(file_path, chunk_size)
-        if not success:
-            return mb.build_response(False, 'File transfer failed', request_timestamp)
-        if self.user_manager.is_online(receiver):
-            receiver_client = self.user_manager.get_socket(receiver)
-            message = mb.build_send_file_request(
-                request_data['sender'], receiver, file_name, file_size, request_data['timestamp'], chunk_size
-            )
-            self.manager_instance.message_server.send_message(receiver_client, message)
-            time.sleep(0.5)
-            success = self.file_transfer_server.send_file(file_path, chunk_size)
-            if success:
-                response_text = 'File transfer success'
-            else:
-                response_text = 'File transfer failed'
-            return mb.build_response(success, response_text, request_timestamp)
-        else:
-            offline_message = {
-                'type': 'file',
-                'data': request_data,
-                'timestamp': request_timestamp,
-                'file_path': file_path
-            }
-            self.message_queues.setdefault(receiver, []).append(offline_message)
-            return mb.build_response(
-                True, 'Receiver is not Online, file will be transfered when receiver is online',
-                request_timestamp
-            )
+        compression = request_data.get('compression')
+        if compression is not None and \
+                (compression != 'zlib' or not MessageServer.accepts_file_compression(client_socket)):
+            return mb.build_response(False, 'File compression was not negotiated', request_timestamp)
+        upload = self.file_transfer_server.open(
+            'upload', file_path, chunk_size, request_data.get('file_size'), compression
+        )
+
+        def notify(status):
+            event = mb.build_file_transfer_event(upload.ticket, status, receiver, file_name, request_timestamp)
+            try:
+                MessageServer.send_message(client_socket, event)
+            except OSError:
+                pass
+
+        def on_uploaded(future):
+            if not future.result():
+                notify('failed')
+                return
+            receiver_clients = self.user_manager.get_sockets(receiver)
+            if not receiver_clients:
+                offline_file = OfflineFile(
+                    request_data['sender'], receiver, file_name, request_data.get('file_size'), chunk_size,
+                    request_data['timestamp']
+                )
+                self.message_queues.setdefault(sys.intern(receiver), []).append(offline_file)
+                notify('queued')
+                return
+            # 每个在线设备各自凭下载凭证连接文件端口下载一份，全部结束后通知发送者
+            # 启用了文件压缩的设备在文件可压缩时下载压缩流
+            accepts_compression = [MessageServer.accepts_file_compression(client) for client in receiver_clients]
+            compressible = any(accepts_compression) and Compression.is_file_compressible(file_path)
+            downloads = [
+                self.file_transfer_server.open(
+                    'download', file_path, chunk_size, compression='zlib' if compressible and accepts else None
+                ) for accepts in accepts_compression
+            ]
+            results = []
+            results_lock = threading.Lock()
+
+            def on_downloaded(future):
+                with results_lock:
+                    results.append(future.result())
+                    finished = len(results) == len(downloads)
+                if finished:
+                    notify('delivered' if all(results) else 'failed')
+
+            for receiver_client, download in zip(receiver_clients, downloads):
+                download.result.add_done_callback(on_downloaded)
+                message = mb.build_send_file_request(
+                    request_data['sender'], receiver, file_name, request_data.get('file_size'),
+                    request_data['timestamp'], chunk_size, download.ticket, download.compression
+                )
+                try:
+                    self.manager_instance.message_server.send_message(receiver_client, message)
+                except OSError as e:
+                    logging.info(f'Failed to notify {receiver} of file {file_name}: {e}')
+
+        upload.result.add_done_callback(on_uploaded)
+        return mb.build_response(True, 'File transfer accepted', request_timestamp, {'ticket': upload.ticket})
+
+
+METRICS_FLUSH_BYTES = 1024 * 1024
+FILE_BUFFER_BYTES = 256 * 1024  # 文件数据按大块读写，TLS 下每次写入可以拆成满长度的记录
+TICKET_BYTES = 32  # uuid4().hex
+
+
+class OfflineFile:
+    '''
+    等待离线接收者上线后发送的文件，只保存发送通知所需的字段
+    '''
+    __slots__ = ('sender', 'receiver', 'file_name', 'file_size', 'chunk_size', 'timestamp')
+
+    def __init__(self, sender, receiver, file_name, file_size, chunk_size, timestamp):
+        self.sender = sys.intern(sender)
+        self.receiver = sys.intern(receiver)
+        self.file_name = file_name
+        self.file_size = file_size
+        self.chunk_size = chunk_size
+        self.timestamp = timestamp
+
+    @property
+    def file_path(self):
+        return os.path.join(f'server_files/{self.receiver}', self.file_name)
+
+
+class FileTransfer:
+    '''
+    一次上传或下载，客户端连接文件端口后先发送 ticket，服务器据此找到对应的传输
+    size 为上传的预期大小，收到的字节数（解压后）不一致时视为失败
+    compression 为 'zlib' 时连接上传输的是 zlib 压缩流，服务器保存的始终是原始文件
+    result 在传输完成后设置为 True，失败或过期未连接时为 False
+    '''
+    __slots__ = ('ticket', 'kind', 'file_path', 'chunk_size', 'size', 'compression', 'created', 'result')
+
+    def __init__(self, kind, file_path, chunk_size, size=None, compression=None):
+        self.ticket = uuid.uuid4().hex
+        self.kind = kind
+        self.file_path = file_path
+        self.chunk_size = chunk_size
+        self.size = size
+        self.compression = compression
+        self.created = time.monotonic()
+        self.result = concurrent.futures.Future()
 
 
 class FileTransferServer:
+    '''
+    文件端口由独立的 accept 线程接受连接，数据收发在传输线程池中进行，不占用客户端的消息连接线程
+    tls_context 不为 None 时，TLS 握手也在传输线程中进行
+    '''
 
-    def __init__(self, manager_instance):
+    def __init__(self, manager_instance, tls_context=None):
         configparser = Config()
         self.host = configparser.host
         self.port = configparser.file_transfer_port
         self.manager_instance = manager_instance
+        self.tls_context = tls_context
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind((self.host, self.port))
-        self.socket.listen(5)
-    
-    def receive_file(self, file_path, chunk_size):
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(self.__receive_file, file_path, chunk_size)
-            return future.result()
-
-    def send_file(self, file_path, chunk_size):
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            future = executor.submit(self.__send_file, file_path, chunk_size)
-            return future.result()
-
-    def __receive_file(self, file_path, chunk_size):
-        client_socket, client_address = self.socket.accept()
-        logging.info(f"Client connected from {client_address[0]}:{client_address[1]}")
-        with open(file_path, 'wb') as f:
-            while True:
-                data = client_socket.recv(chunk_size)
-                if not data:
-                    break
-                f.write(data)
-        client_socket.close()
-        logging.info(f"File {file_path} received")
+        self.socket.listen(configparser.listen_backlog)
+        self.io_timeout = configparser.socket_timeout
+        self.ticket_timeout = configparser.file_ticket_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            configparser.file_transfer_workers, thread_name_prefix='file-transfer'
+        )
+        self.transfers = {}  # ticket -> 等待客户端连接的 FileTransfer
+        self.transfers_lock = threading.Lock()
+        self.active = 0  # 正在进行的传输数
+        self.active_lock = threading.Lock()
+        self.metrics = Metrics()
+
+    def start(self):
+        threading.Thread(target=self.__accept_loop, name='file-accept', daemon=True).start()
+        threading.Thread(target=self.__expire_loop, name='file-expire', daemon=True).start()
+        logging.info(f"File transfer server started on {self.host}:{self.port}{' (TLS)' if self.tls_context else ''}")
+
+    def open(self, kind, file_path, chunk_size, size=None, compression=None):
+        '''
+        登记一次 upload 或 download，返回 FileTransfer，客户端需要在 ticket_timeout 秒内连接
+        '''
+        transfer = FileTransfer(kind, file_path, chunk_size, size, compression)
+        with self.transfers_lock:
+            self.transfers[transfer.ticket] = transfer
+        return transfer
+
+    def pending(self):
+        return len(self.transfers)
+
+    def __accept_loop(self):
+        while True:
+            try:
+                client_socket, client_address = self.socket.accept()
+            except OSError:
+                return  # 监听 socket 已关闭
+            self.executor.submit(self.__handle, client_socket, client_address)
+
+    def __expire_loop(self):
+        while True:
+            time.sleep(min(self.ticket_timeout, 5))
+            now = time.monotonic()
+            with self.transfers_lock:
+                expired = [
+                    self.transfers.pop(ticket) for ticket, transfer in list(self.transfers.items())
+                    if now - transfer.created > self.ticket_timeout
+                ]
+            for transfer in expired:
+                logging.warning(f"File {transfer.kind} of {transfer.file_path} expired before the client connected")
+                self.__finish(transfer, False)
+
+    def __finish(self, transfer, success):
+        self.metrics.inc('chat_file_transfers_total', (transfer.kind, 'success' if success else 'failure'))
+        transfer.result.set_result(success)
+
+    def __handle(self, client_socket, client_address):
+        client_socket.settimeout(self.io_timeout)
+        if self.tls_context is not None:
+            # 客户端通常用消息连接上得到的会话票据恢复会话，只需简短握手
+            try:
+                client_socket = tls.handshake(self.tls_context, client_socket, 'file')
+            except OSError as e:
+                logging.info(f"TLS handshake with {client_address[0]}:{client_address[1]} failed: {e}")
+                client_socket.close()
+                return
+        transfer = None
+        success = False
+        try:
+            with client_socket:
+                try:
+                    ticket = self.__read_ticket(client_socket)
+                except OSError as e:
+                    logging.info(f"File connection from {client_address[0]}:{client_address[1]} failed: {e}")
+                    return
+                with self.transfers_lock:
+                    transfer = self.transfers.pop(ticket, None)
+                if transfer is None:
+                    logging.warning(f"Unknown file transfer ticket from {client_address[0]}:{client_address[1]}")
+                    return
+                logging.info(f"Client connected from {client_address[0]}:{client_address[1]} for {transfer.kind}")
+                self.__count_transfer(1)
+                try:
+                    if transfer.kind == 'upload':
+                        success = self.__receive_file(client_socket, transfer)
+                    else:
+                        success = self.__send_file(client_socket, transfer)
+                except (OSError, zlib.error, ValueError) as e:
+                    # zlib.error: 客户端发来的压缩数据损坏
+                    logging.error(f"File {transfer.kind} of {transfer.file_path} failed: {e}")
+                finally:
+                    self.__count_transfer(-1)
+        finally:
+            # 任何异常都要设置传输结果，否则等待结果的上传通知和离线文件队列永远不会完成
+            if transfer is not None:
+                self.__finish(transfer, success)
+
+    @staticmethod
+    def __read_ticket(client_socket):
+        data = b''
+        while len(data) < TICKET_BYTES:
+            chunk = client_socket.recv(TICKET_BYTES - len(data))
+            if not chunk:
+                raise ConnectionResetError('Connection closed before the ticket was sent')
+            data += chunk
+        return data.decode('ascii', 'replace')
+
+    def __count_transfer(self, delta):
+        with self.active_lock:
+            self.active += delta
+
+    def __receive_file(self, client_socket, transfer):
+        decompressor = zlib.decompressobj() if transfer.compression == 'zlib' else None
+        received = total = 0
+        try:
+            with open(transfer.file_path, 'wb') as f:
+                while True:
+                    data = client_socket.recv(max(transfer.chunk_size, FILE_BUFFER_BYTES))
+                    if not data:
+                        break
+                    received += len(data)
+                    # 解压时每次最多输出 FILE_BUFFER_BYTES，超过声明的大小后立即停止，很小的压缩数据也不会解压出大量数据
+                    while data:
+                        if decompressor is not None:
+                            limit = FILE_BUFFER_BYTES
+                            if transfer.size is not None:
+                                limit = min(limit, transfer.size - total + 1)
+                            chunk = decompressor.decompress(data, limit)
+                            data = decompressor.unconsumed_tail
+                        else:
+                            chunk, data = data, b''
+                        f.write(chunk)
+                        total += len(chunk)
+                        if transfer.size is not None and total > transfer.size:
+                            break
+                    if transfer.size is not None and total > transfer.size:
+                        break  # 超过声明的大小（包括解压后膨胀的数据），不再接收
+                    if received >= METRICS_FLUSH_BYTES:  # 按 1MB 累计后计数，不必每个分块都记录
+                        self.metrics.inc('chat_file_transfer_bytes_total', ('receive', ), received)
+                        received = 0
+                if decompressor is not None and (transfer.size is None or total <= transfer.size):
+                    data = decompressor.flush()
+                    f.write(data)
+                    total += len(data)
+        finally:
+            self.metrics.inc('chat_file_transfer_bytes_total', ('receive', ), received)
+        if transfer.size is not None and total != transfer.size:
+            logging.error(f"File {transfer.file_path} incomplete: {total} of {transfer.size} bytes")
+            return False
+        logging.info(f"File {transfer.file_path} received")
         return True
 
-    def __send_file(self, file_path, chunk_size=1024):
-        client_socket, client_address = self.socket.accept()
-        logging.info(f"Client connected from {client_address[0]}:{client_address[1]}")
-        with open(file_path, 'rb') as f:
-            while True:
-                data = f.read(chunk_size)
-                if not data:
-                    break
-                client_socket.send(data)
-        client_socket.close()
-        logging.info(f"File {file_path} sent")
+    def __send_file(self, client_socket, transfer):
+        compressor = zlib.compressobj(1) if transfer.compression == 'zlib' else None
+        sent = 0
+        try:
+            with open(transfer.file_path, 'rb') as f:
+                while True:
+                    data = f.read(max(transfer.chunk_size, FILE_BUFFER_BYTES))
+                    if not data:
+                        break
+                    if compressor is not None:
+                        data = compressor.compress(data)
+                    client_socket.sendall(data)
+                    sent += len(data)
+                    if sent >= METRICS_FLUSH_BYTES:
+                        self.metrics.inc('chat_file_transfer_bytes_total', ('send', ), sent)
+                        sent = 0
+                if compressor is not None:
+                    data = compressor.flush()
+                    client_socket.sendall(data)
+                    sent += len(data)
+        finally:
+            self.metrics.inc('chat_file_transfer_bytes_total', ('send', ), sent)
+        logging.info(f"File {transfer.file_path} sent")
         return True
 
 
@@ -352,6 +1134,9 @@ class Config:
         return cls._instance
 
     def __init__(self, config_file='./config.ini'):
+        # 单例只解析一次配置文件，避免每次发送消息都重新读取
+        if hasattr(self, 'config'):
+            return
         self.config = configparser.ConfigParser()
         self.config.read(config_file)
         if os.environ.get('LOCAL'):
@@ -365,10 +1150,79 @@ class Config:
         self.heartbeat_timeout = int(self.config['Server']['heartbeat_timeout'])
         self.default_chunk_size = int(self.config['Server']['default_chunk_size'])
         self.socket_timeout = int(self.config['Server']['socket_timeout'])
-        self.file_transfer_interval = float(self.config['Server']['file_transfer_interval'])
+        self.listen_backlog = int(self.config['Server']['listen_backlog'])
+        self.file_transfer_workers = int(self.config['Server']['file_transfer_workers'])
+        self.file_ticket_timeout = float(self.config['Server']['file_ticket_timeout'])
+        self.presence_coalesce_interval = float(self.config['Server']['presence_coalesce_interval'])
+        self.session_shards = int(self.config['Server']['session_shards'])
+        self.fanout_workers = int(self.config['Server']['fanout_workers'])
+        self.fanout_report_interval = float(self.config['Server']['fanout_report_interval'])
+        self.max_unacked = int(self.config['Delivery']['max_unacked'])
+        self.dedup_window = int(self.config['Delivery']['dedup_window'])
+        self.max_offline = int(self.config['Delivery']['max_offline'])
         self.is_json_format = self.config['Logger']['is_json_format']
         self.log_file = self.config['Logger']['log_file']
         self.is_output_heartbeat = self.config['Logger']['is_output_heartbeat']
+        self.password_workers = int(self.config['Auth']['password_workers'])
+        self.password_queue_limit = int(self.config['Auth']['password_queue_limit'])
+        self.password_timeout = float(self.config['Auth']['password_timeout'])
+        self.session_key_file = self.config['Auth']['session_key_file']
+        self.session_token_ttl = int(self.config['Auth']['session_token_ttl'])
+        self.friend_cache_max_entries = int(self.config['Cache']['friend_cache_max_entries'])
+        self.metrics_enabled = self.config['Metrics']['enabled']
+        self.metrics_host = self.config['Metrics']['host']
+        self.metrics_port = int(self.config['Metrics']['port'])
+        self.tracing_enabled = self.config['Tracing']['enabled']
+        self.tracing_sample_rate = float(self.config['Tracing']['sample_rate'])
+        self.tracing_users = [user.strip() for user in self.config['Tracing']['users'].split(',') if user.strip()]
+        self.tracing_actions = [
+            action.strip() for action in self.config['Tracing']['actions'].split(',') if action.strip()
+        ]
+        self.tracing_buffer_size = int(self.config['Tracing']['buffer_size'])
+        self.watchdog_enabled = self.config['Watchdog']['enabled']
+        self.watchdog_handler_budget = float(self.config['Watchdog']['handler_budget'])
+        self.watchdog_write_budget = float(self.config['Watchdog']['write_budget'])
+        # action_budgets = file_transfer:60,login:5
+        self.watchdog_action_budgets = {
+            action.strip(): float(budget)
+            for action, budget in (
+                item.split(':') for item in self.config['Watchdog']['action_budgets'].split(',') if item.strip()
+            )
+        }
+        self.watchdog_check_interval = float(self.config['Watchdog']['check_interval'])
+        self.admin_enabled = self.config['Admin']['enabled']
+        self.admin_socket = self.config['Admin']['socket_path']
+        self.profile_dir = self.config['Admin']['profile_dir']
+        self.signal_profile_seconds = float(self.config['Admin']['signal_profile_seconds'])
+        self.capture_enabled = self.config['Capture']['enabled']
+        self.capture_path = self.config['Capture']['path']
+        # <scope>.<action> = 每秒令牌数/桶容量，见 ratelimit.py
+        self.rate_limit_enabled = self.config['RateLimit']['enabled']
+        self.rate_limit_max_defer = float(self.config['RateLimit']['max_defer'])
+        self.rate_limits = {
+            key: tuple(float(number) for number in value.split('/'))
+            for key, value in self.config['RateLimit'].items() if '.' in key
+        }
+        self.compression_enabled = self.config['Compression']['enabled']
+        self.compression_algorithms = [
+            algorithm.strip() for algorithm in self.config['Compression']['algorithms'].split(',') if algorithm.strip()
+        ]
+        self.compression_min_size = int(self.config['Compression']['min_size'])
+        self.compression_level = int(self.config['Compression']['level'])
+        self.file_compression = self.config['Compression']['files']
+        # 自签名证书可以用 tool/make_cert.py 生成，客户端使用 ca_file 校验服务器证书
+        self.tls_enabled = self.config['TLS']['enabled']
+        self.tls_cert_file = self.config['TLS']['cert_file']
+        self.tls_key_file = self.config['TLS']['key_file']
+        self.tls_session_tickets = int(self.config['TLS']['session_tickets'])
+        self.admission_enabled = self.config['Admission']['enabled']
+        self.admission_latency_threshold = float(self.config['Admission']['latency_threshold'])
+        self.admission_low_priority_actions = [
+            action.strip() for action in self.config['Admission']['low_priority_actions'].split(',') if action.strip()
+        ]
+        self.admission_ignored_actions = [
+            action.strip() for action in self.config['Admission']['ignored_actions'].split(',') if action.strip()
+        ]
 
 
 class ColoredFormatter(logging.Formatter):
@@ -0,0 +1,89 @@
+import sys
+import threading
+
+
+class SessionRegistry:
+    '''
+    多设备会话表：username -> socket 或 {socket, ...}，同一用户可以同时有多个连接
+    大多数用户只有一个设备，只有一个会话时直接保存 socket，不为每个用户创建集合；
+    第二个设备上线时才换成 set，add/remove 都是 O(1)
+    写操作按用户名哈希分片加锁，用户名经 sys.intern 处理，所有会话共用同一个字符串对象
+    读操作依赖 GIL 保证单次字典访问的原子性，不加锁，因此可以在其他锁内安全调用
+    '''
+
+    def __init__(self, shard_count=64):
+        self.shards = [({}, threading.Lock()) for _ in range(shard_count)]
+        self.owners = {}  # socket -> username
+
+    def __shard(self, username):
+        return self.shards[hash(username) % len(self.shards)]
+
+    def add(self, username, session, on_online=None):
+        '''
+        返回 True 表示这是该用户的第一个会话，on_online 在分片锁内调用
+        '''
+        username = sys.intern(username)
+        sessions, lock = self.__shard(username)
+        with lock:
+            devices = sessions.get(username)
+            first = devices is None
+            if first:
+                sessions[username] = session
+            elif type(devices) is set:
+                devices.add(session)
+            elif devices is not session:
+                sessions[username] = {devices, session}
+            self.owners[session] = username
+            if first and on_online:
+                on_online()
+        return first
+
+    def remove(self, username, session=None, on_offline=None):
+        '''
+        session 为 None 时移除该用户的全部会话
+        返回 True 表示该用户已经没有会话，on_offline 在分片锁内调用
+        '''
+        sessions, lock = self.__shard(username)
+        with lock:
+            devices = sessions.get(username)
+            if devices is None:
+                return False
+            multiple = type(devices) is set
+            if session is None:
+                removed = devices if multiple else (devices, )
+            elif session is devices or (multiple and session in devices):
+                removed = (session, )
+            else:
+                removed = ()
+            for device in removed:
+                if self.owners.get(device) == username:
+                    del self.owners[device]
+            if multiple and session is not None:
+                devices.discard(session)
+                if len(devices) == 1:
+                    sessions[username] = next(iter(devices))
+                return False
+            if not removed:
+                return False
+            del sessions[username]
+            if on_offline:
+                on_offline()
+        return True
+
+    def owner(self, session):
+        return self.owners.get(session)
+
+    def is_online(self, username):
+        return username in self.__shard(username)[0]
+
+    def get_sessions(self, username):
+        devices = self.__shard(username)[0].get(username)
+        if devices is None:
+            return []
+        return list(devices) if type(devices) is set else [devices]
+
+    def online_count(self):
+        return sum(len(sessions) for sessions, _ in self.shards)
+
+    def session_count(self):
+        return len(self.owners)
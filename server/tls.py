@@ -0,0 +1,112 @@
+import select
+import socket
+import ssl
+import threading
+import time
+
+from metrics import Metrics
+
+
+def create_server_context(cert_file, key_file, session_tickets=2):
+    '''
+    消息端口和文件端口共用一个上下文，票据密钥相同，
+    消息连接上得到的会话票据也可以用来恢复文件数据连接
+    '''
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(cert_file, key_file)
+    context.num_tickets = session_tickets  # TLS 1.3 握手后发送的票据数
+    return context
+
+
+def handshake(context, client_socket, port):
+    '''
+    在连接自己的线程中完成握手（超时沿用 client_socket 的设置），按端口和是否恢复会话记录握手耗时
+    '''
+    started = time.perf_counter()
+    ssl_socket = context.wrap_socket(client_socket, server_side=True)
+    Metrics().observe(
+        'chat_tls_handshake_seconds', time.perf_counter() - started,
+        (port, 'true' if ssl_socket.session_reused else 'false')
+    )
+    return ssl_socket
+
+
+class TLSConnection:
+    '''
+    消息连接的 TLS 封装
+    OpenSSL 的 SSL 对象不能同时被多个线程使用，而消息连接由连接线程读取、任意线程经 OutboundQueue 写入，
+    因此 socket 设为非阻塞，recv 和 send 都在锁内执行，等待可读或可写时释放锁，超时与原来的阻塞 socket 相同
+    其余属性（getpeername、fileno 等）直接转发给 SSLSocket
+    '''
+
+    def __init__(self, ssl_socket):
+        self.socket = ssl_socket
+        self.timeout = ssl_socket.gettimeout()
+        self.lock = threading.Lock()
+        ssl_socket.setblocking(False)
+
+    def __getattr__(self, name):
+        return getattr(self.socket, name)
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def gettimeout(self):
+        return self.timeout
+
+    def recv(self, size):
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while True:
+            with self.lock:
+                try:
+                    return self.socket.recv(size)
+                except ssl.SSLWantReadError:
+                    writing = False
+                except ssl.SSLWantWriteError:
+                    writing = True
+            self.__wait(writing, deadline)
+
+    def sendall(self, data):
+        '''
+        SSL_write 返回 WANT_WRITE 后必须用同一段数据重试，所以只在成功后才移动 view
+        '''
+        view = memoryview(data)
+        deadline = None if self.timeout is None else time.monotonic() + self.timeout
+        while view:
+            with self.lock:
+                try:
+                    view = view[self.socket.send(view):]
+                    continue
+                except ssl.SSLWantWriteError:
+                    writing = True
+                except ssl.SSLWantReadError:
+                    writing = False
+            self.__wait(writing, deadline)
+
+    def shutdown(self, how):
+        with self.lock:
+            self.socket.shutdown(how)
+
+    def close(self):
+        with self.lock:
+            self.socket.close()
+
+    def __wait(self, writing, deadline):
+        remaining = None
+        if deadline is not None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise socket.timeout('timed out')
+        if hasattr(select, 'poll'):
+            # select.select 不能处理大于 FD_SETSIZE 的文件描述符，连接多时必须用 poll
+            poller = select.poll()
+            poller.register(self.socket, select.POLLOUT if writing else select.POLLIN)
+            ready = poller.poll(None if remaining is None else remaining * 1000)
+        else:
+            readable, writable, _ = select.select(
+                [] if writing else [self.socket], [self.socket] if writing else [], [], remaining
+            )
+            ready = readable or writable
+        if not ready:
+            raise socket.timeout('timed out')
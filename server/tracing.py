@@ -0,0 +1,117 @@
+import itertools
+import os
+import random
+import threading
+import time
+from collections import deque
+
+
+class Trace:
+    '''
+    一个请求帧的处理过程，stamps 为 (阶段, perf_counter 时间, 附加信息)
+    阶段: recv, decode, dispatch, handler_start, handler_end, enqueue（进入接收方发送队列）, write（写入 socket）
+    '''
+    max_stamps = 256  # 大群的群消息每个成员都会产生 enqueue/write
+
+    def __init__(self, trace_id, action, user, received):
+        self.id = trace_id
+        self.action = action
+        self.user = user
+        self.thread = threading.current_thread().name
+        self.stamps = [('recv', received, None), ('decode', time.perf_counter(), None)]
+
+    def stamp(self, stage, detail=None):
+        if len(self.stamps) < self.max_stamps:
+            self.stamps.append((stage, time.perf_counter(), detail))
+
+
+class Tracer:
+    '''
+    消息处理过程追踪，默认关闭
+    按用户（发送者或接收者）、action 或随机比例采样，采样到的 Trace 保存在环形缓冲区中，
+    由 export() 导出为 Chrome trace-event JSON（chrome://tracing 或 Perfetto 打开）
+    处理线程通过 activate() 设置当前 Trace，发送消息时由 current() 取得
+    '''
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, enabled=False, sample_rate=0.0, users=(), actions=(), buffer_size=10000):
+        if hasattr(self, 'traces'):
+            return
+        self.traces = deque(maxlen=buffer_size)
+        self.ids = itertools.count(1)
+        self.local = threading.local()
+        self.configure(enabled, sample_rate, users, actions)
+
+    def configure(self, enabled=None, sample_rate=None, users=None, actions=None):
+        '''
+        运行时修改采样规则，None 表示保持不变
+        '''
+        if sample_rate is not None:
+            self.sample_rate = sample_rate
+        if users is not None:
+            self.users = frozenset(users)
+        if actions is not None:
+            self.actions = frozenset(actions)
+        if enabled is not None:
+            self.enabled = enabled
+
+    def start(self, message, received):
+        '''
+        帧解码后调用，采样命中时返回新的 Trace，否则返回 None
+        '''
+        action = message.get('action') or message.get('type')
+        request_data = message.get('request_data') or {}
+        user = request_data.get('username') or request_data.get('sender') or message.get('who')
+        if not (
+            action in self.actions or user in self.users or request_data.get('receiver') in self.users
+            or (self.sample_rate and random.random() < self.sample_rate)
+        ):
+            return None
+        trace = Trace(next(self.ids), action, user, received)
+        self.traces.append(trace)
+        return trace
+
+    def activate(self, trace):
+        self.local.trace = trace
+
+    def current(self):
+        return getattr(self.local, 'trace', None)
+
+    def clear(self):
+        self.traces.clear()
+
+    def export(self):
+        '''
+        每个 Trace 占一行（tid 为 trace id），相邻两个时间点之间的区间作为一个事件，以后一个阶段命名
+        '''
+        pid = os.getpid()
+        events = []
+        for trace in list(self.traces):
+            stamps = list(trace.stamps)
+            first, last = stamps[0][1], stamps[-1][1]
+            events.append({
+                'ph': 'M', 'name': 'thread_name', 'pid': pid, 'tid': trace.id,
+                'args': {'name': f'#{trace.id} {trace.action} {trace.user or ""}'}
+            })
+            events.append({
+                'ph': 'X', 'name': trace.action, 'cat': 'message', 'pid': pid, 'tid': trace.id,
+                'ts': first * 1e6, 'dur': (last - first) * 1e6,
+                'args': {'user': trace.user, 'thread': trace.thread, 'total_ms': (last - first) * 1000}
+            })
+            for (_, previous, _), (stage, current, detail) in zip(stamps, stamps[1:]):
+                event = {
+                    'ph': 'X', 'name': stage, 'cat': 'stage', 'pid': pid, 'tid': trace.id,
+                    'ts': previous * 1e6, 'dur': (current - previous) * 1e6
+                }
+                if detail is not None:
+                    event['args'] = {'detail': detail}
+                events.append(event)
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
@@ -1,10 +1,152 @@
 import logging
 import sys
 import sqlite3
-import bcrypt
+import threading
+import time
+from collections import OrderedDict, deque
 
 sys.path.append(".")
 from utils import Utils
+from auth import ServerBusyError
+from sessions import SessionRegistry
+from metrics import TimedCursor
+
+
+class FriendCache:
+    '''
+    好友关系的内存邻接表缓存
+    按用户懒加载，超过 max_entries（缓存的好友关系总条数）时按 LRU 淘汰整个用户
+    '''
+
+    def __init__(self, max_entries=100000):
+        self.max_entries = max_entries
+        self.entries = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.adjacency = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, username):
+        with self.lock:
+            friends = self.adjacency.get(username)
+            if friends is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.adjacency.move_to_end(username)
+            return list(friends)
+
+    def put(self, username, friends):
+        with self.lock:
+            old = self.adjacency.pop(username, None)
+            if old is not None:
+                self.entries -= len(old)
+            self.adjacency[sys.intern(username)] = dict.fromkeys(map(sys.intern, friends))
+            self.entries += len(friends)
+            self.__evict()
+
+    def contains(self, username, friend):
+        '''
+        返回 True/False，未缓存该用户时返回 None
+        '''
+        with self.lock:
+            friends = self.adjacency.get(username)
+            if friends is None:
+                return None
+            return friend in friends
+
+    def add(self, username, friend):
+        # 只更新已经加载的用户，未加载的用户下次读取时会从数据库得到最新数据
+        with self.lock:
+            friends = self.adjacency.get(username)
+            if friends is not None and friend not in friends:
+                friends[friend] = None
+                self.entries += 1
+                self.__evict()
+
+    def remove(self, username, friend):
+        with self.lock:
+            friends = self.adjacency.get(username)
+            if friends is not None and friend in friends:
+                del friends[friend]
+                self.entries -= 1
+
+    def invalidate(self, username):
+        with self.lock:
+            friends = self.adjacency.pop(username, None)
+            if friends is not None:
+                self.entries -= len(friends)
+
+    def __evict(self):
+        while self.entries > self.max_entries and len(self.adjacency) > 1:
+            _, friends = self.adjacency.popitem(last=False)
+            self.entries -= len(friends)
+            self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'users': len(self.adjacency),
+                'entries': self.entries,
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+
+
+class FriendListVersions:
+    '''
+    好友列表版本号: "epoch.counter"，每次添加/删除好友时 counter 加一
+    每个用户只保留最近 max_changes 条变更，更早的版本或服务器重启前的版本只能全量同步
+    '''
+
+    def __init__(self, max_changes=64):
+        self.epoch = format(int(time.time()), 'x')
+        self.max_changes = max_changes
+        self.counters = {}
+        self.changes = {}  # username -> deque[(counter, friend, added)]
+        self.lock = threading.Lock()
+
+    def current(self, username):
+        with self.lock:
+            return f'{self.epoch}.{self.counters.get(username, 0)}'
+
+    def record(self, username, friend, added):
+        with self.lock:
+            counter = self.counters.get(username, 0) + 1
+            self.counters[username] = counter
+            self.changes.setdefault(username, deque(maxlen=self.max_changes)).append((counter, friend, added))
+
+    def diff(self, username, version):
+        '''
+        返回 (当前版本, 新增好友集合, 删除好友集合)，无法增量同步时返回 None
+        '''
+        try:
+            epoch, counter = version.split('.')
+            counter = int(counter)
+        except (AttributeError, ValueError):
+            return None
+        with self.lock:
+            current = self.counters.get(username, 0)
+            if epoch != self.epoch or counter > current:
+                return None
+            added, removed = set(), set()
+            if counter < current:
+                changes = self.changes.get(username)
+                if not changes or changes[0][0] > counter + 1:
+                    return None
+                for change_counter, friend, is_added in changes:
+                    if change_counter <= counter:
+                        continue
+                    if is_added:
+                        added.add(friend)
+                        removed.discard(friend)
+                    else:
+                        removed.add(friend)
+                        added.discard(friend)
+            return f'{self.epoch}.{current}', added, removed
 
 
 class UserManager:
@@ -16,9 +158,16 @@ class UserManager:
             cls._instance = super().__new__(cls)
         return cls._instance
 
-    def __init__(self):
+    def __init__(self, password_hasher, session_tokens, friend_cache_max_entries=100000, session_shards=64):
+        self.password_hasher = password_hasher
+        self.session_tokens = session_tokens
+        self.friend_cache = FriendCache(friend_cache_max_entries)
+        self.friend_versions = FriendListVersions()
         self.conn = sqlite3.connect('users.db', check_same_thread=False)
-        self.cursor = self.conn.cursor()
+        # 记录查询耗时，见 metrics.py
+        self.cursor = TimedCursor(self.conn.cursor(), 'users')
+        # 各连接线程共用同一个游标，访问数据库时必须持有该锁
+        self.db_lock = threading.RLock()
         self.cursor.execute(
             '''
             CREATE TABLE IF NOT EXISTS users (
@@ -36,20 +185,29 @@ class UserManager:
             )
         ''')
         self.conn.commit()
-        self.online_users = {}
+        # 在线会话表，同一用户可以有多个设备同时在线
+        self.online_users = SessionRegistry(session_shards)
+        # 反向索引: 用户 -> 在线且关注其状态的好友
+        self.watchers = {}
+        self.presence_lock = threading.RLock()
+        self.presence_notifier = None
 
     def _validate_credentials(self, username, password, register=False):
         success, message = Utils.is_valid_username_then_password(username, password)
         if success:
-            self.cursor.execute('SELECT * FROM users WHERE username = ?', (username, ))
-            user = self.cursor.fetchone()
+            with self.db_lock:
+                self.cursor.execute('SELECT * FROM users WHERE username = ?', (username, ))
+                user = self.cursor.fetchone()
             if user is None:
                 if not register:
                     success, message = False, 'User is not exist'
             elif not register:
                 stored_password_hash = user[1]
-                if not bcrypt.checkpw(password.encode('utf-8'), stored_password_hash.encode('utf-8')):
-                    success, message = False, 'The password is wrong'
+                try:
+                    if not self.password_hasher.check_password(password, stored_password_hash):
+                        success, message = False, 'The password is wrong'
+                except ServerBusyError as e:
+                    success, message = False, str(e)
             else:
                 success, message = False, 'Username already exists'
         return success, message
@@ -57,11 +215,15 @@ class UserManager:
     def register_user(self, username, password):
         success, message = self._validate_credentials(username, password, True)
         if success:
-            password_hash = Utils.hash_password(password)
-            self.cursor.execute(
-                'INSERT INTO users (username, password_hash) VALUES (?, ?)', (username, password_hash)
-            )
-            self.conn.commit()
+            try:
+                password_hash = self.password_hasher.hash_password(password)
+            except ServerBusyError as e:
+                return False, str(e)
+            with self.db_lock:
+                self.cursor.execute(
+                    'INSERT INTO users (username, password_hash) VALUES (?, ?)', (username, password_hash)
+                )
+                self.conn.commit()
             message = 'User registered successfully'
         return success, message
 
@@ -71,44 +233,98 @@ class UserManager:
             message = 'Login successful!'
         return success, message
 
+    def _get_password_hash(self, username):
+        with self.db_lock:
+            self.cursor.execute('SELECT password_hash FROM users WHERE username = ?', (username, ))
+            user = self.cursor.fetchone()
+        return user[0] if user else None
+
+    def issue_session_token(self, username):
+        password_hash = self._get_password_hash(username)
+        if password_hash is None:
+            return None
+        return self.session_tokens.issue(username, password_hash)
+
+    def resume_session(self, username, session_token):
+        '''
+        使用登录时签发的会话令牌恢复登录，只做一次 HMAC 校验，不再进行 bcrypt 计算
+        '''
+        password_hash = self._get_password_hash(username)
+        if password_hash is None:
+            return False, 'User is not exist'
+        if not session_token or not self.session_tokens.verify(username, session_token, password_hash):
+            return False, 'Session token is invalid or expired'
+        return True, 'Session resumed'
+
     def delete_account(self, username, password):
         success, message = self._validate_credentials(username, password)
         if success:
-            self.cursor.execute('DELETE FROM users WHERE username = ?', (username, ))
-            self.conn.commit()
+            with self.db_lock:
+                self.cursor.execute('SELECT friendname FROM friendship WHERE username = ?', (username, ))
+                friends = [friend[0] for friend in self.cursor.fetchall()]
+                self.cursor.execute('DELETE FROM users WHERE username = ?', (username, ))
+                self.cursor.execute('DELETE FROM friendship WHERE username = ? OR friendname = ?', (username, username))
+                self.conn.commit()
+            # 好友的缓存和版本号也要更新，否则好友同步时仍然会得到已删除的账户
+            self.friend_cache.invalidate(username)
+            for friend in friends:
+                self.friend_cache.remove(friend, username)
+                self.friend_versions.record(friend, username, False)
+            with self.presence_lock:
+                for friend in friends:
+                    self.watchers.get(friend, set()).discard(username)
             message = 'Account deleted successfully'
         return success, message
     
     def is_username_exist(self, username):
-        self.cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
-        user = self.cursor.fetchone()
+        with self.db_lock:
+            self.cursor.execute('SELECT * FROM users WHERE username = ?', (username,))
+            user = self.cursor.fetchone()
         return user is not None
     
     def get_friends(self, username):
-        is_exists = self.is_username_exist(username)
-        if not is_exists:
-            return False, 'User is not exist', None
-        self.cursor.execute('SELECT friendname FROM friendship WHERE username = ?', (username,))
-        friends = self.cursor.fetchall()
+        friends = self.friend_cache.get(username)
+        if friends is None:
+            is_exists = self.is_username_exist(username)
+            if not is_exists:
+                return False, 'User is not exist', None
+            # 在 db_lock 内写入缓存：添加/删除好友在提交数据库之后才修改缓存，
+            # 这里读到的列表不会覆盖之后的修改
+            with self.db_lock:
+                self.cursor.execute('SELECT friendname FROM friendship WHERE username = ?', (username,))
+                friends = [friend[0] for friend in self.cursor.fetchall()]
+                self.friend_cache.put(username, friends)
         if not friends:
             return True, 'No friends found', []
-        return True, 'Get friends list successfully', [friend[0] for friend in friends]
+        return True, 'Get friends list successfully', friends
     
     def add_friend(self, username, friend_username):
         if not self.is_username_exist(friend_username):
             return False, 'User is not exist'
         
         # Check if the friendship already exists
-        self.cursor.execute('SELECT * FROM friendship WHERE (username = ? AND friendname = ?) OR (username = ? AND friendname = ?)', (username, friend_username, friend_username, username))
-        existing_friendship = self.cursor.fetchone()
-        
-        if existing_friendship:
+        # 好友关系总是成对写入，只需按主键查询一个方向
+        if self.friend_cache.contains(username, friend_username):
             return False, 'Friendship already exists'
         
         # If friendship doesn't exist, then add the friend
-        self.cursor.execute('INSERT INTO friendship (username, friendname) VALUES (?, ?)', (username, friend_username))
-        self.cursor.execute('INSERT INTO friendship (username, friendname) VALUES (?, ?)', (friend_username, username))
-        self.conn.commit()
+        # 查询和写入在同一次加锁内完成，双方同时互相添加时只有一方成功
+        with self.db_lock:
+            self.cursor.execute(
+                'SELECT 1 FROM friendship WHERE username = ? AND friendname = ?', (username, friend_username)
+            )
+            if self.cursor.fetchone() is not None:
+                return False, 'Friendship already exists'
+            self.cursor.executemany(
+                'INSERT INTO friendship (username, friendname) VALUES (?, ?)',
+                [(username, friend_username), (friend_username, username)]
+            )
+            self.conn.commit()
+        self.friend_cache.add(username, friend_username)
+        self.friend_cache.add(friend_username, username)
+        self.friend_versions.record(username, friend_username, True)
+        self.friend_versions.record(friend_username, username, True)
+        self.__link_watchers(username, friend_username)
         return True, 'Friend added successfully'
 
     
@@ -116,26 +332,84 @@ class UserManager:
         is_exists = self.is_username_exist(username)
         if not is_exists:
             return False, 'User is not exist'
-        self.cursor.execute('DELETE FROM friendship WHERE username = ? AND friendname = ?', (username, friend_username))
-        self.cursor.execute('DELETE FROM friendship WHERE username = ? AND friendname = ?', (friend_username, username))
-        self.conn.commit()
+        with self.db_lock:
+            self.cursor.execute('DELETE FROM friendship WHERE username = ? AND friendname = ?', (username, friend_username))
+            self.cursor.execute('DELETE FROM friendship WHERE username = ? AND friendname = ?', (friend_username, username))
+            self.conn.commit()
+        self.friend_cache.remove(username, friend_username)
+        self.friend_cache.remove(friend_username, username)
+        self.friend_versions.record(username, friend_username, False)
+        self.friend_versions.record(friend_username, username, False)
+        with self.presence_lock:
+            self.watchers.get(username, set()).discard(friend_username)
+            self.watchers.get(friend_username, set()).discard(username)
         return True, 'Friend removed successfully'
 
     
     def set_online(self, username, socket):
+        username = sys.intern(username)  # 会话表、在线好友索引和状态推送共用同一个字符串
+        previous = self.online_users.owner(socket)
+        if previous == username:
+            return
+        if previous is not None:
+            # 同一连接切换了身份，只移除该连接原来的会话
+            self.set_offline(previous, socket)
         logging.info(f'{username} is online')
-        self.online_users[username] = socket
+        _, _, friends = self.get_friends(username)
+        online_friends = set()
+
+        def on_online():
+            with self.presence_lock:
+                online_friends.update(friend for friend in friends or [] if self.online_users.is_online(friend))
+                self.watchers[username] = online_friends
+                for friend in online_friends:
+                    self.watchers.setdefault(friend, set()).add(username)
+
+        if self.online_users.add(username, socket, on_online) and self.presence_notifier:
+            self.presence_notifier.publish(username, True, online_friends)
+
+    def set_offline(self, username, socket=None):
+        '''
+        socket 为 None 时下线该用户的所有设备，否则只移除对应的会话
+        '''
+        online_friends = set()
+
+        def on_offline():
+            with self.presence_lock:
+                online_friends.update(self.watchers.pop(username, set()))
+                for friend in online_friends:
+                    self.watchers.get(friend, set()).discard(username)
+
+        if self.online_users.remove(username, socket, on_offline):
+            logging.info(f'{username} is offline')
+            if self.presence_notifier:
+                self.presence_notifier.publish(username, False, online_friends)
+
+    def drop_session(self, socket):
+        '''
+        连接断开时调用，移除该连接对应的会话
+        '''
+        username = self.online_users.owner(socket)
+        if username is not None:
+            self.set_offline(username, socket)
+        return username
 
-    def set_offline(self, username):
-        logging.info(f'{username} is offline')
-        if username in self.online_users:
-            del self.online_users[username]
+    def __link_watchers(self, username, friend_username):
+        # 新建好友关系时双方都在线，则互相加入反向索引并立即推送当前状态
+        with self.presence_lock:
+            if not self.online_users.is_online(username) or not self.online_users.is_online(friend_username):
+                return
+            self.watchers.setdefault(username, set()).add(friend_username)
+            self.watchers.setdefault(friend_username, set()).add(username)
+        if self.presence_notifier:
+            self.presence_notifier.push(username, {friend_username: True})
+            self.presence_notifier.push(friend_username, {username: True})
 
     def is_online(self, username):
-        return username in self.online_users
+        return self.online_users.is_online(username)
 
-    def get_socket(self, username):
-        return self.online_users.get(username)
+    def get_sockets(self, username):
+        return self.online_users.get_sessions(username)
 
     def close_connection(self):
         self.conn.close()
@@ -0,0 +1,96 @@
+import logging
+import sys
+import threading
+import time
+import traceback
+
+from metrics import Metrics
+
+
+class WatchEntry:
+
+    def __init__(self, kind, action, user, budget):
+        self.kind = kind
+        self.action = action
+        self.user = user
+        self.budget = budget
+        self.thread_id = threading.get_ident()
+        self.started = time.perf_counter()
+        self.reported = False
+
+
+class Watchdog:
+    '''
+    慢操作检测
+    处理请求和写 socket 前调用 begin()，结束后调用 end()；后台线程定期检查，
+    超过预算的操作通过 sys._current_frames 取得所在线程的调用栈写入日志，并计入 chat_slow_operations_total
+    每次操作只报告一次，结束时再记录总耗时
+    '''
+    _instance = None
+    _lock = threading.Lock()
+
+    def __new__(cls, *args, **kwargs):
+        if cls._instance is None:
+            with cls._lock:
+                if cls._instance is None:
+                    cls._instance = super().__new__(cls)
+        return cls._instance
+
+    def __init__(self, enabled=True, handler_budget=1.0, write_budget=1.0, action_budgets=None, check_interval=0.1):
+        if hasattr(self, 'active'):
+            return
+        self.enabled = enabled
+        self.budgets = {'handler': handler_budget, 'write': write_budget}
+        self.action_budgets = action_budgets or {}  # action -> 预算，例如文件传输需要更长时间
+        self.check_interval = check_interval
+        self.active = set()
+        self.metrics = Metrics()
+        self.metrics.counter(
+            'chat_slow_operations_total', 'Handlers and socket writes over budget', ('kind', 'action')
+        )
+        if enabled:
+            threading.Thread(target=self.__run, name='watchdog', daemon=True).start()
+
+    def begin(self, kind, action, user=None):
+        if not self.enabled:
+            return None
+        entry = WatchEntry(kind, action, user, self.action_budgets.get(action, self.budgets[kind]))
+        self.active.add(entry)
+        return entry
+
+    def end(self, entry):
+        if entry is None:
+            return
+        self.active.discard(entry)
+        if entry.reported:
+            logging.warning(
+                f'Slow {entry.kind} {entry.action} ({entry.user}) finished after '
+                f'{time.perf_counter() - entry.started:.3f}s'
+            )
+
+    def __run(self):
+        while True:
+            time.sleep(self.check_interval)
+            # 格式化调用栈时线程可能正好退出，任何异常都不能结束检查线程
+            try:
+                self.__check()
+            except Exception:
+                logging.exception('Watchdog check failed')
+
+    def __check(self):
+        now = time.perf_counter()
+        overdue = [entry for entry in list(self.active) if not entry.reported and now - entry.started > entry.budget]
+        if not overdue:
+            return
+        frames = sys._current_frames()
+        for entry in overdue:
+            self.__report(entry, frames.get(entry.thread_id), now)
+
+    def __report(self, entry, frame, now):
+        entry.reported = True
+        self.metrics.inc('chat_slow_operations_total', (entry.kind, entry.action))
+        stack = ''.join(traceback.format_stack(frame)) if frame is not None else '(thread has exited)\n'
+        logging.warning(
+            f'Slow {entry.kind} {entry.action} ({entry.user}): running for {now - entry.started:.3f}s, '
+            f'budget {entry.budget}s, thread {entry.thread_id}\n{stack}'
+        )
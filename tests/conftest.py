@@ -0,0 +1,6 @@
+import os
+import sys
+
+# 与从仓库根目录运行服务器时相同：utils 在根目录，服务器模块之间直接按模块名导入
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, 'server')]
@@ -0,0 +1,98 @@
+from delivery import DeliveryTracker
+
+
+def track(delivery, recipient, conversation, seq):
+    return delivery.track(recipient, conversation, seq, f'{conversation}#{seq}'.encode())
+
+
+def test_seq_per_conversation():
+    delivery = DeliveryTracker()
+    chat = delivery.personal_conversation('bob', 'alice')
+    assert chat == delivery.personal_conversation('alice', 'bob')
+    assert delivery.assign('alice', 'm1', chat) == (1, False)
+    assert delivery.assign('bob', 'm2', chat) == (2, False)
+    assert delivery.assign('alice', 'm3', delivery.group_conversation('dev')) == (1, False)
+
+
+def test_duplicate_message_id_returns_first_seq():
+    delivery = DeliveryTracker()
+    chat = delivery.personal_conversation('alice', 'bob')
+    assert delivery.assign('alice', 'm1', chat) == (1, False)
+    assert delivery.assign('alice', 'm2', chat) == (2, False)
+    assert delivery.assign('alice', 'm1', chat) == (1, True)
+    # message_id 按发送者去重，其他发送者的相同 id 是另一条消息
+    assert delivery.assign('bob', 'm1', chat) == (3, False)
+    assert delivery.assign('alice', None, chat) == (4, False)
+    assert delivery.assign('alice', None, chat) == (5, False)
+
+
+def test_dedup_window_forgets_oldest_ids():
+    delivery = DeliveryTracker(dedup_window=2)
+    chat = delivery.personal_conversation('alice', 'bob')
+    for message_id in ('m1', 'm2', 'm3'):
+        delivery.assign('alice', message_id, chat)
+    assert delivery.assign('alice', 'm3', chat) == (3, True)
+    assert delivery.assign('alice', 'm1', chat) == (4, False)
+
+
+def test_cumulative_ack_removes_prefix_of_one_conversation():
+    delivery = DeliveryTracker()
+    chat, group = delivery.personal_conversation('alice', 'bob'), delivery.group_conversation('dev')
+    for conversation, seq in ((chat, 1), (group, 1), (chat, 2), (group, 2), (chat, 3)):
+        track(delivery, 'bob', conversation, seq)
+    assert delivery.ack('bob', chat, 2) == 2
+    assert delivery.pending('bob') == [b'g:dev#1', b'g:dev#2', b'p:alice|bob#3']
+    assert delivery.ack('bob', chat, 2) == 0
+    assert delivery.ack('bob', 'p:other', 5) == 0
+    assert delivery.unacked_count('bob') == 3
+
+
+def test_ack_everything_forgets_recipient():
+    delivery = DeliveryTracker()
+    chat = delivery.personal_conversation('alice', 'bob')
+    track(delivery, 'bob', chat, 1)
+    track(delivery, 'bob', chat, 2)
+    assert delivery.ack('bob', chat, 10) == 2
+    assert delivery.pending('bob') == []
+    assert delivery.unacked_count('bob') == 0
+    assert delivery.total_unacked() == 0
+    assert delivery.ack('bob', chat, 10) == 0
+
+
+def test_pending_keeps_receive_order_across_conversations():
+    delivery = DeliveryTracker()
+    order = [('g:dev', 1), ('p:alice|bob', 1), ('g:dev', 2), ('g:ops', 1), ('p:alice|bob', 2)]
+    for conversation, seq in order:
+        track(delivery, 'bob', conversation, seq)
+    assert delivery.pending('bob') == [f'{conversation}#{seq}'.encode() for conversation, seq in order]
+
+
+def test_out_of_order_track_is_removed_by_later_ack():
+    # 同一会话的消息由不同线程登记，seq 可能不按顺序到达
+    delivery = DeliveryTracker()
+    chat = delivery.personal_conversation('alice', 'bob')
+    track(delivery, 'bob', chat, 2)
+    track(delivery, 'bob', chat, 1)
+    assert delivery.ack('bob', chat, 1) == 0
+    assert delivery.ack('bob', chat, 2) == 2
+
+
+def test_overflow_keeps_messages():
+    delivery = DeliveryTracker(max_unacked=2)
+    chat = delivery.personal_conversation('alice', 'bob')
+    assert not track(delivery, 'bob', chat, 1)
+    assert not track(delivery, 'bob', chat, 2)
+    assert track(delivery, 'bob', chat, 3)
+    assert len(delivery.pending('bob')) == 3
+
+
+def test_offline_backlog_limit():
+    delivery = DeliveryTracker(max_offline=2)
+    chat = delivery.personal_conversation('alice', 'bob')
+    track(delivery, 'bob', chat, 1)
+    assert delivery.accepts('bob')
+    track(delivery, 'bob', chat, 2)
+    assert not delivery.accepts('bob')
+    assert delivery.accepts('carol')
+    delivery.ack('bob', chat, 1)
+    assert delivery.accepts('bob')
@@ -0,0 +1,78 @@
+import struct
+
+import pytest
+
+from utils import Compression, FrameBuffer, FrameCodec, Protocol
+
+ALGORITHMS = Compression.available()
+
+
+def frame(size):
+    return Protocol.encode({'type': 'heartbeat', 'who': 'alice', 'padding': 'x' * size})
+
+
+def test_frame_buffer_joins_partial_frames():
+    data = frame(10) + frame(20)
+    frame_buffer = FrameBuffer()
+    assert frame_buffer.feed(data[:7]) == []
+    frames = frame_buffer.feed(data[7:])
+    assert [Protocol.decode(item)['padding'] for item in frames] == ['x' * 10, 'x' * 20]
+    assert frame_buffer.pending == b''
+
+
+def test_frame_buffer_rejects_oversized_frame():
+    frame_buffer = FrameBuffer()
+    frame_buffer.feed(b'x' * Protocol.MAX_FRAME_SIZE)
+    with pytest.raises(ValueError):
+        frame_buffer.feed(b'x')
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS)
+def test_codec_round_trip_byte_by_byte(algorithm):
+    encoder, decoder = FrameCodec(algorithm, min_size=64), FrameCodec(algorithm, min_size=64)
+    frames = [frame(0), frame(500), frame(500), frame(5000)]
+    data = b''.join(encoder.encode(item) for item in frames)
+    received = []
+    for offset in range(len(data)):
+        received.extend(decoder.feed(data[offset:offset + 1]))
+    assert [bytes(item) for item in received] == [item[:-len(Protocol.DELIMITER)] for item in frames]
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS)
+def test_codec_rejects_declared_length_over_limit(algorithm):
+    decoder = FrameCodec(algorithm)
+    with pytest.raises(ValueError):
+        decoder.feed(FrameCodec.HEADER.pack(FrameCodec.RAW, Protocol.MAX_FRAME_SIZE + 1))
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS)
+def test_codec_rejects_corrupt_data(algorithm):
+    decoder = FrameCodec(algorithm)
+    payload = b'\xff' * 64
+    with pytest.raises(ValueError):
+        decoder.feed(FrameCodec.HEADER.pack(FrameCodec.COMPRESSED, len(payload)) + payload)
+
+
+@pytest.mark.parametrize('algorithm', ALGORITHMS)
+def test_codec_rejects_decompression_bomb(algorithm):
+    # 几 KB 的压缩数据解压后超过 MAX_FRAME_SIZE
+    encoder, decoder = FrameCodec(algorithm), FrameCodec(algorithm)
+    data = encoder.encode(frame(Protocol.MAX_FRAME_SIZE))
+    assert len(data) < Protocol.MAX_FRAME_SIZE // 100
+    with pytest.raises(ValueError):
+        decoder.feed(data)
+
+
+def test_decompress_limit():
+    compress, _ = Compression.stream('zlib', 6)
+    _, decompress = Compression.stream('zlib', 6, max_size=1000)
+    assert decompress(compress(b'a' * 1000)) == b'a' * 1000
+    with pytest.raises(ValueError):
+        decompress(compress(b'a' * 1001))
+
+
+def test_raw_frames_are_not_compressed():
+    encoder = FrameCodec('zlib', min_size=128)
+    data = encoder.encode(frame(0))
+    flag, length = struct.unpack_from('>BI', data)
+    assert flag == FrameCodec.RAW and length == len(frame(0)) - len(Protocol.DELIMITER)
@@ -0,0 +1,49 @@
+from user_manager import FriendListVersions
+
+
+def test_unchanged_version():
+    versions = FriendListVersions()
+    version = versions.current('alice')
+    assert versions.diff('alice', version) == (version, set(), set())
+
+
+def test_delta_since_version():
+    versions = FriendListVersions()
+    version = versions.current('alice')
+    versions.record('alice', 'bob', True)
+    versions.record('alice', 'carol', True)
+    versions.record('alice', 'dave', False)
+    current, added, removed = versions.diff('alice', version)
+    assert current == versions.current('alice') != version
+    assert added == {'bob', 'carol'}
+    assert removed == {'dave'}
+
+
+def test_add_then_remove_cancels_out():
+    versions = FriendListVersions()
+    version = versions.current('alice')
+    versions.record('alice', 'bob', True)
+    versions.record('alice', 'bob', False)
+    _, added, removed = versions.diff('alice', version)
+    assert added == set() and removed == {'bob'}
+
+
+def test_versions_are_per_user():
+    versions = FriendListVersions()
+    version = versions.current('alice')
+    versions.record('bob', 'carol', True)
+    assert versions.current('alice') == version
+    assert versions.diff('alice', version)[1:] == (set(), set())
+
+
+def test_full_sync_when_delta_is_unavailable():
+    versions = FriendListVersions(max_changes=2)
+    version = versions.current('alice')
+    for friend in ('bob', 'carol', 'dave'):
+        versions.record('alice', friend, True)
+    assert versions.diff('alice', version) is None  # 最早的变更已经丢弃
+    assert versions.diff('alice', None) is None
+    assert versions.diff('alice', 'garbage') is None
+    assert versions.diff('alice', 'otherepoch.1') is None  # 服务器重启前的版本
+    epoch = versions.current('alice').split('.')[0]
+    assert versions.diff('alice', f'{epoch}.99') is None  # 比当前版本还新
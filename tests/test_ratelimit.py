@@ -0,0 +1,84 @@
+import pytest
+
+import ratelimit
+from ratelimit import AdmissionController, RateLimiter, TokenBucket
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    return clock
+
+
+def test_token_bucket_refill():
+    bucket = TokenBucket(2, 4, 0.0)
+    bucket.tokens = 0
+    assert bucket.wait_time() == pytest.approx(0.5)
+    bucket.refill(0.25)
+    assert bucket.tokens == pytest.approx(0.5)
+    bucket.refill(10.0)
+    assert bucket.tokens == 4  # 不超过桶容量
+    assert bucket.wait_time() == 0
+
+
+def test_burst_then_wait(clock):
+    limiter = RateLimiter({'user.send_personal_message': (2, 3)})
+    for _ in range(3):
+        assert limiter.check('send_personal_message', 'alice', '10.0.0.1') == (0, None)
+    retry_after, scope = limiter.check('send_personal_message', 'alice', '10.0.0.1')
+    assert retry_after == pytest.approx(0.5) and scope == 'user'
+    assert limiter.check('send_personal_message', 'bob', '10.0.0.1') == (0, None)
+    assert limiter.check('get_friends', 'alice', '10.0.0.1') == (0, None)  # 没有匹配的规则
+    clock.now += 0.5
+    assert limiter.check('send_personal_message', 'alice', '10.0.0.1') == (0, None)
+
+
+def test_rejected_request_takes_no_tokens(clock):
+    limiter = RateLimiter({'user.*': (1, 1), 'ip.*': (1, 2)})
+    assert limiter.check('login', 'alice', '10.0.0.1') == (0, None)
+    assert limiter.check('login', 'alice', '10.0.0.1')[1] == 'user'
+    # alice 被拒绝的请求没有消耗 ip 桶的令牌
+    assert limiter.check('login', 'bob', '10.0.0.1') == (0, None)
+
+
+def test_no_user_only_matches_ip_and_global(clock):
+    limiter = RateLimiter({'user.login': (1, 1), 'ip.login': (1, 2)})
+    assert limiter.check('login', None, '10.0.0.1') == (0, None)
+    assert limiter.check('login', None, '10.0.0.1') == (0, None)
+    assert limiter.check('login', None, '10.0.0.1')[1] == 'ip'
+    assert limiter.check('login', None, '10.0.0.2') == (0, None)
+
+
+def test_global_scope_is_reported_first(clock):
+    limiter = RateLimiter({'user.*': (1, 1), 'global.*': (0.5, 1)})
+    assert limiter.check('ack', 'alice', '10.0.0.1') == (0, None)
+    retry_after, scope = limiter.check('ack', 'alice', '10.0.0.1')
+    assert scope == 'global' and retry_after == pytest.approx(2)
+
+
+@pytest.mark.parametrize('rule', [{'user.*': (0, 5)}, {'ip.login': (1, 0.5)}, {'users.*': (1, 1)}])
+def test_invalid_rules(rule):
+    with pytest.raises(ValueError):
+        RateLimiter(rule)
+
+
+def test_admission_sheds_low_priority_requests(clock):
+    admission = AdmissionController(0.1, ['get_friends'], ['file_transfer'])
+    admission.record('file_transfer', 60)
+    assert admission.admit('get_friends')
+    for _ in range(30):
+        admission.record('send_personal_message', 1.0)
+    assert not admission.admit('get_friends')
+    assert admission.admit('send_personal_message')
+    clock.now += 30  # 没有新样本时平均值衰减
+    assert admission.admit('get_friends')
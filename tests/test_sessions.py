@@ -0,0 +1,51 @@
+from sessions import SessionRegistry
+
+
+def test_first_and_last_session():
+    registry = SessionRegistry()
+    events = []
+    assert registry.add('alice', 'phone', on_online=lambda: events.append('online'))
+    assert not registry.add('alice', 'laptop', on_online=lambda: events.append('online'))
+    assert set(registry.get_sessions('alice')) == {'phone', 'laptop'}
+
+    assert not registry.remove('alice', 'phone', on_offline=lambda: events.append('offline'))
+    assert registry.get_sessions('alice') == ['laptop']
+    assert registry.remove('alice', 'laptop', on_offline=lambda: events.append('offline'))
+    assert not registry.is_online('alice')
+    assert events == ['online', 'offline']
+
+
+def test_owner_follows_sessions():
+    registry = SessionRegistry()
+    registry.add('alice', 'phone')
+    registry.add('alice', 'laptop')
+    assert registry.owner('phone') == 'alice'
+    registry.remove('alice', 'phone')
+    assert registry.owner('phone') is None
+    assert registry.owner('laptop') == 'alice'
+
+
+def test_remove_all_sessions():
+    registry = SessionRegistry()
+    registry.add('alice', 'phone')
+    registry.add('alice', 'laptop')
+    assert registry.remove('alice')
+    assert registry.get_sessions('alice') == []
+    assert registry.owner('phone') is None and registry.owner('laptop') is None
+
+
+def test_remove_unknown_session():
+    registry = SessionRegistry()
+    registry.add('alice', 'phone')
+    assert not registry.remove('alice', 'tablet')
+    assert not registry.remove('bob', 'phone')
+    assert registry.get_sessions('alice') == ['phone']
+    assert registry.owner('phone') == 'alice'
+
+
+def test_same_session_added_twice():
+    registry = SessionRegistry()
+    registry.add('alice', 'phone')
+    registry.add('alice', 'phone')
+    assert registry.get_sessions('alice') == ['phone']
+    assert registry.remove('alice', 'phone')
@@ -0,0 +1,32 @@
+'''
+向运行中的服务器发送管理命令（需要在服务器所在机器上运行）
+用法: python ./tool/admin.py [--socket chat-admin.sock] <命令>
+    python ./tool/admin.py profile sample 30
+    python ./tool/admin.py profile cprofile 10
+    python ./tool/admin.py tracemalloc snapshot
+    python ./tool/admin.py trace on users=user1
+不带命令时列出所有命令
+'''
+import argparse
+import socket
+
+
+def send_command(path, command):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client_socket:
+        client_socket.connect(path)
+        client_socket.sendall(' '.join(command).encode('utf-8') + b'\n')
+        data = b''
+        while True:
+            chunk = client_socket.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    return data.decode('utf-8')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ChatApp server admin')
+    parser.add_argument('--socket', default='chat-admin.sock', help='服务器 config.ini 中的 [Admin] socket_path')
+    parser.add_argument('command', nargs=argparse.REMAINDER)
+    args = parser.parse_args()
+    print(send_command(args.socket, args.command or ['help']), end='')
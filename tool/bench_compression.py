@@ -0,0 +1,131 @@
+'''
+帧压缩带宽测试：按服务器实际发送的帧格式生成几类典型流量，比较不压缩、zlib 和 zstd（已安装 zstandard 时）的线上字节数
+用法: python ./tool/bench_compression.py [--friends 500] [--messages 1000] [--burst 200] [--output result.json]
+
+- heartbeat: 客户端心跳，小于 min_size 不压缩，只增加 5 字节帧头
+- chat: 一个连接上收到的私聊消息，来自 5 个好友，内容为随机中英文短句
+- friend_list: 登录后完整同步一次好友列表（带在线状态）
+- redelivery: 重新登录时补发的未确认消息，连续发送
+每类流量使用新的 FrameCodec，相当于一个新连接；3g_ms 为按 impair_proxy 的 3g 带宽估算的传输时间
+'''
+import argparse
+import json
+import random
+import sys
+import time
+import uuid
+
+sys.path.append(".")
+sys.path.append("./server")
+from utils import MessageBuilder as mb
+from utils import Compression, FrameCodec, Protocol
+from delivery import DeliveryTracker
+from impair_proxy import PRESETS
+
+WORDS = [
+    'ok', 'thanks', 'see you', 'lunch?', 'meeting at 3', 'on my way', 'sounds good', 'haha',
+    '好的', '收到', '明天见', '在吗', '文件发你了', '晚上一起吃饭', '我看一下', '没问题'
+]
+
+
+def chat_content(rng):
+    return ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 8)))
+
+
+def delivered_message(rng, sender, receiver, seq):
+    request = mb.build_send_personal_message_request(sender, receiver, chat_content(rng))
+    conversation = DeliveryTracker.personal_conversation(sender, receiver)
+    return dict(request['request_data'], conversation=conversation, seq=seq, epoch=uuid.uuid4().hex[:16])
+
+
+def heartbeat_frames(args, rng):
+    return [Protocol.encode(mb.build_heartbeat('user0')) for _ in range(args.messages)]
+
+
+def chat_frames(args, rng):
+    friends = [f'user{index}' for index in range(1, 6)]
+    return [
+        Protocol.encode(delivered_message(rng, rng.choice(friends), 'user0', seq))
+        for seq in range(1, args.messages + 1)
+    ]
+
+
+def friend_list_frames(args, rng):
+    friends = {f'friend_{uuid.uuid4().hex[:8]}': rng.random() < 0.3 for _ in range(args.friends)}
+    data = mb.build_friends_sync_data(1, friends=friends)
+    return [Protocol.encode(mb.build_response(True, 'Get friends success', time.time(), data))]
+
+
+def redelivery_frames(args, rng):
+    friends = [f'user{index}' for index in range(1, 21)]
+    return [
+        Protocol.encode(delivered_message(rng, rng.choice(friends), 'user0', seq))
+        for seq in range(1, args.burst + 1)
+    ]
+
+
+SCENARIOS = {
+    'heartbeat': heartbeat_frames,
+    'chat': chat_frames,
+    'friend_list': friend_list_frames,
+    'redelivery': redelivery_frames
+}
+
+
+def measure(frames, algorithm, args):
+    '''
+    返回 (线上字节数, 每帧编码耗时 us)，同时检查解码结果与原始帧一致
+    '''
+    if algorithm is None:
+        return sum(len(frame) for frame in frames), 0.0
+    encoder = FrameCodec(algorithm, args.min_size, args.level)
+    decoder = FrameCodec(algorithm, args.min_size, args.level)
+    started = time.perf_counter()
+    encoded = [encoder.encode(frame) for frame in frames]
+    elapsed = time.perf_counter() - started
+    decoded = decoder.feed(b''.join(encoded))
+    if [bytes(frame) for frame in decoded] != [frame[:-len(Protocol.DELIMITER)] for frame in frames]:
+        raise RuntimeError(f'{algorithm} round trip mismatch')
+    return sum(len(data) for data in encoded), elapsed / len(frames) * 1e6
+
+
+def run(args):
+    bandwidth = PRESETS['3g']['bandwidth'] * 1024
+    algorithms = [None] + Compression.available()
+    results = {}
+    for name, build in SCENARIOS.items():
+        frames = build(args, random.Random(args.seed))
+        results[name] = {}
+        for algorithm in algorithms:
+            wire, encode_us = measure(frames, algorithm, args)
+            results[name][algorithm or 'raw'] = {
+                'frames': len(frames),
+                'bytes': wire,
+                'ratio': wire / results[name]['raw']['bytes'] if algorithm else 1.0,
+                'encode_us': encode_us,
+                '3g_ms': wire / bandwidth * 1000
+            }
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare frame compression bandwidth')
+    parser.add_argument('--friends', type=int, default=500, help='好友列表中的好友数')
+    parser.add_argument('--messages', type=int, default=1000, help='chat 和 heartbeat 的帧数')
+    parser.add_argument('--burst', type=int, default=200, help='重新登录时补发的消息数')
+    parser.add_argument('--min-size', type=int, default=128, help='小于该字节数的帧不压缩')
+    parser.add_argument('--level', type=int, default=6)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='结果写入的 JSON 文件')
+    args = parser.parse_args()
+    results = run(args)
+    print(f"{'scenario':<12} {'codec':<5} {'frames':>7} {'bytes':>10} {'ratio':>7} {'encode us':>10} {'3g ms':>9}")
+    for name, codecs in results.items():
+        for codec, result in codecs.items():
+            print(
+                f"{name:<12} {codec:<5} {result['frames']:>7} {result['bytes']:>10} {result['ratio']:>7.3f} "
+                f"{result['encode_us']:>10.1f} {result['3g_ms']:>9.1f}"
+            )
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
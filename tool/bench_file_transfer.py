@@ -0,0 +1,255 @@
+'''
+文件传输性能测试，在本机回环地址上直接驱动服务器的 FileTransferServer，不需要启动服务器
+用法: python ./tool/bench_file_transfer.py [--sizes 1,16,64] [--chunk-sizes 1024,65536] [--concurrency 1,4]
+
+- 测试文件由 filemaker.py 生成，分为可压缩（text）和不可压缩（random）两种
+- 模式: upload（客户端 -> 服务器）、download（服务器 -> 客户端）、relay（上传后再下载，与实际转发流程相同）
+- 每组参数在独立的子进程中运行并重复多次，记录吞吐量、CPU 时间和峰值内存
+- 结果追加到历史文件（按 git 提交区分），并与上一个提交的结果对比，列出性能退化的项
+- --impair 时客户端经过网络损伤代理连接服务器（见 impair_proxy.py），例如 --impair dsl
+'''
+import argparse
+import concurrent.futures
+import itertools
+import json
+import os
+import resource
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from filemaker import create_file
+from impair_proxy import Impairment, start_in_thread
+
+MB = 1024 * 1024
+
+
+def upload(port, ticket, file_path, chunk_size):
+    with socket.create_connection(('127.0.0.1', port)) as client_socket, open(file_path, 'rb') as f:
+        client_socket.sendall(ticket.encode('ascii'))
+        while True:
+            data = f.read(chunk_size)
+            if not data:
+                break
+            client_socket.sendall(data)
+
+
+def download(port, ticket, file_path, chunk_size):
+    with socket.create_connection(('127.0.0.1', port)) as client_socket, open(file_path, 'wb') as f:
+        client_socket.sendall(ticket.encode('ascii'))
+        while True:
+            data = client_socket.recv(chunk_size)
+            if not data:
+                break
+            f.write(data)
+
+
+def run_transfers(pool, server, port, phase, sources, targets, chunk_size):
+    '''
+    同时进行 len(sources) 个传输，每个传输先在服务器登记，客户端凭 ticket 连接
+    '''
+    if phase == 'upload':
+        transfers = [server.open('upload', target, chunk_size) for target in targets]
+        client_jobs = [
+            pool.submit(upload, port, transfer.ticket, source, chunk_size)
+            for transfer, source in zip(transfers, sources)
+        ]
+    else:
+        transfers = [server.open('download', source, chunk_size) for source in sources]
+        client_jobs = [
+            pool.submit(download, port, transfer.ticket, target, chunk_size)
+            for transfer, target in zip(transfers, targets)
+        ]
+    for job in client_jobs:
+        job.result()
+    for transfer in transfers:
+        transfer.result.result()
+
+
+def run_one(spec):
+    '''
+    子进程中执行一组测试，返回测量结果
+    '''
+    os.environ['LOCAL'] = 'True'
+    sys.path.insert(0, './server')
+    import server as chat_server
+
+    config = chat_server.Config()
+    config.file_transfer_port = 0  # 使用临时端口，不影响正在运行的服务器
+    server = chat_server.FileTransferServer(None)
+    server.start()
+    port = server.socket.getsockname()[1]
+    if spec.get('impair'):
+        (port, ), _ = start_in_thread([(0, port)], '127.0.0.1', Impairment.parse(spec['impair']))
+
+    concurrency = spec['concurrency']
+    work_dir = tempfile.mkdtemp(prefix='bench-file-')
+    uploaded = [os.path.join(work_dir, f'uploaded-{i}') for i in range(concurrency)]
+    downloaded = [os.path.join(work_dir, f'downloaded-{i}') for i in range(concurrency)]
+    sources = [spec['file']] * concurrency
+
+    usage_before = resource.getrusage(resource.RUSAGE_SELF)
+    started = time.perf_counter()
+    with concurrent.futures.ThreadPoolExecutor(2 * concurrency) as pool:
+        if spec['mode'] == 'upload':
+            run_transfers(pool, server, port, 'upload', sources, uploaded, spec['chunk_size'])
+            outputs = uploaded
+        elif spec['mode'] == 'download':
+            run_transfers(pool, server, port, 'download', sources, downloaded, spec['chunk_size'])
+            outputs = downloaded
+        else:
+            run_transfers(pool, server, port, 'upload', sources, uploaded, spec['chunk_size'])
+            run_transfers(pool, server, port, 'download', uploaded, downloaded, spec['chunk_size'])
+            outputs = downloaded
+    elapsed = time.perf_counter() - started
+    usage_after = resource.getrusage(resource.RUSAGE_SELF)
+
+    expected = os.path.getsize(spec['file'])
+    complete = all(os.path.getsize(path) == expected for path in outputs)
+    for path in uploaded + downloaded:
+        if os.path.exists(path):
+            os.remove(path)
+    os.rmdir(work_dir)
+    server.socket.close()
+
+    total_bytes = expected * concurrency
+    cpu = (usage_after.ru_utime - usage_before.ru_utime) + (usage_after.ru_stime - usage_before.ru_stime)
+    return {
+        'seconds': elapsed,
+        'throughput_mb_s': total_bytes / MB / elapsed,
+        'cpu_seconds': cpu,
+        'cpu_per_mb_ms': cpu / (total_bytes / MB) * 1000,
+        'peak_rss_mb': usage_after.ru_maxrss / 1024,  # Linux 下单位为 KB
+        'complete': complete
+    }
+
+
+def run_isolated(spec):
+    output = subprocess.run(
+        [sys.executable, __file__, '--run-one', json.dumps(spec)], capture_output=True, text=True, check=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def run_key(run):
+    key = f"{run['mode']}/{run['kind']}/{run['size_mb']}MB/chunk{run['chunk_size']}/x{run['concurrency']}"
+    return f"{key}/{run['impair']}" if run.get('impair') else key
+
+
+def load_history(history_file):
+    if not os.path.exists(history_file):
+        return []
+    with open(history_file) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def report(result, baseline, threshold):
+    '''
+    打印本次结果，并与基线对比：吞吐量下降或 CPU/内存上升超过 threshold 视为退化
+    '''
+    previous = {run_key(run): run for run in baseline['runs']} if baseline else {}
+    print(f"{'run':<44} {'MB/s':>9} {'cpu ms/MB':>10} {'rss MB':>8}  change")
+    regressions = []
+    for run in result['runs']:
+        key = run_key(run)
+        change = ''
+        old = previous.get(key)
+        if old is not None:
+            throughput = run['throughput_mb_s'] / old['throughput_mb_s'] - 1
+            cpu = run['cpu_per_mb_ms'] / old['cpu_per_mb_ms'] - 1 if old['cpu_per_mb_ms'] else 0
+            rss = run['peak_rss_mb'] / old['peak_rss_mb'] - 1
+            change = f'{throughput * 100:+.1f}% MB/s, {cpu * 100:+.1f}% cpu, {rss * 100:+.1f}% rss'
+            if throughput < -threshold or cpu > threshold or rss > threshold:
+                regressions.append(key)
+                change += '  REGRESSION'
+        if not run['complete']:
+            change += '  INCOMPLETE'
+        print(
+            f"{key:<44} {run['throughput_mb_s']:>9.1f} {run['cpu_per_mb_ms']:>10.2f} {run['peak_rss_mb']:>8.1f}  {change}"
+        )
+    if baseline:
+        print(f"\nCompared with {baseline['commit']} ({baseline['timestamp']}): {len(regressions)} regressions")
+    return regressions
+
+
+def parse_list(value):
+    return [int(item) for item in value.split(',')]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='File transfer benchmark')
+    parser.add_argument('--sizes', type=parse_list, default=[1, 16, 64], help='文件大小 (MB)，逗号分隔')
+    parser.add_argument('--kinds', default='text,random', help='文件类型: zeros,text,random')
+    parser.add_argument('--modes', default='upload,download,relay')
+    parser.add_argument('--chunk-sizes', type=parse_list, default=[1024, 65536])
+    parser.add_argument('--concurrency', type=parse_list, default=[1, 4])
+    parser.add_argument('--repeat', type=int, default=3, help='每组参数重复运行的次数')
+    parser.add_argument('--history', default='bench_file_transfer.jsonl', help='历史结果文件，每行一次运行')
+    parser.add_argument('--baseline', help='指定对比的提交，默认为历史中上一个不同的提交')
+    parser.add_argument('--threshold', type=float, default=0.2, help='判定退化的相对变化')
+    parser.add_argument('--impair', help='网络损伤参数，例如 dsl 或 latency=50,bandwidth=1024，见 impair_proxy.py')
+    parser.add_argument('--run-one', help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def main(args):
+    data_dir = tempfile.mkdtemp(prefix='bench-data-')
+    runs = []
+    try:
+        files = {}
+        for kind, size in itertools.product(args.kinds.split(','), args.sizes):
+            files[kind, size] = os.path.join(data_dir, f'{kind}-{size}MB.bin')
+            create_file(files[kind, size], size * MB, kind)
+        matrix = itertools.product(
+            args.modes.split(','), args.kinds.split(','), args.sizes, args.chunk_sizes, args.concurrency
+        )
+        for mode, kind, size, chunk_size, concurrency in matrix:
+            spec = {
+                'mode': mode,
+                'kind': kind,
+                'size_mb': size,
+                'chunk_size': chunk_size,
+                'concurrency': concurrency,
+                'impair': args.impair,
+                'file': files[kind, size]
+            }
+            # 单次结果波动较大，重复运行后取吞吐量为中位数的一次
+            samples = sorted((run_isolated(spec) for _ in range(args.repeat)), key=lambda r: r['throughput_mb_s'])
+            run = dict(spec, **samples[len(samples) // 2])
+            del run['file']
+            runs.append(run)
+            print(f"{run_key(run):<44} {run['throughput_mb_s']:>9.1f} MB/s", file=sys.stderr)
+    finally:
+        for path in os.listdir(data_dir):
+            os.remove(os.path.join(data_dir, path))
+        os.rmdir(data_dir)
+
+    result = {'commit': git_commit(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'runs': runs}
+    history = load_history(args.history)
+    if args.baseline:
+        candidates = [entry for entry in history if entry['commit'] == args.baseline]
+    else:
+        candidates = [entry for entry in history if entry['commit'] != result['commit']]
+    regressions = report(result, candidates[-1] if candidates else None, args.threshold)
+    with open(args.history, 'a') as f:
+        f.write(json.dumps(result) + '\n')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.run_one:
+        print(json.dumps(run_one(json.loads(args.run_one))))
+    else:
+        sys.exit(main(args))
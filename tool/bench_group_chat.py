@@ -0,0 +1,148 @@
+'''
+群聊投递延迟测试，需要先在仓库根目录启动本地服务器 (LOCAL=True python ./server/server.py)
+用法: python ./tool/bench_group_chat.py [群规模,逗号分隔] [每组消息数] [users.db 路径]
+
+测试账户默认通过 register 请求创建（测试服务器需要关闭 [RateLimit] 或调大 register 的限额），
+指定 users.db 路径时改为直接写入服务器的数据库（共用同一个密码哈希），省去成千上万次 bcrypt 注册
+所有成员都用自己的连接登录并加入群组，登录并发数为 AUTH_CONCURRENCY
+'''
+import selectors
+import socket
+import sqlite3
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(".")
+from utils import MessageBuilder as mb
+from utils import Utils
+from utils import FrameBuffer, Protocol
+
+HOST, PORT = '127.0.0.1', 9999
+PASSWORD = '123'
+AUTH_CONCURRENCY = 8  # 登录和注册都要做 bcrypt，排队超过 password_timeout 的请求会被服务器拒绝
+
+
+class BenchConnection:
+
+    def __init__(self, username):
+        self.username = username
+        self.socket = socket.create_connection((HOST, PORT))
+        self.frame_buffer = FrameBuffer()
+
+    def send(self, message):
+        self.socket.sendall(Protocol.encode(message))
+
+    def read_frames(self):
+        data = self.socket.recv(65536)
+        if not data:
+            raise ConnectionResetError
+        return [Protocol.decode(frame) for frame in self.frame_buffer.feed(data)]
+
+    def call(self, message):
+        self.send(message)
+        while True:
+            for frame in self.read_frames():
+                if frame.get('type') == 'response':
+                    return frame
+
+    def login(self, password=PASSWORD):
+        response = self.call(mb.build_login_request(self.username, password))
+        if not response['success']:
+            raise RuntimeError(f"{self.username} failed to log in: {response['message']}")
+        return self
+
+
+def register_accounts(usernames, password=PASSWORD):
+    '''
+    通过 register 请求创建账户，已存在或被限流的注册忽略，账户不存在时之后的登录会报错
+    '''
+    def register(username):
+        connection = BenchConnection(username)
+        connection.call(mb.build_register_request(username, password))
+        connection.socket.close()
+
+    with ThreadPoolExecutor(AUTH_CONCURRENCY) as pool:
+        list(pool.map(register, usernames))
+
+
+def login_all(usernames, password=PASSWORD):
+    with ThreadPoolExecutor(AUTH_CONCURRENCY) as pool:
+        return list(pool.map(lambda username: BenchConnection(username).login(password), usernames))
+
+
+def prepare_accounts(db_file, usernames, password=PASSWORD):
+    '''
+    直接写入服务器数据库创建账户，只用于显式指定数据库路径的测试
+    '''
+    conn = sqlite3.connect(db_file)
+    password_hash = Utils.hash_password(password)
+    conn.executemany(
+        'INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)',
+        [(username, password_hash) for username in usernames]
+    )
+    conn.commit()
+    conn.close()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def bench(size, message_count, db_file):
+    sender_name = f'gs{size}'
+    member_names = [f'gm{size}_{i}' for i in range(size - 1)]
+    group = f'bench{size}'
+    if db_file:
+        prepare_accounts(db_file, [sender_name] + member_names)
+    else:
+        register_accounts([sender_name] + member_names)
+
+    sender = BenchConnection(sender_name).login()
+    sender.call(mb.build_create_group_request(sender_name, group))
+    members = login_all(member_names)
+    with ThreadPoolExecutor(AUTH_CONCURRENCY) as pool:
+        list(pool.map(lambda member: member.call(mb.build_join_group_request(member.username, group)), members))
+
+    selector = selectors.DefaultSelector()
+    for member in members:
+        member.socket.setblocking(False)
+        selector.register(member.socket, selectors.EVENT_READ, member)
+
+    latencies, completions = [], []
+    for index in range(message_count):
+        sent_at = time.perf_counter()
+        message = mb.build_send_group_message_request(sender_name, group, f'bench message {index}')
+        sender.send(message)
+        remaining = len(members)
+        while remaining:
+            events = selector.select(timeout=10)
+            if not events:
+                raise TimeoutError(f'{remaining} members did not receive message {index}')
+            for key, _ in events:
+                for frame in key.data.read_frames():
+                    if frame.get('type') == 'group_message':
+                        latencies.append(time.perf_counter() - sent_at)
+                        remaining -= 1
+        completions.append(time.perf_counter() - sent_at)
+
+    for member in members:
+        selector.unregister(member.socket)
+        member.socket.close()
+    sender.socket.close()
+    print(
+        f'members={size:<5} messages={message_count} '
+        f'p50={percentile(latencies, 50) * 1000:.2f}ms '
+        f'p95={percentile(latencies, 95) * 1000:.2f}ms '
+        f'p99={percentile(latencies, 99) * 1000:.2f}ms '
+        f'all-delivered(avg)={sum(completions) / len(completions) * 1000:.2f}ms'
+    )
+
+
+if __name__ == '__main__':
+    sizes = [int(size) for size in sys.argv[1].split(',')] if len(sys.argv) > 1 else [10, 500, 5000]
+    message_count = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    db_file = sys.argv[3] if len(sys.argv) > 3 else None
+    for size in sizes:
+        bench(size, message_count, db_file)
@@ -0,0 +1,102 @@
+'''
+服务器内存占用测试：用 tracemalloc 测量每个在线会话、每条未确认消息和每个离线文件的内存开销
+用法: python ./tool/bench_memory.py [--entries 100000]
+
+- 在线会话: SessionRegistry 中的会话 + 该连接的 OutboundQueue，不包括 socket 本身
+- 未确认消息: DeliveryTracker 中保存的消息，每个接收者 10 条、来自 5 个好友；payload 预先生成，不计入
+- 离线文件: 等待接收者上线的文件记录
+用户名都经过 JSON 解码得到，与服务器收到的请求一样，每次都是新的字符串对象
+'''
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+os.environ['LOCAL'] = 'True'
+sys.path.insert(0, './server')
+from sessions import SessionRegistry
+from outbound import OutboundQueue
+from delivery import DeliveryTracker
+from server import OfflineFile
+
+
+class SyntheticSocket:
+
+    def getpeername(self):
+        return ('127.0.0.1', 50000)
+
+
+def decoded(value):
+    return json.loads(json.dumps(value))
+
+
+def measure(entries, build):
+    '''
+    返回 build() 创建的对象平均每个条目占用的字节数
+    '''
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    kept = build()
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del kept
+    return (after - before) / entries
+
+
+def online_sessions(usernames, sockets):
+    registry = SessionRegistry()
+    outbound_queues = {}
+    for username, client_socket in zip(usernames, sockets):
+        registry.add(decoded(username), client_socket)
+        outbound_queues[client_socket] = OutboundQueue(client_socket)
+    return registry, outbound_queues
+
+
+def unacked_messages(usernames, payloads):
+    delivery = DeliveryTracker(max_unacked=1000)
+    for index, payload in enumerate(payloads):
+        recipient = usernames[index // 10]
+        sender = usernames[(index // 10 + index % 5 + 1) % len(usernames)]
+        conversation = delivery.personal_conversation(decoded(recipient), decoded(sender))
+        delivery.track(decoded(recipient), conversation, index, payload)
+    return delivery
+
+
+def offline_files(usernames, entries):
+    message_queues = {}
+    for index in range(entries):
+        request_data = decoded({
+            'sender': usernames[(index // 10 + index % 5 + 1) % len(usernames)],
+            'receiver': usernames[index // 10],
+            'file_name': f'report-{index}.pdf',
+            'file_size': 123456,
+            'chunk_size': 1024,
+            'timestamp': 1760000000.123
+        })
+        offline_file = OfflineFile(
+            request_data['sender'], request_data['receiver'], request_data['file_name'], request_data['file_size'],
+            request_data['chunk_size'], request_data['timestamp']
+        )
+        message_queues.setdefault(sys.intern(request_data['receiver']), []).append(offline_file)
+    return message_queues
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure per-entry memory of server state')
+    parser.add_argument('--entries', type=int, default=100000)
+    parser.add_argument('--payload-size', type=int, default=150, help='未确认消息的编码后字节数（不计入结果）')
+    args = parser.parse_args()
+    usernames = [f'user{i}' for i in range(args.entries)]
+    sockets = [SyntheticSocket() for _ in range(args.entries)]
+    payloads = [os.urandom(args.payload_size) for _ in range(args.entries)]
+    results = {
+        'online_session_bytes': measure(args.entries, lambda: online_sessions(usernames, sockets)),
+        'unacked_message_bytes': measure(args.entries, lambda: unacked_messages(usernames, payloads)),
+        'offline_file_bytes': measure(args.entries, lambda: offline_files(usernames, args.entries))
+    }
+    for name, value in results.items():
+        print(f'{name:<24} {value:>8.0f}')
@@ -0,0 +1,48 @@
+'''
+SessionRegistry 压力测试：多个线程并发上线/下线大量会话，统计吞吐并检查最终状态一致
+用法: python ./tool/bench_session_registry.py [sessions] [threads]
+'''
+import sys
+import threading
+import time
+
+sys.path.append("./server")
+from sessions import SessionRegistry
+
+
+def churn(registry, sessions, rounds):
+    for _ in range(rounds):
+        for username, session in sessions:
+            registry.add(username, session)
+        for username, session in sessions:
+            registry.remove(username, session)
+
+
+def run(shard_count, session_count, thread_count, rounds=5, devices_per_user=3):
+    registry = SessionRegistry(shard_count)
+    # 每个用户有 devices_per_user 个设备，分散到不同线程，制造同一用户上的竞争
+    all_sessions = [(f'user{i // devices_per_user}', object()) for i in range(session_count)]
+    parts = [all_sessions[i::thread_count] for i in range(thread_count)]
+    threads = [threading.Thread(target=churn, args=(registry, part, rounds)) for part in parts]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    operations = session_count * rounds * 2
+    consistent = registry.online_count() == 0 and registry.session_count() == 0
+    print(
+        f'shards={shard_count:<4} sessions={session_count} threads={thread_count} '
+        f'ops={operations} time={elapsed:.3f}s ops/s={operations / elapsed:,.0f} consistent={consistent}'
+    )
+    return consistent
+
+
+if __name__ == '__main__':
+    session_count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    thread_count = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    ok = True
+    for shard_count in (1, 16, 64):
+        ok = run(shard_count, session_count, thread_count) and ok
+    sys.exit(0 if ok else 1)
@@ -0,0 +1,199 @@
+'''
+TLS 性能测试，在本机回环地址上直接驱动服务器的 FileTransferServer，不需要启动服务器
+用法: python ./tool/bench_tls.py [--connections 200] [--size 64] [--output result.json]
+
+- 证书由 make_cert.py 在临时目录中生成（需要 openssl 命令）
+- 模式: tcp（不加密）、tls（每个连接完整握手）、tls-resumed（所有连接共用一个 ResumableSSLContext，复用会话票据）
+- handshake: 依次建立 --connections 个连接，每个连接下载一个 1 KB 的文件，相当于大量短文件数据连接，
+  记录客户端握手耗时和整个连接耗时的 p50/p99，以及进程 CPU 时间（包括服务器线程）
+- throughput: 上传和下载 --size MB 的随机数据，记录吞吐量和每 MB 的 CPU 时间；
+  --chunk-size 为客户端在请求中声明的分块大小（默认与 default_chunk_size 相同），服务器按不小于 256 KB 的块读写
+'''
+import argparse
+import json
+import os
+import resource
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+sys.path.append(".")
+from utils import ResumableSSLContext
+from bench_group_chat import percentile
+from make_cert import make_cert
+
+MB = 1024 * 1024
+MODES = ('tcp', 'tls', 'tls-resumed')
+
+
+def cpu_seconds():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class Client:
+
+    def __init__(self, port, mode, ca_file):
+        self.port = port
+        self.mode = mode
+        self.ca_file = ca_file
+        self.context = ResumableSSLContext.create(ca_file) if mode == 'tls-resumed' else None
+
+    def connect(self):
+        '''
+        返回 (socket, 握手秒数, 是否恢复了会话)
+        '''
+        client_socket = socket.create_connection(('127.0.0.1', self.port))
+        if self.mode == 'tcp':
+            return client_socket, 0.0, False
+        context = self.context or ResumableSSLContext.create(self.ca_file)
+        started = time.perf_counter()
+        client_socket = context.wrap_socket(client_socket, server_hostname='localhost')
+        return client_socket, time.perf_counter() - started, client_socket.session_reused
+
+    def download(self, ticket, chunk_size=65536):
+        client_socket, handshake, resumed = self.connect()
+        size = 0
+        with client_socket:
+            client_socket.sendall(ticket.encode('ascii'))
+            while True:
+                data = client_socket.recv(chunk_size)
+                if not data:
+                    break
+                size += len(data)
+        return size, handshake, resumed
+
+    def upload(self, ticket, file_path, chunk_size=65536):
+        client_socket, handshake, resumed = self.connect()
+        with client_socket, open(file_path, 'rb') as f:
+            client_socket.sendall(ticket.encode('ascii'))
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                client_socket.sendall(data)
+            if self.mode != 'tcp':
+                # 服务器发来的会话票据没有被读取，直接 close 会发送 RST，服务器可能丢失最后的数据；
+                # 先发送 close_notify 并读到服务器关闭连接
+                try:
+                    client_socket.unwrap()
+                except OSError:
+                    pass
+        return handshake, resumed
+
+
+def bench_handshakes(server, client, small_file, connections):
+    if client.mode == 'tls-resumed':
+        client.download(server.open('download', small_file, 1024).ticket)  # 取得第一张会话票据
+    handshakes, totals = [], []
+    resumed = 0
+    cpu = cpu_seconds()
+    for _ in range(connections):
+        transfer = server.open('download', small_file, 1024)
+        started = time.perf_counter()
+        _, handshake, reused = client.download(transfer.ticket)
+        transfer.result.result()
+        totals.append(time.perf_counter() - started)
+        handshakes.append(handshake)
+        resumed += reused
+    cpu = cpu_seconds() - cpu
+    return {
+        'connections': connections,
+        'resumed': resumed,
+        'handshake_p50_ms': percentile(handshakes, 50) * 1000,
+        'handshake_p99_ms': percentile(handshakes, 99) * 1000,
+        'connection_p50_ms': percentile(totals, 50) * 1000,
+        'connection_p99_ms': percentile(totals, 99) * 1000,
+        'cpu_per_connection_ms': cpu / connections * 1000
+    }
+
+
+def bench_throughput(server, client, data_file, work_dir, chunk_size):
+    size = os.path.getsize(data_file)
+    results = {}
+    for direction in ('upload', 'download'):
+        if direction == 'upload':
+            transfer = server.open('upload', os.path.join(work_dir, 'uploaded.bin'), chunk_size, size)
+        else:
+            transfer = server.open('download', data_file, chunk_size)
+        cpu = cpu_seconds()
+        started = time.perf_counter()
+        if direction == 'upload':
+            client.upload(transfer.ticket, data_file)
+        else:
+            client.download(transfer.ticket)
+        complete = transfer.result.result()
+        elapsed = time.perf_counter() - started
+        cpu = cpu_seconds() - cpu
+        results[direction] = {
+            'throughput_mb_s': size / MB / elapsed,
+            'cpu_per_mb_ms': cpu / (size / MB) * 1000,
+            'complete': complete
+        }
+    return results
+
+
+def main(args):
+    os.environ['LOCAL'] = 'True'
+    sys.path.insert(0, './server')
+    import server as chat_server
+    import tls
+
+    work_dir = tempfile.mkdtemp(prefix='bench-tls-')
+    try:
+        cert_file, key_file = os.path.join(work_dir, 'server.crt'), os.path.join(work_dir, 'server.key')
+        make_cert(cert_file, key_file, ['localhost', '127.0.0.1'])
+        small_file, data_file = os.path.join(work_dir, 'small.bin'), os.path.join(work_dir, 'data.bin')
+        with open(small_file, 'wb') as f:
+            f.write(os.urandom(1024))
+        with open(data_file, 'wb') as f:
+            f.write(os.urandom(args.size * MB))
+
+        config = chat_server.Config()
+        config.file_transfer_port = 0  # 使用临时端口，不影响正在运行的服务器
+        context = tls.create_server_context(cert_file, key_file, config.tls_session_tickets)
+        results = {}
+        for mode in MODES:
+            server = chat_server.FileTransferServer(None, None if mode == 'tcp' else context)
+            server.start()
+            client = Client(server.socket.getsockname()[1], mode, cert_file)
+            results[mode] = {
+                'handshake': bench_handshakes(server, client, small_file, args.connections),
+                'throughput': bench_throughput(server, client, data_file, work_dir, args.chunk_size)
+            }
+            server.socket.close()
+        return results
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def report(results):
+    print(f"{'mode':<12} {'resumed':>8} {'hs p50 ms':>10} {'hs p99 ms':>10} {'conn p50 ms':>12} {'cpu ms/conn':>12}")
+    for mode, result in results.items():
+        handshake = result['handshake']
+        print(
+            f"{mode:<12} {handshake['resumed']:>8} {handshake['handshake_p50_ms']:>10.2f} "
+            f"{handshake['handshake_p99_ms']:>10.2f} {handshake['connection_p50_ms']:>12.2f} "
+            f"{handshake['cpu_per_connection_ms']:>12.2f}"
+        )
+    print(f"\n{'mode':<12} {'direction':<9} {'MB/s':>9} {'cpu ms/MB':>10}")
+    for mode, result in results.items():
+        for direction, run in result['throughput'].items():
+            flag = '' if run['complete'] else '  INCOMPLETE'
+            print(f"{mode:<12} {direction:<9} {run['throughput_mb_s']:>9.1f} {run['cpu_per_mb_ms']:>10.2f}{flag}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TLS handshake and throughput benchmark')
+    parser.add_argument('--connections', type=int, default=200, help='握手测试的连接数')
+    parser.add_argument('--size', type=int, default=64, help='吞吐量测试的数据大小 (MB)')
+    parser.add_argument('--chunk-size', type=int, default=1024, help='请求中声明的分块大小')
+    parser.add_argument('--output', help='结果写入的 JSON 文件')
+    args = parser.parse_args()
+    results = main(args)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(results, fp, indent=2)
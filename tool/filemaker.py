@@ -1,8 +1,40 @@
-def create_large_file(file_path, size_in_mb):
+'''
+生成测试文件
+用法: python ./tool/filemaker.py [文件名] [大小 MB] [zeros|text|random]
+zeros/text 为可压缩数据，random 为不可压缩数据
+'''
+import os
+import sys
+
+KINDS = ('zeros', 'text', 'random')
+
+
+def create_file(file_path, size, kind='zeros', block_size=1024 * 1024):
+    '''
+    生成 size 字节的文件，按块写入，生成大文件时不会占用大量内存
+    '''
+    if kind == 'text':
+        line = b'The quick brown fox jumps over the lazy dog 0123456789\n'
+        block = (line * (block_size // len(line) + 1))[:block_size]
+    elif kind == 'zeros':
+        block = b'\0' * block_size
+    elif kind != 'random':
+        raise ValueError(f'Unknown file kind: {kind}')
     with open(file_path, 'wb') as f:
-        f.write(b'\0' * (size_in_mb * 1024 * 1024))
+        remaining = size
+        while remaining > 0:
+            length = min(block_size, remaining)
+            f.write(os.urandom(length) if kind == 'random' else block[:length])
+            remaining -= length
+
+
+def create_large_file(file_path, size_in_mb):
+    create_file(file_path, size_in_mb * 1024 * 1024)
+
 
-file_path = 'large_file.bin'
-size_in_mb = 110
-create_large_file(file_path, size_in_mb)
-print(f"File '{file_path}' created with size approximately {size_in_mb} MB.")
+if __name__ == '__main__':
+    file_path = sys.argv[1] if len(sys.argv) > 1 else 'large_file.bin'
+    size_in_mb = int(sys.argv[2]) if len(sys.argv) > 2 else 110
+    kind = sys.argv[3] if len(sys.argv) > 3 else 'zeros'
+    create_file(file_path, size_in_mb * 1024 * 1024, kind)
+    print(f"File '{file_path}' created with size approximately {size_in_mb} MB.")
@@ -0,0 +1,236 @@
+'''
+网络损伤代理：在客户端和服务器之间转发 TCP 数据，并加入延迟、抖动、带宽限制、乱序延迟和断线
+用法: python ./tool/impair_proxy.py --impair 3g [--map 19999:9999 --map 19998:9998]
+    客户端改为连接 19999（消息端口）和 19998（文件端口）
+
+--impair 为预设名称和/或 key=value，以逗号分隔，例如 "3g"、"latency=80,jitter=20,bandwidth=256"、"wifi,drop=30"
+    latency      单向延迟 (ms)
+    jitter       延迟的随机波动 (±ms)
+    bandwidth    每个方向的带宽 (KB/s)，0 表示不限制
+    reorder      数据块被额外延迟的概率，模拟乱序后 TCP 按序交付造成的队头阻塞
+    reorder_delay 额外延迟 (ms)
+    drop         每个连接平均存活秒数（指数分布），到期后强制断开，0 表示不断开
+    seed         随机种子，保证结果可重复
+
+代理转发的是字节流，不能真正打乱数据顺序；乱序表现为某个数据块被延迟，其后的数据块等待它一起交付
+也可以在其他工具中使用：loadtest.py 和 bench_file_transfer.py 的 --impair 参数会在进程内启动代理
+'''
+import argparse
+import asyncio
+import random
+import threading
+
+PRESETS = {
+    'lan': {'latency': 1, 'jitter': 0.5},
+    'wifi': {'latency': 10, 'jitter': 5, 'bandwidth': 5000, 'reorder': 0.01, 'reorder_delay': 30},
+    'dsl': {'latency': 25, 'jitter': 5, 'bandwidth': 1000},
+    '3g': {'latency': 100, 'jitter': 30, 'bandwidth': 200, 'reorder': 0.02, 'reorder_delay': 200},
+    'lossy': {'latency': 50, 'jitter': 40, 'bandwidth': 500, 'reorder': 0.1, 'reorder_delay': 300, 'drop': 60},
+    'satellite': {'latency': 300, 'jitter': 20, 'bandwidth': 1000}
+}
+
+
+class Impairment:
+
+    def __init__(
+        self, latency=0, jitter=0, bandwidth=0, reorder=0, reorder_delay=0, drop=0, seed=None, chunk_size=16384
+    ):
+        self.latency = latency / 1000
+        self.jitter = jitter / 1000
+        self.bandwidth = bandwidth * 1024
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay / 1000
+        self.drop = drop
+        self.random = random.Random(seed)
+        self.chunk_size = chunk_size
+
+    @staticmethod
+    def parse(spec):
+        '''
+        解析 "3g,drop=30" 形式的参数，后面的值覆盖前面的预设
+        '''
+        settings = {}
+        for item in (spec or '').split(','):
+            item = item.strip()
+            if not item:
+                continue
+            if '=' in item:
+                key, value = item.split('=', 1)
+                settings[key.strip()] = int(value) if key.strip() == 'seed' else float(value)
+            elif item in PRESETS:
+                settings.update(PRESETS[item])
+            else:
+                raise ValueError(f'Unknown impairment preset {item}, choose from {", ".join(PRESETS)}')
+        return Impairment(**settings)
+
+    def delay(self):
+        delay = max(0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+        if self.reorder and self.random.random() < self.reorder:
+            delay += self.reorder_delay
+        return delay
+
+    def lifetime(self):
+        return self.random.expovariate(1 / self.drop) if self.drop else None
+
+
+class ProxyStats:
+
+    def __init__(self):
+        self.connections = 0
+        self.drops = 0
+        self.bytes_up = 0  # 客户端 -> 服务器
+        self.bytes_down = 0
+
+    def __str__(self):
+        return (
+            f'{self.connections} connections, {self.drops} dropped, '
+            f'{self.bytes_up} bytes up, {self.bytes_down} bytes down'
+        )
+
+
+class ImpairedProxy:
+    '''
+    一个监听端口对应一个上游地址，每个连接的两个方向分别施加损伤
+    '''
+
+    def __init__(self, upstream_host, upstream_port, impairment, stats=None):
+        self.upstream_host = upstream_host
+        self.upstream_port = upstream_port
+        self.impairment = impairment
+        self.stats = stats or ProxyStats()
+        self.server = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.server = await asyncio.start_server(self.__handle, host, port)
+        return self.server.sockets[0].getsockname()[1]
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+
+    async def __handle(self, client_reader, client_writer):
+        try:
+            upstream_reader, upstream_writer = await asyncio.open_connection(self.upstream_host, self.upstream_port)
+        except OSError:
+            client_writer.transport.abort()
+            return
+        self.stats.connections += 1
+        pipes = [
+            asyncio.ensure_future(self.__pipe(client_reader, upstream_writer, 'bytes_up')),
+            asyncio.ensure_future(self.__pipe(upstream_reader, client_writer, 'bytes_down'))
+        ]
+        lifetime = self.impairment.lifetime()
+        done, _ = await asyncio.wait(pipes, timeout=lifetime)
+        if len(done) < len(pipes) and lifetime is not None:
+            # 模拟断线：不发送 FIN，直接中断两端
+            self.stats.drops += 1
+            for pipe in pipes:
+                pipe.cancel()
+            client_writer.transport.abort()
+            upstream_writer.transport.abort()
+            return
+        await asyncio.gather(*pipes, return_exceptions=True)
+        client_writer.close()
+        upstream_writer.close()
+
+    async def __pipe(self, reader, writer, counter):
+        '''
+        读取的数据块按到期时间进入队列，到期时间不早于前一块（按序交付），发送时按带宽限速
+        '''
+        loop = asyncio.get_running_loop()
+        impairment = self.impairment
+        queue = asyncio.Queue(maxsize=256)  # 相当于链路缓冲区，满了以后对发送方形成反压
+
+        async def receive():
+            last_due = 0
+            try:
+                while True:
+                    data = await reader.read(impairment.chunk_size)
+                    if not data:
+                        break
+                    last_due = max(loop.time() + impairment.delay(), last_due)
+                    await queue.put((last_due, data))
+            except OSError:
+                pass
+            await queue.put(None)
+
+        receiver = asyncio.ensure_future(receive())
+        next_send = loop.time()
+        try:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    break
+                due, data = item
+                if impairment.bandwidth:
+                    # 数据块按带宽计算发送完成时间，与传播延迟叠加
+                    next_send = max(next_send, loop.time()) + len(data) / impairment.bandwidth
+                    due = max(due, next_send)
+                delay = due - loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                writer.write(data)
+                await writer.drain()
+                setattr(self.stats, counter, getattr(self.stats, counter) + len(data))
+            if writer.can_write_eof():
+                writer.write_eof()  # 转发半关闭，文件上传以关闭连接表示结束
+        except OSError:
+            pass
+        finally:
+            receiver.cancel()
+
+
+async def start_proxies(mappings, upstream_host, impairment, listen_host='127.0.0.1'):
+    '''
+    mappings: [(监听端口, 上游端口)]，监听端口为 0 时使用临时端口
+    返回 (代理列表, 实际监听端口列表)，所有代理共用一个 ProxyStats
+    '''
+    stats = ProxyStats()
+    proxies = [ImpairedProxy(upstream_host, upstream_port, impairment, stats) for _, upstream_port in mappings]
+    ports = [await proxy.start(listen_host, listen_port) for proxy, (listen_port, _) in zip(proxies, mappings)]
+    return proxies, ports
+
+
+def start_in_thread(mappings, upstream_host, impairment):
+    '''
+    在后台线程的事件循环中运行代理，供同步代码（bench_file_transfer.py）使用，返回 (实际监听端口列表, ProxyStats)
+    '''
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name='impair-proxy', daemon=True).start()
+    proxies, ports = asyncio.run_coroutine_threadsafe(
+        start_proxies(mappings, upstream_host, impairment), loop
+    ).result()
+    return ports, proxies[0].stats
+
+
+def parse_mapping(value):
+    listen_port, upstream_port = value.split(':')
+    return int(listen_port), int(upstream_port)
+
+
+async def main(args):
+    mappings = args.map or [(19999, 9999), (19998, 9998)]
+    proxies, ports = await start_proxies(mappings, args.upstream, Impairment.parse(args.impair), args.listen)
+    for port, (_, upstream_port) in zip(ports, mappings):
+        print(f'{args.listen}:{port} -> {args.upstream}:{upstream_port}')
+    try:
+        while True:
+            await asyncio.sleep(args.report_interval)
+            print(proxies[0].stats)
+    finally:
+        for proxy in proxies:
+            await proxy.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='TCP proxy with network impairment')
+    parser.add_argument('--impair', default='', help=f'预设 ({", ".join(PRESETS)}) 和/或 key=value，逗号分隔')
+    parser.add_argument('--map', type=parse_mapping, action='append', help='监听端口:上游端口，可重复，默认 19999:9999 和 19998:9998')
+    parser.add_argument('--listen', default='127.0.0.1')
+    parser.add_argument('--upstream', default='127.0.0.1')
+    parser.add_argument('--report-interval', type=float, default=10, help='输出统计的间隔秒数')
+    try:
+        asyncio.run(main(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
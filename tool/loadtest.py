@@ -0,0 +1,311 @@
+'''
+压力测试，需要先在仓库根目录启动本地服务器 (LOCAL=True python ./server/server.py)
+用法: python ./tool/loadtest.py --users 1000 --rate 0.5 --duration 30 --output result.json
+
+模拟 N 个用户（基于 chat_sdk），按好友关系图互发私聊消息，可选同时进行文件传输，
+统计连接速率、消息吞吐量以及从发送时间戳到接收的端到端延迟 p50/p95/p99，结果写入 JSON
+每个虚拟用户都通过 register 请求创建账户（已存在时忽略）并用密码登录，注册和登录的并发数为 --auth-concurrency；
+测试服务器需要关闭 [RateLimit] 或调大 register 的限额，--db 时改为直接写入服务器数据库创建账户（见 bench_group_chat.py）
+--impair 经过进程内的网络损伤代理连接服务器（见 impair_proxy.py），例如 --impair 3g
+--compression 与服务器协商帧压缩（例如 zlib 或 zstd,zlib），同时启用文件传输压缩
+--tls 使用 TLS 连接（服务器需要启用 [TLS]），参数为校验服务器证书的 CA 文件，每个虚拟用户的连接复用自己的会话
+'''
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.append(".")
+from chat_sdk import AsyncChatClient, ChatError
+from utils import ResumableSSLContext
+from bench_group_chat import percentile, prepare_accounts
+from impair_proxy import Impairment, start_proxies
+
+
+class VirtualUser:
+
+    def __init__(self, index, args, stats, endpoint):
+        self.username = f'{args.prefix}{index}'
+        self.friends = []
+        self.stats = stats
+        host, port, file_port = endpoint
+        self.client = AsyncChatClient(
+            host, port, file_port, request_timeout=args.request_timeout, on_event=self.on_event,
+            compression=args.compression.split(',') if args.compression else None,
+            compress_files=bool(args.compression),
+            ssl_context=ResumableSSLContext.create(args.tls) if args.tls else None
+        )
+
+    def on_event(self, client, event):
+        if event['type'] == 'personal_message':
+            self.stats.received(time.time() - event['timestamp'])
+        elif event['type'] == 'file_transfer':
+            download = asyncio.ensure_future(self.stats.receive_file(self, event))
+            self.stats.downloads.add(download)
+            download.add_done_callback(self.stats.downloads.discard)
+
+
+class Stats:
+
+    def __init__(self, download_dir):
+        self.download_dir = download_dir
+        self.sent = 0
+        self.send_errors = 0
+        self.latencies = []  # 端到端投递延迟
+        self.request_latencies = []  # 发送请求到服务器响应
+        self.file_latencies = []
+        self.file_bytes = 0
+        self.file_started = {}  # file_name -> 开始时间
+        self.downloads = set()
+
+    def received(self, latency):
+        self.latencies.append(latency)
+
+    async def receive_file(self, user, event):
+        file_path = os.path.join(self.download_dir, f"{user.username}-{event['file_name']}")
+        size = await user.client.receive_file(event['ticket'], file_path, event.get('compression'))
+        started = self.file_started.pop(event['file_name'], None)
+        if started is not None:
+            self.file_latencies.append(time.perf_counter() - started)
+        self.file_bytes += size
+        os.remove(file_path)
+
+
+def summarize(values):
+    if not values:
+        return None
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50) * 1000,
+        'p95_ms': percentile(values, 95) * 1000,
+        'p99_ms': percentile(values, 99) * 1000,
+        'max_ms': max(values) * 1000
+    }
+
+
+def build_friend_graph(users, friends, graph):
+    '''
+    ring: 每个用户与其后的 friends 个用户为好友；random: 随机选择 friends 个好友
+    '''
+    count = len(users)
+    friends = min(friends, count - 1)
+    for index, user in enumerate(users):
+        if graph == 'ring':
+            others = [users[(index + offset) % count] for offset in range(1, friends + 1)]
+        else:
+            others = random.sample(users[:index] + users[index + 1:], friends)
+        user.friends = [other.username for other in others]
+
+
+async def connect_all(users, args):
+    '''
+    分批连接，返回 (连接耗时, 登录耗时)
+    '''
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    async def connect(user):
+        async with semaphore:
+            await user.client.connect()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connect(user) for user in users))
+    connect_time = time.perf_counter() - started
+
+    # 登录和注册都要做 bcrypt，排队超过 password_timeout 的请求会被服务器拒绝
+    auth_semaphore = asyncio.Semaphore(args.auth_concurrency)
+
+    async def register(user):
+        async with auth_semaphore:
+            try:
+                await user.client.register(user.username, args.password)
+            except ChatError:
+                pass  # 账户已经存在，或注册被限流（之后登录时报告账户不存在）
+
+    async def login(user):
+        async with auth_semaphore:
+            await user.client.login(user.username, args.password)
+
+    if not args.db:
+        await asyncio.gather(*(register(user) for user in users))
+    started = time.perf_counter()
+    await asyncio.gather(*(login(user) for user in users))
+    return connect_time, time.perf_counter() - started
+
+
+async def add_friends(users, args):
+    semaphore = asyncio.Semaphore(args.connect_concurrency)
+
+    async def add(user, friend):
+        async with semaphore:
+            try:
+                await user.client.add_friend(friend)
+            except ChatError:
+                pass  # 重复运行时好友关系已经存在
+
+    await asyncio.gather(*(add(user, friend) for user in users for friend in user.friends))
+
+
+async def send_messages(user, args, stats, deadline):
+    if not user.friends or args.rate <= 0:
+        return
+    while True:
+        delay = random.expovariate(args.rate)  # 泊松到达
+        if time.perf_counter() + delay >= deadline:
+            return
+        await asyncio.sleep(delay)
+        started = time.perf_counter()
+        try:
+            await user.client.send_message(random.choice(user.friends), 'x' * args.message_size)
+        except (ChatError, asyncio.TimeoutError, ConnectionError):
+            stats.send_errors += 1
+            continue
+        stats.sent += 1
+        stats.request_latencies.append(time.perf_counter() - started)
+
+
+async def send_files(users, args, stats, deadline):
+    '''
+    文件依次发送，延迟从开始上传计算到接收方下载完成
+    '''
+    with tempfile.NamedTemporaryFile(delete=False) as fp:
+        fp.write(os.urandom(args.file_size * 1024))
+        source = fp.name
+    try:
+        index = 0
+        while time.perf_counter() < deadline:
+            user = random.choice([user for user in users if user.friends])
+            file_name = f'loadtest-{index}.bin'
+            path = os.path.join(os.path.dirname(source), file_name)
+            os.replace(source, path)
+            source = path
+            stats.file_started[file_name] = time.perf_counter()
+            try:
+                await user.client.send_file(random.choice(user.friends), source)
+            except (ChatError, asyncio.TimeoutError, OSError):
+                stats.file_started.pop(file_name, None)
+            index += 1
+            await asyncio.sleep(args.file_interval)
+    finally:
+        os.remove(source)
+
+
+async def run(args):
+    stats = Stats(tempfile.mkdtemp(prefix='loadtest-'))
+    random.seed(args.seed)
+    if args.db:
+        prepare_accounts(args.db, [f'{args.prefix}{index}' for index in range(args.users)], args.password)
+    endpoint = (args.host, args.port, args.file_port)
+    proxies = []
+    if args.impair:
+        proxies, ports = await start_proxies(
+            [(0, args.port), (0, args.file_port)], args.host, Impairment.parse(args.impair)
+        )
+        endpoint = ('127.0.0.1', *ports)
+    users = [VirtualUser(index, args, stats, endpoint) for index in range(args.users)]
+    build_friend_graph(users, args.friends, args.graph)
+
+    connect_time, login_time = await connect_all(users, args)
+    print(f'{len(users)} users connected in {connect_time:.2f}s, online in {login_time:.2f}s')
+    started = time.perf_counter()
+    await add_friends(users, args)
+    print(f'Friend graph ready in {time.perf_counter() - started:.2f}s')
+
+    deadline = time.perf_counter() + args.duration
+    tasks = [send_messages(user, args, stats, deadline) for user in users]
+    if args.file_size > 0:
+        tasks.append(send_files(users, args, stats, deadline))
+    await asyncio.gather(*tasks)
+    await asyncio.sleep(args.drain)  # 等待在途消息送达
+    for download in list(stats.downloads):  # 未完成的下载不再等待
+        download.cancel()
+    await asyncio.gather(*(user.client.close() for user in users))
+    for proxy in proxies:
+        await proxy.close()
+    shutil.rmtree(stats.download_dir, ignore_errors=True)
+
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'config': vars(args),
+        'users': len(users),
+        'connect_seconds': connect_time,
+        'connect_rate': len(users) / connect_time,
+        'online_seconds': login_time,
+        'messages_sent': stats.sent,
+        'messages_received': len(stats.latencies),
+        'send_errors': stats.send_errors,
+        'sent_per_second': stats.sent / args.duration,
+        'received_per_second': len(stats.latencies) / args.duration,
+        'delivery_latency': summarize(stats.latencies),
+        'request_latency': summarize(stats.request_latencies),
+        'files_received': len(stats.file_latencies),
+        'file_bytes': stats.file_bytes,
+        'file_latency': summarize(stats.file_latencies),
+        'proxy': str(proxies[0].stats) if proxies else None
+    }
+
+
+def compare(result, baseline):
+    '''
+    与之前保存的结果对比主要指标
+    '''
+    metrics = [
+        ('connect_rate', None), ('received_per_second', None), ('delivery_latency', 'p50_ms'),
+        ('delivery_latency', 'p95_ms'), ('delivery_latency', 'p99_ms'), ('request_latency', 'p99_ms')
+    ]
+    for name, key in metrics:
+        old, new = baseline.get(name), result.get(name)
+        if key is not None:
+            old, new = (old or {}).get(key), (new or {}).get(key)
+        if not old or new is None:
+            continue
+        label = name if key is None else f'{name}.{key}'
+        print(f'{label:<28} {old:>12.2f} -> {new:>12.2f} ({(new - old) / old * 100:+.1f}%)')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='ChatApp load test')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--file-port', type=int, default=9998)
+    parser.add_argument('--db', help='服务器 users.db 路径，指定时直接写入数据库创建测试账户，不经过 register 请求')
+    parser.add_argument('--users', type=int, default=100)
+    parser.add_argument('--prefix', default='lt', help='测试账户用户名前缀')
+    parser.add_argument('--password', default='123')
+    parser.add_argument('--connect-concurrency', type=int, default=200, help='连接和加好友阶段的并发请求数')
+    parser.add_argument('--auth-concurrency', type=int, default=8, help='注册和登录的并发请求数')
+    parser.add_argument('--request-timeout', type=float, default=30)
+    parser.add_argument('--friends', type=int, default=5, help='每个用户的好友数')
+    parser.add_argument('--graph', choices=('ring', 'random'), default='random')
+    parser.add_argument('--rate', type=float, default=1.0, help='每个用户每秒发送的消息数')
+    parser.add_argument('--message-size', type=int, default=64, help='消息内容字节数')
+    parser.add_argument('--duration', type=float, default=30, help='发送阶段持续秒数')
+    parser.add_argument('--drain', type=float, default=2, help='发送结束后等待送达的秒数')
+    parser.add_argument('--file-size', type=int, default=0, help='文件大小 (KB)，0 表示不传输文件')
+    parser.add_argument('--file-interval', type=float, default=1.0, help='两次文件传输之间的间隔秒数')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--compression', help='协商的压缩算法，逗号分隔，例如 zstd,zlib')
+    parser.add_argument('--tls', metavar='CA_FILE', help='使用 TLS 连接，例如 --tls server.crt')
+    parser.add_argument('--impair', help='网络损伤参数，例如 3g 或 latency=50,bandwidth=512，见 impair_proxy.py')
+    parser.add_argument('--output', help='结果写入的 JSON 文件')
+    parser.add_argument('--compare', help='与之前保存的 JSON 结果对比')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            compare(result, json.load(fp))
@@ -0,0 +1,43 @@
+'''
+生成自签名的服务器证书（需要 openssl 命令），用于 [TLS] 和 bench_tls.py
+用法: python ./tool/make_cert.py [--host localhost --host 127.0.0.1] [--cert server.crt --key server.key]
+
+客户端把生成的证书作为 ca_file 校验服务器，连接使用的主机名或 IP 必须在 --host 中
+'''
+import argparse
+import ipaddress
+import subprocess
+
+
+def subject_alt_names(hosts):
+    names = []
+    for host in hosts:
+        try:
+            ipaddress.ip_address(host)
+            names.append(f'IP:{host}')
+        except ValueError:
+            names.append(f'DNS:{host}')
+    return ','.join(names)
+
+
+def make_cert(cert_file, key_file, hosts, days=365):
+    subprocess.run(
+        [
+            'openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1', '-nodes',
+            '-keyout', key_file, '-out', cert_file, '-days', str(days), '-subj', f'/CN={hosts[0]}',
+            '-addext', f'subjectAltName={subject_alt_names(hosts)}'
+        ],
+        check=True,
+        capture_output=True
+    )
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Create a self-signed server certificate')
+    parser.add_argument('--host', action='append', help='证书中的主机名或 IP，可重复，默认 localhost 和 127.0.0.1')
+    parser.add_argument('--cert', default='server.crt')
+    parser.add_argument('--key', default='server.key')
+    parser.add_argument('--days', type=int, default=365)
+    args = parser.parse_args()
+    make_cert(args.cert, args.key, args.host or ['localhost', '127.0.0.1'], args.days)
+    print(f'Wrote {args.cert} and {args.key}')
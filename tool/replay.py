@@ -0,0 +1,235 @@
+'''
+重放服务器记录的流量（[Capture] 或管理命令 capture start），需要先在仓库根目录启动测试服务器
+用法: python ./tool/replay.py capture.bin --speed 10 --output result.json [--compare baseline.json]
+
+- 按记录中的相对时间发送，--speed 为倍速，0 表示不等待、尽快发送
+- 每个记录的连接对应一个 chat_sdk 连接，用户名加上 --prefix 前缀，重放前通过 register 请求创建账户
+  （测试服务器需要关闭 [RateLimit] 或调大 register 的限额），--db 时改为直接写入测试服务器数据库
+- 登录使用 --password，恢复会话改为登录；文件传输和删除账户不重放
+- 统计每种请求的响应延迟和消息端到端投递延迟，--compare 与之前的结果对比，p99 退化超过 --threshold 时退出码为 1
+'''
+import argparse
+import asyncio
+import json
+import sys
+import time
+import uuid
+from collections import defaultdict
+
+sys.path.append(".")
+sys.path.append("./server")
+from chat_sdk import AsyncChatClient, ChatError
+from utils import MessageBuilder as mb
+from capture import CLOSE, FRAME, OPEN, read_capture, rename
+from bench_group_chat import prepare_accounts
+from loadtest import summarize
+
+SKIPPED_ACTIONS = ('file_transfer', 'delete_account')
+
+
+class Replay:
+
+    def __init__(self, args):
+        self.args = args
+        self.clients = {}  # 连接编号 -> AsyncChatClient
+        self.in_flight = defaultdict(set)  # 连接编号 -> 未完成的请求
+        self.request_latencies = defaultdict(list)  # action -> 响应延迟
+        self.delivery_latencies = []
+        self.errors = defaultdict(int)  # 服务器返回失败
+        self.failures = defaultdict(int)  # 超时或连接断开
+        self.skipped = defaultdict(int)
+        self.frames = 0
+
+    def prefixed(self, name):
+        return self.args.prefix + name
+
+    def on_event(self, client, event):
+        if event.get('type') in ('personal_message', 'group_message') and 'timestamp' in event:
+            self.delivery_latencies.append(time.time() - event['timestamp'])
+
+    async def client(self, connection):
+        client = self.clients.get(connection)
+        if client is None:
+            client = self.clients[connection] = AsyncChatClient(
+                self.args.host, self.args.port, request_timeout=self.args.request_timeout, on_event=self.on_event
+            )
+            await client.connect()
+        return client
+
+    async def close(self, connection):
+        client = self.clients.pop(connection, None)
+        if client is None:
+            return
+        await asyncio.gather(*self.in_flight.pop(connection, ()), return_exceptions=True)
+        await client.close()
+
+    def prepare(self, message):
+        '''
+        换成测试账户、刷新时间戳和幂等键，返回 (action, 消息)，不重放的返回 (action, None)
+        '''
+        message = rename(message, self.prefixed, self.prefixed)
+        action = message.get('action') or message['type']
+        if action in SKIPPED_ACTIONS:
+            return action, None
+        request_data = message.get('request_data') or {}
+        if action == 'resume_session':
+            message = mb.build_login_request(request_data['username'], self.args.password)
+        elif 'password' in request_data:
+            request_data['password'] = self.args.password
+        message['timestamp'] = time.time()
+        if 'timestamp' in request_data:
+            request_data['timestamp'] = message['timestamp']
+        if 'message_id' in request_data:
+            request_data['message_id'] = uuid.uuid4().hex
+        return action, message
+
+    async def request(self, client, action, message):
+        started = time.perf_counter()
+        try:
+            await client.request(message)
+        except ChatError:
+            self.errors[action] += 1
+        except (asyncio.TimeoutError, ConnectionError):
+            self.failures[action] += 1
+            return
+        self.request_latencies[action].append(time.perf_counter() - started)
+
+    async def send(self, connection, message):
+        action, message = self.prepare(message)
+        if message is None:
+            self.skipped[action] += 1
+            return
+        client = await self.client(connection)
+        self.frames += 1
+        if message['type'] != 'request':
+            client.send(message)
+            return
+        task = asyncio.ensure_future(self.request(client, action, message))
+        in_flight = self.in_flight[connection]
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    async def run(self, records):
+        started = time.perf_counter()
+        for offset, connection, kind, message in records:
+            if self.args.speed > 0:
+                delay = started + offset / self.args.speed - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            if kind == OPEN:
+                await self.client(connection)
+            elif kind == CLOSE:
+                asyncio.ensure_future(self.close(connection))
+            elif kind == FRAME:
+                await self.send(connection, message)
+        await asyncio.gather(*(task for tasks in self.in_flight.values() for task in tasks), return_exceptions=True)
+        elapsed = time.perf_counter() - started
+        await asyncio.sleep(self.args.drain)  # 等待在途消息送达
+        await asyncio.gather(*(self.close(connection) for connection in list(self.clients)))
+        return elapsed
+
+
+def capture_users(records):
+    users = set()
+    for _, _, kind, message in records:
+        if kind == FRAME:
+            rename(message, lambda name: users.add(name) or name, lambda name: name)
+    return users
+
+
+async def register_accounts(args, usernames):
+    '''
+    已存在的账户忽略，bcrypt 排队超过 password_timeout 的请求会被服务器拒绝，并发数不宜过大
+    '''
+    client = AsyncChatClient(args.host, args.port, request_timeout=args.request_timeout)
+    await client.connect()
+    semaphore = asyncio.Semaphore(args.auth_concurrency)
+
+    async def register(username):
+        async with semaphore:
+            try:
+                await client.register(username, args.password)
+            except ChatError:
+                pass
+
+    await asyncio.gather(*(register(username) for username in usernames))
+    await client.close()
+
+
+async def run(args):
+    records = list(read_capture(args.capture))
+    usernames = [args.prefix + user for user in capture_users(records)]
+    if args.db:
+        prepare_accounts(args.db, usernames, args.password)
+    else:
+        await register_accounts(args, usernames)
+    replay = Replay(args)
+    elapsed = await replay.run(records)
+    captured = records[-1][0] if records else 0
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'capture': args.capture,
+        'speed': args.speed,
+        'captured_seconds': captured,
+        'replay_seconds': elapsed,
+        'frames': replay.frames,
+        'skipped': dict(replay.skipped),
+        'errors': dict(replay.errors),
+        'failures': dict(replay.failures),
+        'request_latency': {action: summarize(values) for action, values in sorted(replay.request_latencies.items())},
+        'delivery_latency': summarize(replay.delivery_latencies)
+    }
+
+
+def compare(result, baseline, threshold):
+    '''
+    对比每种请求和消息投递的 p50/p99，返回 p99 退化超过 threshold 的项
+    '''
+    pairs = [('delivery', baseline.get('delivery_latency'), result.get('delivery_latency'))]
+    for action, new in result['request_latency'].items():
+        pairs.append((action, baseline['request_latency'].get(action), new))
+    regressions = []
+    print(f"{'latency':<24} {'p50 ms':>18} {'p99 ms':>22}")
+    for name, old, new in pairs:
+        if not old or not new:
+            continue
+        change = new['p99_ms'] / old['p99_ms'] - 1 if old['p99_ms'] else 0
+        flag = ''
+        if change > threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(
+            f"{name:<24} {old['p50_ms']:>8.2f} -> {new['p50_ms']:>7.2f} "
+            f"{old['p99_ms']:>8.2f} -> {new['p99_ms']:>7.2f} ({change * 100:+.1f}%){flag}"
+        )
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Replay captured ChatApp traffic')
+    parser.add_argument('capture', help='capture 文件')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9999)
+    parser.add_argument('--db', help='测试服务器 users.db 路径，指定时直接写入数据库创建账户，不经过 register 请求')
+    parser.add_argument('--auth-concurrency', type=int, default=8, help='注册的并发请求数')
+    parser.add_argument('--prefix', default='rp_', help='测试账户用户名和群名前缀')
+    parser.add_argument('--password', default='123')
+    parser.add_argument('--speed', type=float, default=1.0, help='倍速，0 表示尽快发送')
+    parser.add_argument('--request-timeout', type=float, default=30)
+    parser.add_argument('--drain', type=float, default=2, help='发送结束后等待送达的秒数')
+    parser.add_argument('--output', help='结果写入的 JSON 文件')
+    parser.add_argument('--compare', help='与之前保存的 JSON 结果对比')
+    parser.add_argument('--threshold', type=float, default=0.2, help='判定退化的 p99 相对变化')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2))
+    if args.output:
+        with open(args.output, 'w') as fp:
+            json.dump(result, fp, indent=2)
+    if args.compare:
+        with open(args.compare) as fp:
+            sys.exit(1 if compare(result, json.load(fp), args.threshold) else 0)
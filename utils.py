@@ -1,5 +1,15 @@
 import bcrypt
+import json
+import ssl
+import struct
 import time
+import uuid
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # 可选依赖，未安装时只支持 zlib
+    zstandard = None
 
 
 class Utils:
@@ -26,12 +36,28 @@ class Utils:
             return False, 'Username has invald characters'
         return True, 'OK'
 
+    @staticmethod
+    def is_valid_group_name(groupname: str):
+        '''群名合法性检测：长度1-30，仅允许可打印的ascii字符
+        '''
+        if not groupname:
+            return False, 'Group name is too short'
+        elif len(groupname) > 30:
+            return False, 'Group name is too long'
+        if not all(ord(char) >= 32 and ord(char) < 127 for char in groupname):
+            return False, 'Group name has invald characters'
+        return True, 'OK'
+
     @staticmethod
     def hash_password(password):
         salt = bcrypt.gensalt()
         hashed_password = bcrypt.hashpw(password.encode('utf-8'), salt)
         return hashed_password.decode('utf-8')
 
+    @staticmethod
+    def check_password(password, password_hash):
+        return bcrypt.checkpw(password.encode('utf-8'), password_hash.encode('utf-8'))
+
     @staticmethod
     def is_valid_password(password):
         minlen = 3
@@ -54,6 +80,266 @@ class Utils:
         return success, message
 
 
+class Protocol:
+    '''
+    消息帧格式: JSON 文本 + 分隔符 '!@#'，服务器、桌面客户端和 SDK 共用
+    MAX_FRAME_SIZE 为单个帧（解压后）的上限，超过时 feed 抛出 ValueError，由接收方断开连接
+    '''
+    DELIMITER = b'!@#'
+    MAX_FRAME_SIZE = 8 * 1024 * 1024
+
+    @staticmethod
+    def encode(message):
+        return json.dumps(message).encode('utf-8') + Protocol.DELIMITER
+
+    @staticmethod
+    def decode(frame):
+        return json.loads(frame.decode('utf-8'))
+
+
+class FrameBuffer:
+    '''
+    拼接每次收到的数据，返回其中完整的消息帧；一次 recv 可能只收到半个消息，不完整的尾部留到下次
+    '''
+
+    def __init__(self):
+        self.pending = b''
+
+    def feed(self, data):
+        frames = (self.pending + data).split(Protocol.DELIMITER)
+        self.pending = frames.pop()
+        if len(self.pending) > Protocol.MAX_FRAME_SIZE:
+            raise ValueError(f'Frame exceeds {Protocol.MAX_FRAME_SIZE} bytes')
+        return frames
+
+
+class Compression:
+    '''
+    连接级压缩：客户端连接后发送 hello 列出支持的算法，服务器选择其中一个，此后两个方向都使用 FrameCodec
+    DICTIONARY 是协议的一部分，两端必须相同；压缩流的窗口较小，每个连接的压缩状态约几十 KB
+    '''
+    # 常见的键名和取值，越常用的放在越后面（距离越近，引用越短）
+    DICTIONARY = (
+        b'"file_transfer_status", "ticket": "status": "delivered", "group_delivery", "delivered": "queued": '
+        b'"failed": "presence", "changes": {"friends": ["online": {"version": "added": "removed": '
+        b'{"type": "request", "action": "file_transfer", "request_data": {"type": "file_transfer", '
+        b'"file_name": "file_size": "chunk_size": "get_friends", "get_groups", "add_friend", "friend": '
+        b'"send_group_messager", "group": "group_message", "seq": "epoch": "conversation": "g:'
+        b'{"type": "response", "timestamp": "success": true, "message": "send success", "data": null}'
+        b'{"type": "request", "action": "send_personal_message", "request_data": {"type": "personal_message", '
+        b'"sender": "receiver": "content": "timestamp": "message_id": "conversation": "p:'
+        b'{"type": "heartbeat", "who": "timestamp": '
+    )
+    ZLIB_WBITS = 12  # 4KB 窗口
+    ZLIB_MEM_LEVEL = 5
+    SYNC_MARKER = b'\x00\x00\xff\xff'  # Z_SYNC_FLUSH 的结尾固定为这 4 个字节，发送时省略，接收时补回
+    SAMPLE_SIZE = 65536
+    ZSTD_INPUT_STEP = 256
+    COMPRESSIBLE_RATIO = 0.9
+
+    @staticmethod
+    def available():
+        return ['zstd', 'zlib'] if zstandard is not None else ['zlib']
+
+    @staticmethod
+    def stream(algorithm, level, max_size=None):
+        '''
+        返回 (compress, decompress)，两者各自维护跨帧的压缩状态，每次调用处理一个完整的帧
+        decompress 解压后超过 max_size（默认 Protocol.MAX_FRAME_SIZE）或数据损坏时抛出 ValueError，
+        解压过程中输出不会超过上限太多，防止很小的压缩帧解压出大量数据
+        '''
+        max_size = max_size or Protocol.MAX_FRAME_SIZE
+        if algorithm == 'zlib':
+            compressor = zlib.compressobj(
+                level, zlib.DEFLATED, -Compression.ZLIB_WBITS, Compression.ZLIB_MEM_LEVEL, zdict=Compression.DICTIONARY
+            )
+            decompressor = zlib.decompressobj(-Compression.ZLIB_WBITS, zdict=Compression.DICTIONARY)
+
+            def compress(data):
+                return (compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH))[:-4]
+
+            def decompress(data):
+                try:
+                    frame = decompressor.decompress(data + Compression.SYNC_MARKER, max_size + 1)
+                except zlib.error as e:
+                    raise ValueError(f'Corrupt compressed frame: {e}')
+                if len(frame) > max_size or decompressor.unconsumed_tail:
+                    raise ValueError(f'Frame exceeds {max_size} bytes')
+                return frame
+
+            return compress, decompress
+        if algorithm == 'zstd' and zstandard is not None:
+            dictionary = zstandard.ZstdCompressionDict(
+                Compression.DICTIONARY, dict_type=zstandard.DICT_TYPE_RAWCONTENT
+            )
+            parameters = zstandard.ZstdCompressionParameters.from_level(level, window_log=16)
+            compressor = zstandard.ZstdCompressor(dict_data=dictionary, compression_params=parameters).compressobj()
+            decompressor = zstandard.ZstdDecompressor(dict_data=dictionary).decompressobj()
+
+            def compress(data):
+                return compressor.compress(data) + compressor.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+
+            def decompress(data):
+                # zstandard 的 decompressobj 不支持限制输出长度，按小块输入并检查累计长度；
+                # 每 ZSTD_INPUT_STEP 字节输入最多解压出几 MB，超出上限的部分有界
+                frame = []
+                size = 0
+                try:
+                    for offset in range(0, len(data), Compression.ZSTD_INPUT_STEP):
+                        chunk = decompressor.decompress(data[offset:offset + Compression.ZSTD_INPUT_STEP])
+                        size += len(chunk)
+                        if size > max_size:
+                            raise ValueError(f'Frame exceeds {max_size} bytes')
+                        frame.append(chunk)
+                except zstandard.ZstdError as e:
+                    raise ValueError(f'Corrupt compressed frame: {e}')
+                return frame[0] if len(frame) == 1 else b''.join(frame)
+
+            return compress, decompress
+        raise ValueError(f'Unsupported compression {algorithm}')
+
+    @staticmethod
+    def is_compressible(sample):
+        '''
+        用最快的压缩级别试压一段样本，判断数据是否值得压缩（已经压缩过的图片、压缩包等不值得）
+        '''
+        return bool(sample) and len(zlib.compress(sample, 1)) < len(sample) * Compression.COMPRESSIBLE_RATIO
+
+    @staticmethod
+    def is_file_compressible(file_path):
+        with open(file_path, 'rb') as fp:
+            return Compression.is_compressible(fp.read(Compression.SAMPLE_SIZE))
+
+
+class FrameCodec:
+    '''
+    协商压缩后使用的帧格式：1 字节标志 + 4 字节长度 + 数据，不再使用分隔符（压缩数据中可能出现分隔符）
+    小于 min_size 的帧（心跳、ack 等）不压缩；其余帧是同一个压缩流中的一段，
+    重复出现的键名、用户名在整个连接期间只需要传一次完整内容
+    encode 必须按发送顺序调用，feed 必须按接收顺序调用
+    files 为 True 表示客户端同时启用了文件传输压缩
+    '''
+    HEADER = struct.Struct('>BI')
+    RAW, COMPRESSED = 0, 1
+
+    def __init__(self, algorithm, min_size=128, level=6, files=False):
+        self.algorithm = algorithm
+        self.min_size = min_size
+        self.files = files
+        self.compress, self.decompress = Compression.stream(algorithm, level)
+        self.pending = b''
+
+    def encode(self, frame):
+        '''
+        frame 为 Protocol.encode 的结果（带分隔符）
+        '''
+        payload = memoryview(frame)[:-len(Protocol.DELIMITER)]
+        if len(payload) < self.min_size:
+            return self.HEADER.pack(self.RAW, len(payload)) + payload
+        data = self.compress(payload)
+        return self.HEADER.pack(self.COMPRESSED, len(data)) + data
+
+    def feed(self, data):
+        '''
+        与 FrameBuffer.feed 相同，返回收到的完整帧（JSON 字节串）
+        帧超过 Protocol.MAX_FRAME_SIZE（声明的长度或解压后的长度）或压缩数据损坏时抛出 ValueError
+        '''
+        buffer = self.pending + data if self.pending else data
+        frames = []
+        offset = 0
+        while len(buffer) - offset >= self.HEADER.size:
+            flag, length = self.HEADER.unpack_from(buffer, offset)
+            if length > Protocol.MAX_FRAME_SIZE:
+                # 在收完之前就拒绝，不为声明的超大长度缓存数据
+                raise ValueError(f'Frame length {length} exceeds {Protocol.MAX_FRAME_SIZE} bytes')
+            end = offset + self.HEADER.size + length
+            if end > len(buffer):
+                break
+            payload = buffer[offset + self.HEADER.size:end]
+            frames.append(self.decompress(payload) if flag == self.COMPRESSED else payload)
+            offset = end
+        self.pending = buffer[offset:]
+        return frames
+
+
+async def negotiate_compression(reader, writer, algorithms, files=False, min_size=128, level=6):
+    '''
+    客户端在连接建立后、发送其他消息之前调用，返回 FrameCodec，服务器不支持压缩时返回 None
+    '''
+    writer.write(Protocol.encode(MessageBuilder.build_hello(algorithms, files)))
+    frame_buffer = FrameBuffer()
+    while True:
+        data = await reader.read(4096)
+        if not data:
+            raise ConnectionError('Connection closed during compression negotiation')
+        frames = frame_buffer.feed(data)
+        if frames:
+            break
+    reply = Protocol.decode(frames[0])
+    if not reply.get('compression'):
+        return None
+    codec = FrameCodec(reply['compression'], min_size, level, bool(reply.get('file_compression')))
+    codec.pending = frame_buffer.pending
+    return codec
+
+
+class ResumableSSLSocket(ssl.SSLSocket):
+    '''
+    关闭后 SSLSocket 不再能取得会话，所以在关闭前交给上下文保存
+    '''
+
+    def close(self):
+        if isinstance(self.context, ResumableSSLContext):
+            self.context.remember(self)
+        super().close()
+
+
+class ResumableSSLContext(ssl.SSLContext):
+    '''
+    客户端 TLS 上下文：新连接复用之前的连接得到的会话票据，重连和文件数据连接只需简短握手
+    asyncio 的 open_connection 没有 session 参数，因此在 wrap_bio 中传入
+    TLS 1.3 的票据在握手之后才收到，所以每次新建连接时再从最近一个连接取会话
+    '''
+    sslsocket_class = ResumableSSLSocket
+    saved_session = None
+    last_connection = None
+
+    @staticmethod
+    def create(ca_file=None):
+        context = ResumableSSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        if ca_file:
+            context.load_verify_locations(ca_file)
+        else:
+            context.load_default_certs()
+        return context
+
+    def remember(self, connection):
+        session = connection.session
+        if session is not None and session.has_ticket:
+            self.saved_session = session
+
+    def resumable_session(self):
+        if self.last_connection is not None:
+            self.remember(self.last_connection)
+        return self.saved_session
+
+    def wrap_bio(self, incoming, outgoing, server_side=False, server_hostname=None, session=None):
+        connection = super().wrap_bio(
+            incoming, outgoing, server_side, server_hostname, session or self.resumable_session()
+        )
+        self.last_connection = connection
+        return connection
+
+    def wrap_socket(self, sock, server_side=False, do_handshake_on_connect=True, suppress_ragged_eofs=True,
+                    server_hostname=None, session=None):
+        connection = super().wrap_socket(
+            sock, server_side, do_handshake_on_connect, suppress_ragged_eofs, server_hostname,
+            session or self.resumable_session()
+        )
+        self.last_connection = connection
+        return connection
+
+
 class MessageBuilder:
 
     # 生成响应信息
@@ -73,6 +359,66 @@ class MessageBuilder:
         response_data = {'type': 'friends', 'friends': friends}
         return response_data
 
+    # 带版本号的好友列表同步数据，friends 为完整列表，added/removed 为增量
+    @staticmethod
+    def build_friends_sync_data(version, friends=None, added=None, removed=None, online=None):
+        response_data = {'version': version}
+        if friends is not None:
+            response_data['friends'] = friends
+        elif added is None and removed is None:
+            response_data['not_modified'] = True
+        else:
+            response_data['added'] = added or {}
+            response_data['removed'] = removed or []
+        if online is not None:
+            response_data['online'] = online
+        return response_data
+
+    # 好友在线状态变更推送，changes: {username: bool}
+    @staticmethod
+    def build_presence(changes):
+        message_data = {'type': 'presence', 'changes': changes}
+        return message_data
+
+    # 群消息投递完成事件，发送给群消息的发送者
+    @staticmethod
+    def build_group_delivery_event(group, request_timestamp, delivered, queued, failed):
+        message_data = {
+            'type': 'group_delivery',
+            'group': group,
+            'timestamp': request_timestamp,
+            'delivered': delivered,
+            'queued': queued,
+            'failed': failed
+        }
+        return message_data
+
+    # 文件传输状态事件，发送给文件的发送者
+    # status: delivered（所有接收设备下载完成）/ queued（接收者离线，上线后发送）/ failed
+    @staticmethod
+    def build_file_transfer_event(ticket, status, receiver, file_name, request_timestamp):
+        message_data = {
+            'type': 'file_transfer_status',
+            'ticket': ticket,
+            'status': status,
+            'receiver': receiver,
+            'file_name': file_name,
+            'timestamp': request_timestamp
+        }
+        return message_data
+
+    # 消息确认，acks: {conversation: seq}，一次确认每个会话中 seq 及之前的全部消息
+    @staticmethod
+    def build_ack(epoch, acks):
+        message_data = {'type': 'ack', 'epoch': epoch, 'acks': acks}
+        return message_data
+
+    # 连接建立后协商压缩，客户端发送支持的算法，服务器回复选定的一个（None 表示不压缩）
+    @staticmethod
+    def build_hello(compression, file_compression=False):
+        message_data = {'type': 'hello', 'compression': compression, 'file_compression': file_compression}
+        return message_data
+
     # 生成心跳包
     @staticmethod
     def build_heartbeat(who):
@@ -82,11 +428,12 @@ class MessageBuilder:
     # region 生成请求消息
     # 根据请求内容生成请求
     @staticmethod
-    def build_request(action, request_data, timestamp=time.time()):
+    def build_request(action, request_data, timestamp=None):
+        # 客户端按 timestamp 匹配响应，每个请求都需要取当前时间
         message_data = {
             'type': 'request',
             'action': action,
-            'timestamp': timestamp,
+            'timestamp': time.time() if timestamp is None else timestamp,
             'request_data': request_data
         }
         return message_data
@@ -97,6 +444,11 @@ class MessageBuilder:
         request_data = {'username': username, 'password': password}
         return MessageBuilder.build_request('login', request_data)
 
+    @staticmethod
+    def build_resume_session_request(username, session_token):
+        request_data = {'username': username, 'session_token': session_token}
+        return MessageBuilder.build_request('resume_session', request_data)
+
     @staticmethod
     def build_logout_request(username):
         request_data = {'username': username}
@@ -118,8 +470,9 @@ class MessageBuilder:
         return MessageBuilder.build_request('add_friend', request_data)
 
     @staticmethod
-    def build_get_friends_request(username):
-        request_data = {'username': username}
+    def build_get_friends_request(username, version=None):
+        # 携带 version 字段表示客户端支持增量同步，首次同步时为 None
+        request_data = {'username': username, 'version': version}
         return MessageBuilder.build_request('get_friends', request_data)
 
     @staticmethod
@@ -134,7 +487,8 @@ class MessageBuilder:
             'sender': sender,
             'receiver': receiver,
             'content': content,
-            'timestamp': time.time()
+            'timestamp': time.time(),
+            'message_id': uuid.uuid4().hex  # 幂等键，重试时保持不变
         }
         return MessageBuilder.build_request('send_personal_message', message_data)
 
@@ -145,14 +499,37 @@ class MessageBuilder:
             'sender': sender,
             'group': group,
             'content': content,
-            'timestamp': time.time()
+            'timestamp': time.time(),
+            'message_id': uuid.uuid4().hex
         }
         return MessageBuilder.build_request('send_group_messager', message_data)
 
+    @staticmethod
+    def build_create_group_request(username, group):
+        request_data = {'username': username, 'group': group}
+        return MessageBuilder.build_request('create_group', request_data)
+
+    @staticmethod
+    def build_join_group_request(username, group):
+        request_data = {'username': username, 'group': group}
+        return MessageBuilder.build_request('join_group', request_data)
+
+    @staticmethod
+    def build_leave_group_request(username, group):
+        request_data = {'username': username, 'group': group}
+        return MessageBuilder.build_request('leave_group', request_data)
+
+    @staticmethod
+    def build_get_groups_request(username):
+        request_data = {'username': username}
+        return MessageBuilder.build_request('get_groups', request_data)
+
     @staticmethod
     def build_send_file_request(
-        sender, receiver, file_name, file_size, timestamp=time.time(), chunk_size=1024
+        sender, receiver, file_name, file_size, timestamp=None, chunk_size=1024, ticket=None, compression=None
     ):
+        if timestamp is None:
+            timestamp = time.time()
         request_data = {
             'type': 'file_transfer',
             'sender': sender,
@@ -162,6 +539,10 @@ class MessageBuilder:
             'chunk_size': chunk_size,
             'timestamp': timestamp
         }
+        if ticket is not None:  # 服务器转发给接收者的通知带有下载凭证
+            request_data['ticket'] = ticket
+        if compression is not None:  # 文件数据为 zlib 压缩流
+            request_data['compression'] = compression
         return MessageBuilder.build_request('file_transfer', request_data)
 
     # endregion